@@ -1,15 +1,125 @@
+import hashlib
+import json
 import os
-from flask import Flask, request, abort, jsonify
-from models import setup_db, db_drop_and_create_all, Actor, Movie, Rating
-from auth import AuthError, requires_auth
+import threading
+from flask import Flask, Response, request, abort, jsonify, g, stream_with_context
+from models import setup_db, db_drop_and_create_all, bulk_insert, bulk_update, bulk_delete, \
+    delete_row, cast_actor, uncast_actor, get_versions, on_commit, pool_status, update_versioned, db, \
+    read_engine, sticky_clients, use_primary, use_replica, Actor, Job, Movie, Rating
+from auth import AuthError, RateLimitError, authenticate, authorize, check_permissions, rate_limiter, \
+    request_subject, requires_auth, token_cache
+from cache import create_response_cache
+from compression import setup_compression
+from export import EXPORT_MIMETYPES, EXPORT_RETRY_AFTER, acquire_export_slot, stream_export
+from idempotency import idempotent
+from jobs import MAX_JOB_ITEMS, enqueue, register_job
+from metrics import registry, setup_metrics
+from profiler import setup_profiler
+from queries import ACTOR_COLUMNS, MOVIE_COLUMNS, ACTOR_FILTERS, MOVIE_FILTERS, ACTOR_SORT, \
+    MOVIE_SORT, ACTOR_MOVIE_COLUMNS, MOVIE_ACTOR_COLUMNS, ACTOR_RATING_COLUMNS, \
+    MOVIE_RATING_COLUMNS, paginate, select_fields, split_page, \
+    actor_movies_query, movie_actors_query, rating_aggregates_query
+from serializers import json_response, rows_to_dicts
+from validators import ValidationError, validate_actor, validate_movie, validate_rating
 from flask_cors import CORS
-
-PAGE_SIZE = 10
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload
+from werkzeug.exceptions import ServiceUnavailable
+
+MAX_BULK_ITEMS = int(os.environ.get('MAX_BULK_ITEMS', 10000))
+
+# 'lru' (per process), 'redis' (shared, needs RESPONSE_CACHE_URL) or 'none'
+RESPONSE_CACHE = os.environ.get('RESPONSE_CACHE', 'lru')
+RESPONSE_CACHE_URL = os.environ.get('RESPONSE_CACHE_URL')
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 1024))
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 300))
+
+response_cache = create_response_cache(RESPONSE_CACHE, RESPONSE_CACHE_URL,
+                                       RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+# committed writes drop the cached responses built from the tables they touched
+on_commit(response_cache.invalidate)
+
+# cache and pool statistics published next to the request histograms on /metrics
+registry.register_stats('response_cache', response_cache.stats)
+registry.register_stats('token_cache', token_cache.stats)
+registry.register_stats('rate_limit', rate_limiter.stats)
+registry.register_stats('db_pool', pool_status)
+
+# tables each read endpoint depends on, used to build its ETag and cache key
+CONDITIONAL_TABLES = {
+    'get_actors': ('actors',),
+    'get_movies': ('movies',),
+    'get_actor_movies': ('actors', 'movies', 'ratings'),
+    'get_movie_actors': ('actors', 'movies', 'ratings'),
+    'get_actor_ratings': ('actors', 'ratings'),
+    'get_top_movies': ('movies', 'ratings')
+}
+
+# headers added to every response, next to the Access-Control-Allow-Origin of flask_cors
+CORS_HEADERS = (
+    ('Access-Control-Allow-Headers',
+     'Content-Type,Authorization,If-Match,If-None-Match,If-Modified-Since,Idempotency-Key,'
+     'Prefer,X-Profile,true'),
+    ('Access-Control-Allow-Methods', 'GET,PUT,PATCH,POST,DELETE,OPTIONS'),
+    ('Access-Control-Expose-Headers', 'ETag,Last-Modified,X-Cache,X-Profile-Id,Idempotent-Replayed,'
+     'Retry-After,Location,Preference-Applied')
+)
+
+ERROR_MESSAGES = {
+    400: 'bad request',
+    404: 'resource not found',
+    409: 'conflict',
+    412: 'precondition failed',
+    413: 'payload too large',
+    422: 'unprocessable',
+    503: 'service unavailable'
+}
+
+
+'''
+conditional_state(endpoint, view_args, args, versions)
+    strong ETag and Last-Modified date of a read endpoint's response, built
+    from the request and the versions of the tables the endpoint reads
+'''
+def conditional_state(endpoint, view_args, args, versions):
+    etag = hashlib.sha1(json.dumps([
+        endpoint,
+        view_args,
+        sorted(args.items(multi=True)),
+        sorted((name, version) for name, (version, _) in versions.items())
+    ]).encode()).hexdigest()
+    last_modified = max((updated_at for _, updated_at in versions.values()), default=None)
+    return etag, last_modified
+
+
+'''
+not_modified(etag, last_modified, if_none_match, if_modified_since)
+    whether the client's copy is current, If-None-Match (werkzeug ETags)
+    takes precedence over If-Modified-Since (an aware datetime)
+'''
+def not_modified(etag, last_modified, if_none_match, if_modified_since):
+    if if_none_match:
+        # weak comparison, the list ETags are weak
+        return if_none_match.contains_weak(etag)
+    return if_modified_since is not None and last_modified is not None and \
+        last_modified.replace(microsecond=0) <= if_modified_since.replace(tzinfo=None)
+
+
+'''
+response_cache_key(endpoint, etag, payload)
+    cached bodies are shared by the tokens holding the same permissions
+'''
+def response_cache_key(endpoint, etag, payload):
+    permissions = ','.join(sorted(payload.get('permissions', [])))
+    return endpoint + ':' + hashlib.sha1((etag + permissions).encode()).hexdigest()
 
 
 def create_app(test_config=None):
 
     app = Flask(__name__)
+    setup_metrics(app)
+    setup_profiler(app)
+    setup_compression(app)
     setup_db(app)
     CORS(app)
 
@@ -19,55 +129,403 @@ def create_app(test_config=None):
 
     @app.after_request
     def after_request(response):
-        response.headers.add('Access-Control-Allow-Headers',
-                             'Content-Type,Authorization,true')
-        response.headers.add('Access-Control-Allow-Methods',
-                             'GET,PATCH,POST,DELETE,OPTIONS')
+        for name, value in CORS_HEADERS:
+            response.headers.add(name, value)
         return response
 
-    def paginate_results(requests, selection):
-        page = requests.args.get('page', 1, type=int)
+    '''
+    read replicas
+        GET requests read from a replica (models.use_replica) unless their
+        token wrote through this process in the last REPLICA_STICKY_SECONDS
+    '''
+    @app.before_request
+    def route_reads():
+        if request.method in ('GET', 'HEAD') and not sticky_clients.is_sticky(request_subject()):
+            use_replica()
 
-        start = (page - 1) * PAGE_SIZE
-        end = start + PAGE_SIZE
+    @app.after_request
+    def remember_writes(response):
+        if request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400:
+            sticky_clients.mark(request_subject())
+        return response
+
+    '''
+    conditional requests and response cache
+        GET responses of the endpoints in CONDITIONAL_TABLES carry a weak
+        ETag, the same compressed or not, and a Last-Modified date built from the versions of the tables
+        they read. The token is checked for the view's permission (and
+        counted by the rate limiter) before the versions are read, then a
+        request whose If-None-Match (or If-Modified-Since) still matches is
+        answered with 304 before the view runs.
+        Otherwise the body is served from response_cache when it holds one
+        for the same ETag and permission set, and stored there after the view.
+    '''
+    @app.before_request
+    def serve_conditional_or_cached():
+        tables = CONDITIONAL_TABLES.get(request.endpoint)
+        if request.method != 'GET' or tables is None:
+            return None
+        if request.args.get('include'):
+            tables = ('actors', 'movies', 'ratings')
+
+        # no query for requests without a valid token
+        payload = authorize(app.view_functions[request.endpoint].permission)
+        g.etag, g.last_modified = conditional_state(
+            request.endpoint, request.view_args, request.args, get_versions(tables))
+
+        if not_modified(g.etag, g.last_modified, request.if_none_match, request.if_modified_since):
+            return app.response_class(status=304)
+
+        if not response_cache.enabled:
+            return None
+        g.cache_key = response_cache_key(request.endpoint, g.etag, payload)
+        g.cache_tables = tables
+
+        cached = response_cache.get(g.cache_key)
+        if cached is None:
+            return None
+        response = app.response_class(cached, mimetype='application/json')
+        response.headers['X-Cache'] = 'HIT'
+        return response
 
-        objects_formatted = [object_name.format() for object_name in selection]
-        return objects_formatted[start:end]
+    @app.after_request
+    def store_cached_response(response):
+        cache_key = g.get('cache_key')
+        if cache_key is None or 'X-Cache' in response.headers:
+            return response
+        if response.status_code == 200 and not response.direct_passthrough:
+            response_cache.set(cache_key, response.get_data(), g.cache_tables)
+            response.headers['X-Cache'] = 'MISS'
+        return response
+
+    @app.after_request
+    def set_conditional_headers(response):
+        etag = g.get('etag')
+        if etag is None or response.status_code not in (200, 304):
+            return response
+        response.set_etag(etag, weak=True)
+        if g.last_modified is not None:
+            response.last_modified = g.last_modified
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+    '''
+    parse_include(requests, relations)
+        reads ?include=a,b and returns the requested relation names
+        relations maps each name the endpoint accepts to its relationship
+        attribute, unknown names are a bad request
+    '''
+    def parse_include(requests, relations):
+        include = [name for name in requests.args.get('include', '').split(',') if name]
+        if any(name not in relations for name in include):
+            abort(400)
+        return include
+
+    '''
+    include_relations(query, relations, include)
+        batches the requested relations with one extra SELECT ... IN per relation
+    '''
+    def include_relations(query, relations, include):
+        for name in include:
+            query = query.options(selectinload(relations[name]))
+        return query
+
+    '''
+    paginate_results(requests, query, model, include, filters, sort_fields, columns)
+        pushes filters, sort order and page into SQL (queries.paginate)
+        pages without include only load columns, as row tuples, and only the
+        ones ?fields= asks for (queries.select_fields)
+        with include the objects are loaded whole and ?fields= trims their
+        formatted fields, the relations stay
+        returns the formatted page and the cursor of the next page, if any
+    '''
+    def paginate_results(requests, query, model, include, filters, sort_fields, columns):
+        query, limit, keyset = paginate(requests.args, query, model, filters, sort_fields)
+        columns = select_fields(requests.args, columns)
+        if not include:
+            rows, next_cursor = split_page(query.with_entities(*columns).all(), limit, keyset)
+            return rows_to_dicts(columns, rows), next_cursor
+
+        objects, next_cursor = split_page(query.all(), limit, keyset)
+        names = {column.key for column in columns}.union(include)
+        return [{key: value for key, value in object_name.format(include).items() if key in names}
+                for object_name in objects], next_cursor
+
+    '''
+    validate(validator, body, partial=False)
+        runs a validator from validators.py and aborts with its status code
+    '''
+    def validate(validator, body, partial=False):
+        try:
+            return validator(body, partial)
+        except ValidationError as error:
+            abort(error.status_code)
+
+    '''
+    if_match_versions(requests)
+        the row versions an If-Match header accepts, None without the header
+        or with "*", weak or non-numeric tags match no version
+    '''
+    def if_match_versions(requests):
+        if_match = requests.if_match
+        if not if_match or if_match.star_tag:
+            return None
+        return [int(tag) for tag in if_match.as_set() if tag.isdigit()]
+
+    '''
+    update_row(requests, model, row_id, fields, columns)
+        writes fields with one conditional UPDATE (models.update_versioned)
+        and commits, 412 when If-Match names another version of the row,
+        404 when there is no such row
+    '''
+    def update_row(requests, model, row_id, fields, columns):
+        versions = if_match_versions(requests)
+        row = update_versioned(model, row_id, fields, columns, versions)
+        if row is None:
+            db.session.rollback()
+            if versions is not None and db.session.get(model, row_id) is not None:
+                abort(412)
+            abort(404)
+        db.session.commit()
+        return row
+
+    '''
+    get_bulk_items(requests, max_items=MAX_BULK_ITEMS)
+        the body of a bulk request is a JSON array of at most max_items items
+    '''
+    def get_bulk_items(requests, max_items=MAX_BULK_ITEMS):
+        items = requests.get_json()
+        if not items or not isinstance(items, list):
+            abort(400)
+        if len(items) > max_items:
+            abort(413)
+        return items
+
+    '''
+    prefers_async(requests)
+        whether a bulk request asks to run as a job with Prefer: respond-async
+    '''
+    def prefers_async(requests):
+        preferences = requests.headers.get('Prefer', '').split(',')
+        return 'respond-async' in [preference.strip() for preference in preferences]
+
+    '''
+    enqueue_response(requests, payload, kind, permission)
+        queues a bulk request of up to MAX_JOB_ITEMS items as a job (jobs.py)
+        and answers 202 at once, the job's progress is at GET /jobs/<id>
+    '''
+    def enqueue_response(requests, payload, kind, permission):
+        items = get_bulk_items(requests, MAX_JOB_ITEMS)
+        job_id = enqueue(kind, permission, payload.get('sub', ''), items)
+        response = jsonify({
+            'success': True,
+            'job_id': job_id
+        })
+        response.status_code = 202
+        response.headers['Location'] = f'/jobs/{job_id}'
+        response.headers['Preference-Applied'] = 'respond-async'
+        return response
+
+    '''
+    bulk_write(items, validator, write, partial=False)
+        validates every item, writes the valid ones with one call to write()
+        and returns one result per item, in request order
+        write receives the validated items and returns the ids it wrote
+    '''
+    def bulk_write(items, validator, write, partial=False):
+        results = [None] * len(items)
+        valid = []
+        for index, item in enumerate(items):
+            try:
+                fields = validator(item, partial)
+                if partial:
+                    item_id = item.get('id')
+                    if isinstance(item_id, bool) or not isinstance(item_id, int):
+                        raise ValidationError(422)
+                    fields['id'] = item_id
+                valid.append((index, fields))
+            except ValidationError as error:
+                results[index] = bulk_error(index, error.status_code)
+
+        written = write([fields for _, fields in valid])
+        for (index, fields), item_id in zip(valid, written):
+            if item_id is None:
+                results[index] = bulk_error(index, 404)
+            else:
+                results[index] = {'index': index, 'success': True, 'id': item_id}
+        return results
+
+    def bulk_error(index, status_code):
+        return {
+            'index': index,
+            'success': False,
+            'error': status_code,
+            'message': ERROR_MESSAGES[status_code]
+        }
+
+    '''
+    bulk_update_ids(model, commit=True)
+        returns a write() for bulk_write that reports unknown ids as None
+    '''
+    def bulk_update_ids(model, commit=True):
+        def write(mappings):
+            updated = bulk_update(model, mappings, commit)
+            return [mapping['id'] if mapping['id'] in updated else None
+                    for mapping in mappings]
+        return write
+
+    '''
+    bulk_delete_results(model, ids, commit=True)
+        deletes the integer ids in one transaction, one result per requested id
+    '''
+    def bulk_delete_results(model, ids, commit=True):
+        valid = [isinstance(item_id, int) and not isinstance(item_id, bool)
+                 for item_id in ids]
+        deleted = bulk_delete(model, [item_id for item_id, is_valid in zip(ids, valid) if is_valid],
+                              commit)
+
+        results = []
+        for index, item_id in enumerate(ids):
+            if not valid[index]:
+                results.append(bulk_error(index, 422))
+            elif item_id not in deleted:
+                results.append(bulk_error(index, 404))
+            else:
+                results.append({'index': index, 'success': True, 'id': item_id})
+        return results
+
+    '''
+    register_bulk_jobs(model, validator)
+        the bulk writes queued jobs run, the job runner commits each chunk
+    '''
+    def register_bulk_jobs(model, validator):
+        name = model.__tablename__
+        register_job(name + '.insert', lambda items: bulk_write(
+            items, validator, lambda mappings: bulk_insert(model, mappings, commit=False)))
+        register_job(name + '.update', lambda items: bulk_write(
+            items, validator, bulk_update_ids(model, commit=False), partial=True))
+        register_job(name + '.delete', lambda items: bulk_delete_results(model, items, commit=False))
+
+    register_bulk_jobs(Actor, validate_actor)
+    register_bulk_jobs(Movie, validate_movie)
+
+    '''
+    rating_aggregates(requests, model, rating_column, columns)
+        average rating and number of ratings per row of model, best first
+    '''
+    def rating_aggregates(requests, model, rating_column, columns):
+        query = rating_aggregates_query(requests.args, model, rating_column, columns)
+        return [row._asdict() for row in db.session.execute(query)]
+
+    '''
+    export_response(requests, model, columns, name)
+        streams every row of model, ordered by id, as NDJSON (default) or CSV
+        ?fields= narrows the columns as on the list endpoints
+        the format comes from ?format= or from an Accept: text/csv header
+        rows come from the request's read engine, a replica unless the token
+        wrote recently. 503 once this process streams EXPORT_MAX_CONCURRENT
+        exports, a slot is freed when its stream ends or its response closes
+    '''
+    def export_response(requests, model, columns, name):
+        fmt = requests.args.get('format')
+        if fmt is None:
+            fmt = 'csv' if requests.accept_mimetypes.best == 'text/csv' else 'ndjson'
+        if fmt not in EXPORT_MIMETYPES:
+            abort(400)
+
+        query = select(*select_fields(requests.args, columns)).order_by(model.id)
+        release = acquire_export_slot()
+        if release is None:
+            raise ServiceUnavailable(retry_after=EXPORT_RETRY_AFTER)
+        response = Response(stream_with_context(stream_export(read_engine(), query, fmt, release=release)),
+                            mimetype=EXPORT_MIMETYPES[fmt])
+        # a stream that is never read is closed without running its finally
+        response.call_on_close(release)
+        response.headers['Content-Disposition'] = f'attachment; filename={name}.{fmt}'
+        return response
+
+    '''
+    detail_response(requests, model, row_id, name, relations, relation_query, relation_columns)
+        one row by primary key
+        ?include= adds its cast (or filmography) with the ratings from one query
+        without include the row version is the ETag, the one PATCH accepts in If-Match
+    '''
+    def detail_response(requests, model, row_id, name, relations, relation_query, relation_columns):
+        include = parse_include(requests, relations)
+        # primary key lookups are cheap, and the version handed out for
+        # If-Match must not lag behind the primary
+        use_primary()
+        row = db.session.get(model, row_id)
+        if row is None:
+            abort(404)
+        version = row.version
+
+        if not include and requests.if_none_match.contains(str(version)):
+            response = app.response_class(status=304)
+            response.set_etag(str(version))
+            return response
+
+        formatted = row.format()
+        for relation in include:
+            formatted[relation] = rows_to_dicts(
+                relation_columns, db.session.execute(relation_query(row_id)).all())
+        response = json_response({
+            'success': True,
+            name: formatted
+        })
+        if not include:
+            response.set_etag(str(version))
+        return response
+
+    def bulk_response(results, key):
+        return jsonify({
+            'success': True,
+            key: sum(1 for result in results if result['success']),
+            'results': results
+        })
 
     @app.route('/actors', methods=['GET'])
     @requires_auth('get:actors')
     def get_actors(jwt):
-        actors = Actor.query.all()
-        actors_paginated = paginate_results(request, actors)
+        relations = {'movies': Actor.ratings}
+        include = parse_include(request, relations)
+        query = include_relations(Actor.query, relations, include)
+        actors_paginated, next_cursor = paginate_results(
+            request, query, Actor, include, ACTOR_FILTERS, ACTOR_SORT, ACTOR_COLUMNS)
 
         if len(actors_paginated) == 0:
             abort(404)
 
-        return jsonify({
+        return json_response({
             'success': True,
-            'actors': actors_paginated
+            'actors': actors_paginated,
+            'next_cursor': next_cursor
         })
 
+    @app.route('/actors/<int:actor_id>', methods=['GET'])
+    @requires_auth('get:actors')
+    def get_actor(jwt, actor_id):
+        return detail_response(request, Actor, actor_id, 'actor', {'movies': Actor.ratings},
+                               actor_movies_query, ACTOR_MOVIE_COLUMNS)
+
+    @app.route('/actors/export', methods=['GET'])
+    @requires_auth('get:actors')
+    def export_actors(jwt):
+        return export_response(request, Actor, ACTOR_COLUMNS, 'actors')
+
     @app.route('/actors', methods=['POST'])
     @requires_auth('post:actors')
+    @idempotent
     def insert_actors(jwt):
-        body = request.get_json()
-        if not body:
-            abort(400)
-
-        name = body.get('name')
-        age = body.get('age')
-        gender = body.get('gender')
-
-        if not (name and age and gender):
-            abort(422)
+        fields = validate(validate_actor, request.get_json())
 
         actor = (Actor(
-            name=name,
-            age=age,
-            gender=gender
+            name=fields['name'],
+            age=fields['age'],
+            gender=fields['gender']
         ))
-        actor.insert()
+        # @idempotent commits the row with the stored response
+        actor.insert(commit=False)
 
         return jsonify({
             'success': True,
@@ -79,30 +537,16 @@ def create_app(test_config=None):
     def edit_actors(payload, actor_id):
         if not actor_id:
             abort(400)
-        body = request.get_json()
-        if not body:
-            abort(400)
-
-        actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
-        if not actor:
-            abort(404)
-
-        name = body.get('name', actor.name)
-        age = body.get('age', actor.age)
-        gender = body.get('gender', actor.gender)
+        fields = validate(validate_actor, request.get_json(), partial=True)
+        actor = update_row(request, Actor, actor_id, fields, ACTOR_COLUMNS)
 
-        # Set new field values
-        actor.name = name
-        actor.age = age
-        actor.gender = gender
-
-        actor.update()
-
-        return jsonify({
+        response = jsonify({
             'success': True,
             'updated': actor.id,
-            'actor': [actor.format()]
+            'actor': rows_to_dicts(ACTOR_COLUMNS, [actor])
         })
+        response.set_etag(str(actor.version))
+        return response
 
     @app.route('/actors/<actor_id>', methods=['DELETE'])
     @requires_auth('delete:actors')
@@ -110,51 +554,82 @@ def create_app(test_config=None):
         if not actor_id:
             abort(400)
 
-        # Find actor which should be deleted by id
-        actor_to_delete = Actor.query.filter(
-            Actor.id == actor_id).one_or_none()
-        if not actor_to_delete:
+        if delete_row(Actor, actor_id) is None:
             abort(404)
 
-        actor_to_delete.delete()
-
         return jsonify({
             'success': True,
             'deleted': actor_id
         })
 
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('post:actors')
+    def insert_actors_bulk(jwt):
+        if prefers_async(request):
+            return enqueue_response(request, jwt, 'actors.insert', 'post:actors')
+        items = get_bulk_items(request)
+        results = bulk_write(items, validate_actor,
+                             lambda mappings: bulk_insert(Actor, mappings))
+        return bulk_response(results, 'created')
+
+    @app.route('/actors/bulk', methods=['PATCH'])
+    @requires_auth('edit:actors')
+    def edit_actors_bulk(jwt):
+        if prefers_async(request):
+            return enqueue_response(request, jwt, 'actors.update', 'edit:actors')
+        items = get_bulk_items(request)
+        results = bulk_write(items, validate_actor, bulk_update_ids(Actor),
+                             partial=True)
+        return bulk_response(results, 'updated')
+
+    @app.route('/actors/bulk', methods=['DELETE'])
+    @requires_auth('delete:actors')
+    def delete_actors_bulk(jwt):
+        if prefers_async(request):
+            return enqueue_response(request, jwt, 'actors.delete', 'delete:actors')
+        results = bulk_delete_results(Actor, get_bulk_items(request))
+        return bulk_response(results, 'deleted')
+
     @app.route('/movies', methods=['GET'])
     @requires_auth('get:movies')
     def get_movies(jwt):
-        selection = Movie.query.all()
-        movies_paginated = paginate_results(request, selection)
+        relations = {'actors': Movie.actors}
+        include = parse_include(request, relations)
+        query = include_relations(Movie.query, relations, include)
+        movies_paginated, next_cursor = paginate_results(
+            request, query, Movie, include, MOVIE_FILTERS, MOVIE_SORT, MOVIE_COLUMNS)
 
         if len(movies_paginated) == 0:
             abort(404)
 
-        return jsonify({
+        return json_response({
             'success': True,
-            'movies': movies_paginated
+            'movies': movies_paginated,
+            'next_cursor': next_cursor
         })
 
+    @app.route('/movies/<int:movie_id>', methods=['GET'])
+    @requires_auth('get:movies')
+    def get_movie(jwt, movie_id):
+        return detail_response(request, Movie, movie_id, 'movie', {'actors': Movie.actors},
+                               movie_actors_query, MOVIE_ACTOR_COLUMNS)
+
+    @app.route('/movies/export', methods=['GET'])
+    @requires_auth('get:movies')
+    def export_movies(jwt):
+        return export_response(request, Movie, MOVIE_COLUMNS, 'movies')
+
     @app.route('/movies', methods=['POST'])
     @requires_auth('post:movies')
+    @idempotent
     def insert_movies(jwt):
-        body = request.get_json()
-        if not body:
-            abort(400)
-
-        title = body.get('title', None)
-        release_date = body.get('release_date', None)
-
-        if not (title and release_date):
-            abort(422)
+        fields = validate(validate_movie, request.get_json())
 
         new_movie = (Movie(
-            title=title,
-            release_date=release_date
+            title=fields['title'],
+            release_date=fields['release_date']
         ))
-        new_movie.insert()
+        new_movie.insert(commit=False)
 
         return jsonify({
             'success': True,
@@ -164,51 +639,159 @@ def create_app(test_config=None):
     @app.route('/movies/<movie_id>', methods=['PATCH'])
     @requires_auth('edit:movies')
     def edit_movies(jwt, movie_id):
-        body = request.get_json()
-
         if not movie_id:
             abort(400)
 
-        if not body:
+        fields = validate(validate_movie, request.get_json(), partial=True)
+        movie = update_row(request, Movie, movie_id, fields, MOVIE_COLUMNS)
+
+        response = jsonify({
+            'success': True,
+            'edited': movie.id,
+            'movie': rows_to_dicts(MOVIE_COLUMNS, [movie])
+        })
+        response.set_etag(str(movie.version))
+        return response
+
+    @app.route('/movies/<movie_id>', methods=['DELETE'])
+    @requires_auth('delete:movies')
+    def delete_movies(jwt, movie_id):
+        if not movie_id:
             abort(400)
 
-        movie_to_update = Movie.query.filter(
-            Movie.id == movie_id).one_or_none()
+        if delete_row(Movie, movie_id) is None:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'deleted': movie_id
+        })
 
-        if not movie_to_update:
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('post:movies')
+    def insert_movies_bulk(jwt):
+        if prefers_async(request):
+            return enqueue_response(request, jwt, 'movies.insert', 'post:movies')
+        items = get_bulk_items(request)
+        results = bulk_write(items, validate_movie,
+                             lambda mappings: bulk_insert(Movie, mappings))
+        return bulk_response(results, 'created')
+
+    @app.route('/movies/bulk', methods=['PATCH'])
+    @requires_auth('edit:movies')
+    def edit_movies_bulk(jwt):
+        if prefers_async(request):
+            return enqueue_response(request, jwt, 'movies.update', 'edit:movies')
+        items = get_bulk_items(request)
+        results = bulk_write(items, validate_movie, bulk_update_ids(Movie),
+                             partial=True)
+        return bulk_response(results, 'updated')
+
+    @app.route('/movies/bulk', methods=['DELETE'])
+    @requires_auth('delete:movies')
+    def delete_movies_bulk(jwt):
+        if prefers_async(request):
+            return enqueue_response(request, jwt, 'movies.delete', 'delete:movies')
+        results = bulk_delete_results(Movie, get_bulk_items(request))
+        return bulk_response(results, 'deleted')
+
+    '''
+    get_job(job_id)
+        progress of a queued bulk request, for the token that queued it
+        the token needs the permission the bulk request was authorized with
+        the token is verified before the job is looked up, without one every
+        id answers 401 alike
+    '''
+    @app.route('/jobs/<int:job_id>', methods=['GET'])
+    def get_job(job_id):
+        payload = authenticate()
+        job = db.session.get(Job, job_id)
+        if job is None:
+            abort(404)
+        check_permissions(job.permission, payload)
+        if job.owner != payload.get('sub', ''):
             abort(404)
 
-        title = body.get('title', movie_to_update.title)
-        release_date = body.get('release_date', movie_to_update.release_date)
+        return jsonify({
+            'success': True,
+            'job': job.format()
+        })
 
-        movie_to_update.title = title
-        movie_to_update.release_date = release_date
+    @app.route('/actors/<int:actor_id>/movies', methods=['GET'])
+    @requires_auth('get:actors')
+    def get_actor_movies(jwt, actor_id):
+        movies = db.session.execute(actor_movies_query(actor_id)).all()
+        if not movies and db.session.get(Actor, actor_id) is None:
+            abort(404)
 
-        movie_to_update.update()
+        return json_response({
+            'success': True,
+            'actor': actor_id,
+            'movies': rows_to_dicts(ACTOR_MOVIE_COLUMNS, movies)
+        })
 
-        return jsonify({
+    @app.route('/actors/ratings', methods=['GET'])
+    @requires_auth('get:actors')
+    def get_actor_ratings(jwt):
+        return json_response({
             'success': True,
-            'edited': movie_to_update.id,
-            'movie': [movie_to_update.format()]
+            'actors': rating_aggregates(request, Actor, Rating.c.Actor_id,
+                                        ACTOR_RATING_COLUMNS)
         })
 
-    @app.route('/movies/<movie_id>', methods=['DELETE'])
-    @requires_auth('delete:movies')
-    def delete_movies(jwt, movie_id):
-        if not movie_id:
-            abort(400)
+    @app.route('/movies/<int:movie_id>/actors', methods=['GET'])
+    @requires_auth('get:movies')
+    def get_movie_actors(jwt, movie_id):
+        actors = db.session.execute(movie_actors_query(movie_id)).all()
+        if not actors and db.session.get(Movie, movie_id) is None:
+            abort(404)
+
+        return json_response({
+            'success': True,
+            'movie': movie_id,
+            'actors': rows_to_dicts(MOVIE_ACTOR_COLUMNS, actors)
+        })
+
+    @app.route('/movies/top', methods=['GET'])
+    @requires_auth('get:movies')
+    def get_top_movies(jwt):
+        return json_response({
+            'success': True,
+            'movies': rating_aggregates(request, Movie, Rating.c.Movie_id,
+                                        MOVIE_RATING_COLUMNS)
+        })
 
-        movie_to_delete = Movie.query.filter(
-            Movie.id == movie_id).one_or_none()
+    @app.route('/movies/<int:movie_id>/actors/<int:actor_id>', methods=['PUT'])
+    @requires_auth('edit:movies')
+    def cast_movie_actor(jwt, movie_id, actor_id):
+        # a link can be cast without a body, a malformed one is a bad request
+        body = request.get_json() if request.get_data() else None
+        fields = validate(validate_rating, body)
 
-        if not movie_to_delete:
+        if db.session.get(Movie, movie_id) is None or \
+                db.session.get(Actor, actor_id) is None:
             abort(404)
 
-        movie_to_delete.delete()
+        created = cast_actor(movie_id, actor_id, fields['rating'])
 
         return jsonify({
             'success': True,
-            'deleted': movie_id
+            'created': created,
+            'movie': movie_id,
+            'actor': actor_id,
+            'rating': fields['rating']
+        })
+
+    @app.route('/movies/<int:movie_id>/actors/<int:actor_id>', methods=['DELETE'])
+    @requires_auth('edit:movies')
+    def uncast_movie_actor(jwt, movie_id, actor_id):
+        if not uncast_actor(movie_id, actor_id):
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'movie': movie_id,
+            'deleted': actor_id
         })
 
     @app.errorhandler(422)
@@ -235,18 +818,83 @@ def create_app(test_config=None):
             "message": "resource not found"
         }), 404
 
+    @app.errorhandler(409)
+    def conflict(error):
+        return jsonify({
+            "success": False,
+            "error": 409,
+            "message": "conflict"
+        }), 409
+
+    @app.errorhandler(412)
+    def precondition_failed(error):
+        return jsonify({
+            "success": False,
+            "error": 412,
+            "message": "precondition failed"
+        }), 412
+
+    @app.errorhandler(413)
+    def payload_too_large(error):
+        return jsonify({
+            "success": False,
+            "error": 413,
+            "message": "payload too large"
+        }), 413
+
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        response = jsonify({
+            "success": False,
+            "error": 503,
+            "message": "service unavailable"
+        })
+        if getattr(error, 'retry_after', None) is not None:
+            response.headers['Retry-After'] = str(error.retry_after)
+        return response, 503
+
+    @app.errorhandler(ValidationError)
+    def validation_error(error):
+        return jsonify({
+            "success": False,
+            "error": error.status_code,
+            "message": ERROR_MESSAGES[error.status_code]
+        }), error.status_code
+
     @app.errorhandler(AuthError)
     def auth_error(AuthError):
-        return jsonify({
+        response = jsonify({
             "success": False,
             "error": AuthError.status_code,
             "message": AuthError.error['description']
-        }), AuthError.status_code
+        })
+        if isinstance(AuthError, RateLimitError):
+            response.headers['Retry-After'] = str(AuthError.retry_after)
+        return response, AuthError.status_code
 
     return app
 
 
-app = create_app()
+'''
+app
+    the application, created on first access rather than at import:
+    `gunicorn app:app`, `flask run` and asgi.py get one shared instance,
+    while importing the module for create_app or its helpers (tests,
+    jobs.py, bench.py) builds nothing
+'''
+_app = None
+_app_lock = threading.Lock()
+
+
+def __getattr__(name):
+    global _app
+    if name != 'app':
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    with _app_lock:
+        if _app is None:
+            _app = create_app()
+    return _app
+
 
 if __name__ == '__main__':
-    app.run()
+    create_app().run()
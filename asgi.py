@@ -0,0 +1,613 @@
+import asyncio
+import io
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import HTTPException, abort
+from werkzeug.http import http_date, parse_date, parse_etags
+from werkzeug.urls import url_decode
+import app as app_module
+import auth
+from auth import AuthError, JWKS_TTL, JWKS_MIN_REFETCH_INTERVAL, JWKS_TIMEOUT, \
+    check_permissions, decode_jwt, limit_rate, parse_jwks, token_from_header, token_key_id, \
+    token_subject
+from compression import compress, compressible, negotiate_encoding
+from metrics import METRICS_ENABLED, PHASES, phase_durations, request_duration, request_statements
+from models import get_engine_options, sticky_clients, versions_query, Actor, Movie, Rating
+from queries import ACTOR_COLUMNS, MOVIE_COLUMNS, ACTOR_FILTERS, MOVIE_FILTERS, ACTOR_SORT, \
+    MOVIE_SORT, ACTOR_MOVIE_COLUMNS, MOVIE_ACTOR_COLUMNS, ACTOR_RATING_COLUMNS, \
+    MOVIE_RATING_COLUMNS, paginate, select_fields, split_page, actor_movies_query, \
+    movie_actors_query, rating_aggregates_query
+from serializers import dumps, rows_to_dicts
+from validators import ValidationError
+
+'''
+ASGI entry point: uvicorn asgi:app
+
+    the read endpoints of app.CONDITIONAL_TABLES are served by coroutines:
+    tokens are checked with the same auth.py functions, signing keys are
+    fetched with an async HTTP client, rows are read through an async
+    SQLAlchemy engine (asyncpg, aiosqlite for sqlite) and encoded by
+    serializers.py, with the ETags, 304s and response cache of app.py.
+    A worker waiting on Auth0 or on the database holds no thread.
+
+    every other request (writes, bulk, exports, ?include=, profiled
+    requests, /metrics, /profiles) runs in the Flask app on a pool of
+    ASGI_WSGI_THREADS threads, so routes and RBAC stay defined in one place.
+'''
+
+ASGI_WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', 32))
+
+# chunks of a streamed WSGI response buffered ahead of a slow client
+WSGI_QUEUE_SIZE = 16
+
+
+'''
+async_database_url(database_path)
+    the async driver URL of a database URL of models.py
+'''
+def async_database_url(database_path):
+    if database_path.startswith('postgresql://'):
+        return database_path.replace('postgresql://', 'postgresql+asyncpg://', 1)
+    if database_path.startswith('sqlite://'):
+        return database_path.replace('sqlite://', 'sqlite+aiosqlite://', 1)
+    return database_path
+
+
+'''
+get_async_engine_options(database_path)
+    the pool settings of get_engine_options for the async engine
+    asyncpg takes the statement timeout as a server setting
+'''
+def get_async_engine_options(database_path):
+    options = dict(get_engine_options(database_path))
+    options.pop('poolclass', None)
+    connect_args = options.pop('connect_args', {})
+    if 'options' in connect_args:
+        timeout = connect_args['options'].split('statement_timeout=', 1)[1]
+        options['connect_args'] = {'server_settings': {'statement_timeout': timeout}}
+    return options
+
+
+## Async JWKS key store
+'''
+AsyncJWKSKeyStore
+    auth.JWKSKeyStore for the event loop: same ttl, refetch interval and
+    single flight, the keys are fetched with httpx and refreshed by a task
+'''
+class AsyncJWKSKeyStore:
+    def __init__(self, url, ttl=JWKS_TTL,
+                 min_refetch_interval=JWKS_MIN_REFETCH_INTERVAL,
+                 timeout=JWKS_TIMEOUT):
+        self.url = url
+        self.ttl = ttl
+        self.min_refetch_interval = min_refetch_interval
+        self.timeout = timeout
+        self.fetch_count = 0
+        self._keys = {}
+        self._fetched_at = None
+        self._loop = None
+        self._fetch_lock = None
+        self._refresher = None
+
+    async def fetch(self):
+        async with httpx.AsyncClient(timeout=self.timeout) as client:
+            response = await client.get(self.url)
+            response.raise_for_status()
+        return parse_jwks(response.json())
+
+    async def refresh(self, min_age=0):
+        # single flight: coroutines queue on the lock and skip the fetch
+        # if another one refreshed the keys while they were waiting
+        seen = self._fetched_at
+        async with self._lock():
+            if self._fetched_at != seen:
+                return False
+            if seen is not None and time.monotonic() - seen < min_age:
+                return False
+            try:
+                keys = await self.fetch()
+            except Exception:
+                if self._fetched_at is not None:
+                    # keep serving the keys we already have
+                    return False
+                raise AuthError({
+                    'code': 'jwks_unavailable',
+                    'description': 'Unable to fetch signing keys.'
+                }, 503)
+            self.fetch_count += 1
+            self._keys = keys
+            self._fetched_at = time.monotonic()
+            return True
+
+    async def get_key(self, kid):
+        if self._fetched_at is None:
+            await self.refresh(min_age=self.ttl)
+        self._ensure_refresher()
+
+        key = self._keys.get(kid)
+        if key is None:
+            # unknown kid, the signing keys may have been rotated
+            await self.refresh(min_age=self.min_refetch_interval)
+            key = self._keys.get(kid)
+        return key
+
+    def stop(self):
+        if self._refresher is not None:
+            self._refresher.cancel()
+            self._refresher = None
+
+    def _lock(self):
+        # locks and tasks belong to one event loop
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._fetch_lock = asyncio.Lock()
+            self._refresher = None
+        return self._fetch_lock
+
+    def _ensure_refresher(self):
+        self._lock()
+        if self._refresher is None:
+            self._refresher = asyncio.get_running_loop().create_task(self._refresh_periodically())
+
+    async def _refresh_periodically(self):
+        while True:
+            await asyncio.sleep(self.ttl)
+            try:
+                await self.refresh(min_age=self.ttl / 2)
+            except AuthError:
+                pass
+
+
+'''
+AsyncRequest
+    the parts of an ASGI request the handlers read, args is a werkzeug
+    MultiDict like Flask's request.args
+    statements run through execute() are counted in the request's phases
+'''
+class AsyncRequest:
+    def __init__(self, scope):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.args = url_decode(scope.get('query_string', b''))
+        self.headers = Headers([(name.decode('latin-1'), value.decode('latin-1'))
+                                for name, value in scope['headers']])
+        self.phases = dict.fromkeys(PHASES + ('statements',), 0)
+        self.connection = None
+
+    async def execute(self, statement):
+        start = time.perf_counter()
+        try:
+            return (await self.connection.execute(statement)).all()
+        finally:
+            self.phases['sql'] += time.perf_counter() - start
+            self.phases['statements'] += 1
+
+
+## Async read handlers
+'''
+the coroutines behind the views of the same endpoint in app.py
+    each returns the payload the view passes to json_response
+'''
+async def list_page(request, model, filters, sort_fields, columns, key):
+    columns = select_fields(request.args, columns)
+    query, limit, keyset = paginate(request.args, select(*columns), model, filters, sort_fields)
+    rows, next_cursor = split_page(await request.execute(query), limit, keyset)
+    if len(rows) == 0:
+        abort(404)
+    return {'success': True, key: rows_to_dicts(columns, rows), 'next_cursor': next_cursor}
+
+
+async def get_actors(request):
+    return await list_page(request, Actor, ACTOR_FILTERS, ACTOR_SORT, ACTOR_COLUMNS, 'actors')
+
+
+async def get_movies(request):
+    return await list_page(request, Movie, MOVIE_FILTERS, MOVIE_SORT, MOVIE_COLUMNS, 'movies')
+
+
+async def get_actor_movies(request, actor_id):
+    movies = await request.execute(actor_movies_query(actor_id))
+    if not movies and not await request.execute(select(Actor.id).where(Actor.id == actor_id)):
+        abort(404)
+    return {
+        'success': True,
+        'actor': actor_id,
+        'movies': rows_to_dicts(ACTOR_MOVIE_COLUMNS, movies)
+    }
+
+
+async def get_movie_actors(request, movie_id):
+    actors = await request.execute(movie_actors_query(movie_id))
+    if not actors and not await request.execute(select(Movie.id).where(Movie.id == movie_id)):
+        abort(404)
+    return {
+        'success': True,
+        'movie': movie_id,
+        'actors': rows_to_dicts(MOVIE_ACTOR_COLUMNS, actors)
+    }
+
+
+async def get_actor_ratings(request):
+    query = rating_aggregates_query(request.args, Actor, Rating.c.Actor_id, ACTOR_RATING_COLUMNS)
+    return {'success': True, 'actors': [row._asdict() for row in await request.execute(query)]}
+
+
+async def get_top_movies(request):
+    query = rating_aggregates_query(request.args, Movie, Rating.c.Movie_id, MOVIE_RATING_COLUMNS)
+    return {'success': True, 'movies': [row._asdict() for row in await request.execute(query)]}
+
+
+ASYNC_HANDLERS = {
+    'get_actors': get_actors,
+    'get_movies': get_movies,
+    'get_actor_movies': get_actor_movies,
+    'get_movie_actors': get_movie_actors,
+    'get_actor_ratings': get_actor_ratings,
+    'get_top_movies': get_top_movies
+}
+
+
+## WSGI fallback
+'''
+wsgi_environ(scope, body)
+    the PEP 3333 environ of an ASGI http request
+'''
+def wsgi_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_LENGTH':
+            continue
+        key = name if name == 'CONTENT_TYPE' else 'HTTP_' + name
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+
+'''
+WSGIFallback(wsgi_app, executor)
+    runs a WSGI app for ASGI requests
+    each request runs on one executor thread from start to end (Flask keeps
+    its request and session state per thread) and hands the chunks of its
+    response to the event loop through a bounded queue
+'''
+class WSGIFallback:
+    def __init__(self, wsgi_app, executor):
+        self.wsgi_app = wsgi_app
+        self.executor = executor
+
+    async def __call__(self, scope, receive, send):
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(WSGI_QUEUE_SIZE)
+        abandoned = threading.Event()
+        started = {}
+
+        def put(item):
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = headers
+
+        def run():
+            try:
+                result = self.wsgi_app(wsgi_environ(scope, body), start_response)
+                try:
+                    for chunk in result:
+                        if abandoned.is_set():
+                            break
+                        if chunk:
+                            put(chunk)
+                finally:
+                    if hasattr(result, 'close'):
+                        result.close()
+            except BaseException as error:
+                put(error)
+            finally:
+                put(None)
+
+        worker = loop.run_in_executor(self.executor, run)
+        try:
+            item = await queue.get()
+            if isinstance(item, BaseException):
+                raise item
+            await send({
+                'type': 'http.response.start',
+                'status': started['status'],
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                            for name, value in started['headers']]
+            })
+            while item is not None:
+                if isinstance(item, BaseException):
+                    raise item
+                await send({'type': 'http.response.body', 'body': item, 'more_body': True})
+                item = await queue.get()
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if not worker.done():
+                # the client went away: free the worker blocked on a full queue
+                abandoned.set()
+                while not queue.empty():
+                    queue.get_nowait()
+
+
+## ASGI application
+'''
+AsyncAgencyApp(flask_app, jwks_store=None)
+    the ASGI application around a Flask app from app.create_app()
+    the async engine is created on first use from the Flask app's
+    SQLALCHEMY_DATABASE_URI and disposed on lifespan shutdown
+'''
+class AsyncAgencyApp:
+    def __init__(self, flask_app, jwks_store=None, threads=ASGI_WSGI_THREADS):
+        self.flask_app = flask_app
+        self.jwks_store = jwks_store or AsyncJWKSKeyStore(auth.JWKS_URL)
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='wsgi')
+        self.fallback = WSGIFallback(flask_app.wsgi_app, self.executor)
+        self.engine = None
+        self.replica_engines = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return None
+
+        route = self.match(scope)
+        if route is None:
+            return await self.fallback(scope, receive, send)
+        status, headers, body = await self.serve(AsyncRequest(scope), *route)
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                        for name, value in headers]
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def close(self):
+        self.jwks_store.stop()
+        if self.engine is not None:
+            await self.engine.dispose()
+            self.engine = None
+        for engine in self.replica_engines or ():
+            await engine.dispose()
+        self.replica_engines = None
+        self.executor.shutdown(wait=False)
+
+    def get_engine(self):
+        if self.engine is None:
+            database_path = self.flask_app.config['SQLALCHEMY_DATABASE_URI']
+            self.engine = create_async_engine(async_database_url(database_path),
+                                              **get_async_engine_options(database_path))
+        return self.engine
+
+    '''
+    get_read_engine(payload)
+        an async engine of a read replica, the primary's without replicas or
+        while the token's subject is sticky after a write (models.sticky_clients)
+    '''
+    def get_read_engine(self, payload):
+        replica_paths = self.flask_app.config.get('SQLALCHEMY_REPLICA_URIS')
+        if not replica_paths or sticky_clients.is_sticky(token_subject(None, payload)):
+            return self.get_engine()
+        if self.replica_engines is None:
+            self.replica_engines = [create_async_engine(async_database_url(path),
+                                                        **get_async_engine_options(path))
+                                    for path in replica_paths]
+        return random.choice(self.replica_engines)
+
+    '''
+    match(scope)
+        (rule, endpoint, view_args) of a request the coroutines serve,
+        None for the requests left to the Flask app
+        routing goes through the Flask app's url_map, so both agree
+    '''
+    def match(self, scope):
+        if scope['method'] != 'GET':
+            return None
+        args = url_decode(scope.get('query_string', b''))
+        if args.get('include') or args.get('profile') in ('1', 'true'):
+            return None
+        for name, value in scope['headers']:
+            if name.lower() == b'x-profile' and value in (b'1', b'true'):
+                return None
+        try:
+            rule, view_args = self.flask_app.url_map.bind('localhost').match(
+                scope['path'], method='GET', return_rule=True)
+        except HTTPException:
+            return None
+        if rule.endpoint not in ASYNC_HANDLERS:
+            return None
+        return rule.rule, rule.endpoint, view_args
+
+    '''
+    authorize(request, permission)
+        auth.authorize for the event loop, the signing key comes from
+        the async key store
+    '''
+    async def authorize(self, request, permission):
+        start = time.perf_counter()
+        try:
+            token = token_from_header(request.headers.get('Authorization'))
+            payload = auth.token_cache.get(token)
+            if payload is None:
+                limit_rate(token, None, permission)
+                payload = decode_jwt(token, await self.jwks_store.get_key(token_key_id(token)))
+                auth.token_cache.set(token, payload)
+            limit_rate(token, payload, permission)
+            check_permissions(permission, payload)
+            return payload
+        finally:
+            request.phases['auth'] += time.perf_counter() - start
+
+    '''
+    serve(request, rule, endpoint, view_args)
+        the response of a read endpoint as (status, headers, body), with the
+        conditional and cache behaviour of app.serve_conditional_or_cached
+    '''
+    async def serve(self, request, rule, endpoint, view_args):
+        start = time.perf_counter()
+        try:
+            status, headers, body = await self.respond(request, endpoint, view_args)
+        except HTTPException as error:
+            status, headers, body = self.error(error.code, app_module.ERROR_MESSAGES[error.code])
+        except ValidationError as error:
+            status, headers, body = self.error(error.status_code,
+                                               app_module.ERROR_MESSAGES[error.status_code])
+        except AuthError as error:
+            status, headers, body = self.error(error.status_code, error.error['description'])
+            if hasattr(error, 'retry_after'):
+                headers.append(('Retry-After', str(error.retry_after)))
+
+        if status == 200:
+            body = self.compress(request, headers, body)
+        origin = request.headers.get('Origin')
+        headers.append(('Access-Control-Allow-Origin', origin or '*'))
+        if origin:
+            headers.append(('Vary', 'Origin'))
+        headers.extend(app_module.CORS_HEADERS)
+        headers.append(('Content-Length', str(len(body))))
+
+        if METRICS_ENABLED:
+            request_duration.observe(time.perf_counter() - start, request.method, rule, str(status))
+            for phase in PHASES:
+                phase_durations[phase].observe(request.phases[phase], request.method, rule)
+            request_statements.observe(request.phases['statements'], request.method, rule)
+        return status, headers, body
+
+    async def respond(self, request, endpoint, view_args):
+        permission = self.flask_app.view_functions[endpoint].permission
+        payload = await self.authorize(request, permission)
+        tables = app_module.CONDITIONAL_TABLES[endpoint]
+        response_cache = app_module.response_cache
+
+        async with self.get_read_engine(payload).connect() as connection:
+            request.connection = connection
+            versions = {row.name: (row.version, row.updated_at)
+                        for row in await request.execute(versions_query(tables))}
+            etag, last_modified = app_module.conditional_state(
+                endpoint, view_args, request.args, versions)
+
+            headers = [('ETag', f'W/"{etag}"'), ('Cache-Control', 'private, no-cache')]
+            if last_modified is not None:
+                headers.append(('Last-Modified', http_date(last_modified)))
+            if app_module.not_modified(etag, last_modified,
+                                       parse_etags(request.headers.get('If-None-Match')),
+                                       parse_date(request.headers.get('If-Modified-Since'))):
+                return 304, headers, b''
+
+            cache_key = None
+            if response_cache.enabled:
+                cache_key = app_module.response_cache_key(endpoint, etag, payload)
+                cached = response_cache.get(cache_key)
+                if cached is not None:
+                    return 200, self.json_headers(headers, 'HIT'), cached
+
+            result = await ASYNC_HANDLERS[endpoint](request, **view_args)
+
+        start = time.perf_counter()
+        body = dumps(result)
+        request.phases['serialize'] += time.perf_counter() - start
+        if cache_key is None:
+            return 200, self.json_headers(headers), body
+        response_cache.set(cache_key, body, tables)
+        return 200, self.json_headers(headers, 'MISS'), body
+
+    '''
+    compress(request, headers, body)
+        the body gzip or brotli encoded as compression.setup_compression does
+        for the Flask app, headers are updated in place
+    '''
+    @staticmethod
+    def compress(request, headers, body):
+        if not compressible('application/json', len(body)) or \
+                any(name == 'ETag' and not value.startswith('W/') for name, value in headers):
+            return body
+        headers.append(('Vary', 'Accept-Encoding'))
+        encoding = negotiate_encoding(request.headers.get('Accept-Encoding'))
+        if encoding is None:
+            return body
+        start = time.perf_counter()
+        body = compress(body, encoding)
+        request.phases['serialize'] += time.perf_counter() - start
+        headers.append(('Content-Encoding', encoding))
+        return body
+
+    @staticmethod
+    def json_headers(headers, cache=None):
+        headers = [('Content-Type', 'application/json')] + headers
+        if cache is not None:
+            headers.append(('X-Cache', cache))
+        return headers
+
+    def error(self, status, message):
+        return status, [('Content-Type', 'application/json')], dumps({
+            'success': False,
+            'error': status,
+            'message': message
+        })
+
+
+def create_asgi_app(flask_app=None, jwks_store=None):
+    return AsyncAgencyApp(flask_app or app_module.app, jwks_store)
+
+
+# `uvicorn asgi:app` creates the application on first access, as app.py does
+_app = None
+_app_lock = threading.Lock()
+
+
+def __getattr__(name):
+    global _app
+    if name != 'app':
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    with _app_lock:
+        if _app is None:
+            _app = create_asgi_app()
+    return _app
@@ -1,9 +1,14 @@
+import hashlib
 import json
-from flask import request
+import threading
+import time
+from collections import OrderedDict
+from flask import g, request
 from functools import wraps
-from jose import jwt
 from urllib.request import urlopen
-from config import auth0_config
+from config import auth0_config, rate_limits
+from metrics import track
+from ratelimit import create_rate_limiter, retry_after
 import os
 
 
@@ -15,10 +20,31 @@ if 'ALGORITHMS' in os.environ:
     ALGORITHMS = os.environ['ALGORITHMS']
 else:
     ALGORITHMS = auth0_config['ALGORITHMS']
-if 'API_AUDIENCE' in os.environ['API_AUDIENCE']:
+if 'API_AUDIENCE' in os.environ:
     API_AUDIENCE = os.environ['API_AUDIENCE']
 else:
     API_AUDIENCE = auth0_config['API_AUDIENCE']
+if 'JWKS_URL' in os.environ:
+    JWKS_URL = os.environ['JWKS_URL']
+else:
+    JWKS_URL = f'https://{AUTH0_DOMAIN}/.well-known/jwks.json'
+JWKS_TTL = int(os.environ.get('JWKS_TTL', auth0_config['JWKS_TTL']))
+JWKS_MIN_REFETCH_INTERVAL = int(os.environ.get(
+    'JWKS_MIN_REFETCH_INTERVAL', auth0_config['JWKS_MIN_REFETCH_INTERVAL']))
+JWKS_TIMEOUT = int(os.environ.get('JWKS_TIMEOUT', auth0_config['JWKS_TIMEOUT']))
+if 'TOKEN_CACHE_ENABLED' in os.environ:
+    TOKEN_CACHE_ENABLED = os.environ['TOKEN_CACHE_ENABLED'].lower() in ('1', 'true', 'yes')
+else:
+    TOKEN_CACHE_ENABLED = auth0_config['TOKEN_CACHE_ENABLED']
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', auth0_config['TOKEN_CACHE_SIZE']))
+# 'memory' (per process), 'redis' (shared, needs RATE_LIMIT_URL) or 'none'
+RATE_LIMIT = os.environ.get('RATE_LIMIT', 'memory')
+RATE_LIMIT_URL = os.environ.get('RATE_LIMIT_URL')
+RATE_LIMITS = {permission: dict(limit) for permission, limit in rate_limits.items()}
+if 'RATE_LIMIT_RATE' in os.environ:
+    RATE_LIMITS['default']['rate'] = float(os.environ['RATE_LIMIT_RATE'])
+if 'RATE_LIMIT_BURST' in os.environ:
+    RATE_LIMITS['default']['burst'] = int(os.environ['RATE_LIMIT_BURST'])
 
 ## AuthError Exception
 '''
@@ -31,6 +57,260 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+'''
+RateLimitError
+    the token's bucket for the permission is empty, retry_after is in seconds
+'''
+class RateLimitError(AuthError):
+    def __init__(self, wait):
+        super().__init__({
+            'code': 'rate_limited',
+            'description': 'Too many requests.'
+        }, 429)
+        self.retry_after = retry_after(wait)
+
+
+## JWKS key store
+'''
+parse_jwks(jwks)
+    the RSA keys of a JWKS document, parsed and indexed by kid
+'''
+def parse_jwks(jwks):
+    # jose is imported where tokens are read, importing auth does not load it
+    from jose import jwk
+    keys = {}
+    for key in jwks['keys']:
+        if key.get('kty') != 'RSA' or 'kid' not in key:
+            continue
+        keys[key['kid']] = jwk.construct({
+            'kty': key['kty'],
+            'kid': key['kid'],
+            'use': key.get('use', 'sig'),
+            'n': key['n'],
+            'e': key['e']
+        }, algorithm='RS256')
+    return keys
+
+
+'''
+JWKSKeyStore
+    process-wide cache of the Auth0 signing keys, parsed once and indexed by kid
+
+    the key set is fetched on first use and refreshed by a background thread
+    every `ttl` seconds. A token signed with an unknown kid (key rotation)
+    triggers one refetch, at most once per `min_refetch_interval` seconds;
+    threads that miss at the same time wait for that fetch instead of
+    starting their own.
+'''
+class JWKSKeyStore:
+    def __init__(self, url, ttl=JWKS_TTL,
+                 min_refetch_interval=JWKS_MIN_REFETCH_INTERVAL,
+                 timeout=JWKS_TIMEOUT):
+        self.url = url
+        self.ttl = ttl
+        self.min_refetch_interval = min_refetch_interval
+        self.timeout = timeout
+        self.fetch_count = 0
+        self._keys = {}
+        self._fetched_at = None
+        self._fetch_lock = threading.Lock()
+        self._refresher = None
+        self._refresher_pid = None
+        self._stopped = threading.Event()
+
+    def fetch(self):
+        with urlopen(self.url, timeout=self.timeout) as jsonurl:
+            return parse_jwks(json.loads(jsonurl.read()))
+
+    def refresh(self, min_age=0):
+        # single flight: callers queue on the lock and skip the fetch
+        # if another thread refreshed the keys while they were waiting
+        seen = self._fetched_at
+        with self._fetch_lock:
+            if self._fetched_at != seen:
+                return False
+            if seen is not None and time.monotonic() - seen < min_age:
+                return False
+            try:
+                keys = self.fetch()
+            except Exception:
+                if self._fetched_at is not None:
+                    # keep serving the keys we already have
+                    return False
+                raise AuthError({
+                    'code': 'jwks_unavailable',
+                    'description': 'Unable to fetch signing keys.'
+                }, 503)
+            self.fetch_count += 1
+            self._keys = keys
+            self._fetched_at = time.monotonic()
+            return True
+
+    def get_key(self, kid):
+        if self._fetched_at is None:
+            self.refresh(min_age=self.ttl)
+        self._ensure_refresher()
+
+        key = self._keys.get(kid)
+        if key is None:
+            # unknown kid, the signing keys may have been rotated
+            self.refresh(min_age=self.min_refetch_interval)
+            key = self._keys.get(kid)
+        return key
+
+    def stop(self):
+        self._stopped.set()
+
+    def _ensure_refresher(self):
+        # threads do not survive a fork, restart the refresher in each worker
+        pid = os.getpid()
+        if self._refresher_pid == pid or self._stopped.is_set():
+            return
+        with self._fetch_lock:
+            if self._refresher_pid == pid:
+                return
+            self._refresher = threading.Thread(
+                target=self._refresh_periodically, daemon=True)
+            self._refresher_pid = pid
+            self._refresher.start()
+
+    def _refresh_periodically(self):
+        while not self._stopped.wait(self.ttl):
+            try:
+                self.refresh(min_age=self.ttl / 2)
+            except AuthError:
+                pass
+
+
+jwks_store = JWKSKeyStore(JWKS_URL)
+
+
+## Verified token cache
+'''
+VerifiedTokenCache
+    bounded LRU of tokens that already passed signature and claim validation
+
+    entries are keyed by the sha256 digest of the token, so raw bearer tokens
+    are never kept in memory, and hold the decoded payload until the token's
+    exp claim. Tokens without exp are not cached.
+'''
+class VerifiedTokenCache:
+    def __init__(self, max_size=TOKEN_CACHE_SIZE, enabled=TOKEN_CACHE_ENABLED):
+        self.max_size = max_size
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _digest(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token):
+        if not self.enabled:
+            return None
+        digest = self._digest(token)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                self.misses += 1
+                return None
+            payload, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[digest]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return payload
+
+    def set(self, token, payload):
+        if not self.enabled or not isinstance(payload.get('exp'), (int, float)):
+            return
+        digest = self._digest(token)
+        with self._lock:
+            self._entries[digest] = (payload, payload['exp'])
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+token_cache = VerifiedTokenCache()
+rate_limiter = create_rate_limiter(RATE_LIMIT, RATE_LIMITS, RATE_LIMIT_URL)
+
+
+## Rate limit
+'''
+token_subject(token, payload=None)
+    sub (or azp) of a verified payload, read unverified from the token
+    without one, None for malformed tokens
+    unverified subjects only pick a database, never grant access nor
+    charge a rate limit bucket
+'''
+def token_subject(token, payload=None):
+    claims = payload
+    if claims is None:
+        from jose import jwt
+        try:
+            claims = jwt.get_unverified_claims(token)
+        except Exception:
+            # malformed tokens are rejected by the signature check
+            return None
+    return claims.get('sub') or claims.get('azp')
+
+
+'''
+request_subject()
+    token_subject of the current request's bearer token, None without one
+'''
+def request_subject():
+    try:
+        return token_subject(get_token_auth_header())
+    except AuthError:
+        return None
+
+
+'''
+limit_rate(token, payload, permission)
+    takes a request from the bucket of the token's subject (azp for tokens
+    without sub) and the permission, raises RateLimitError once it is empty
+    payload must be verified: a token missing from token_cache (payload
+    None) takes from a bucket of its own, keyed by its digest, so a replayed
+    token is throttled before its RSA check while forged claims never spend
+    the requests of the subject they name. Its subject is charged once the
+    signature has been verified.
+'''
+def limit_rate(token, payload, permission):
+    if not rate_limiter.enabled:
+        return
+    if payload is None:
+        key = 'token:' + hashlib.sha256(token.encode()).hexdigest()
+    else:
+        key = token_subject(token, payload)
+        if not key:
+            return
+    wait = rate_limiter.take(key, permission)
+    if wait:
+        raise RateLimitError(wait)
+
+
 ## Auth Header
 def validate_auth_header(auth_header_values):
     # check if it's bearer token
@@ -62,7 +342,10 @@ def validate_auth_header(auth_header_values):
 '''
 def get_token_auth_header():
     # first try to get header
-    auth_header = request.headers.get('Authorization', None)
+    return token_from_header(request.headers.get('Authorization', None))
+
+
+def token_from_header(auth_header):
     if not auth_header:
        raise AuthError({
            'code': 'authorization_header_missing',
@@ -105,6 +388,7 @@ def check_permissions(permission, payload):
 
     it should be an Auth0 token with key id (kid)
     it should verify the token using Auth0 /.well-known/jwks.json
+        the keys are cached by jwks_store, no request goes to Auth0 for a known kid
     it should decode the payload from the token
     it should validate the claims
     return the decoded payload
@@ -112,10 +396,12 @@ def check_permissions(permission, payload):
     !!NOTE urlopen has a common certificate error described here: https://stackoverflow.com/questions/50236117/scraping-ssl-certificate-verify-failed-error-for-http-en-wikipedia-org
 '''
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    return decode_jwt(token, jwks_store.get_key(token_key_id(token)))
+
+
+def token_key_id(token):
+    from jose import jwt
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
 
     # check if header is valid
     if 'kid' not in unverified_header:
@@ -123,17 +409,16 @@ def verify_decode_jwt(token):
             'code': 'invalid_header',
             'description': 'Authorization header is missing kid.'
         }, 401)
+    return unverified_header['kid']
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
 
+'''
+decode_jwt(token, rsa_key)
+    validates the signature and claims of token with the key of its kid
+    (None when the key set has no such key), shared with the async key store
+'''
+def decode_jwt(token, rsa_key):
+    from jose import jwt
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -167,6 +452,46 @@ def verify_decode_jwt(token):
                 'description': 'Unable to find the appropriate key.'
     }, 400)
 
+'''
+authorize(permission)
+    runs the requires_auth checks for the current request outside a decorated view
+    returns the decoded payload
+    a permission already checked for the request (by a request hook before
+    the view) is not checked, nor counted by the rate limiter, again
+'''
+def authorize(permission=''):
+    authorized = g.setdefault('authorized_permissions', {})
+    if permission in authorized:
+        return authorized[permission]
+    with track('auth'):
+        payload = verified_payload(permission)
+        check_permissions(permission, payload)
+    authorized[permission] = payload
+    return payload
+
+'''
+authenticate(permission='')
+    verifies the current request's bearer token without checking any
+    permission, for views that only learn the permission they need from the
+    row they load: they authenticate before the lookup so a request without
+    a valid token never finds out whether the row exists
+    the request is counted by the rate limiter under permission
+    returns the decoded payload
+'''
+def authenticate(permission=''):
+    with track('auth'):
+        return verified_payload(permission)
+
+def verified_payload(permission):
+    token = get_token_auth_header()
+    payload = token_cache.get(token)
+    if payload is None:
+        limit_rate(token, None, permission)
+        payload = verify_decode_jwt(token)
+        token_cache.set(token, payload)
+    limit_rate(token, payload, permission)
+    return payload
+
 '''
 @TODO implement @requires_auth(permission) decorator method
     @INPUTS
@@ -174,17 +499,18 @@ def verify_decode_jwt(token):
 
     it should use the get_token_auth_header method to get the token
     it should use the verify_decode_jwt method to decode the jwt
+        unless token_cache already holds the payload of that token
     it should use the check_permissions method validate claims and check the requested permission
     return the decorator which passes the decoded payload to the decorated method
+        the permission is kept on the wrapper so request hooks can authorize early
 '''
 def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            payload = authorize(permission)
             return f(payload, *args, **kwargs)
 
+        wrapper.permission = permission
         return wrapper
     return requires_auth_decorator
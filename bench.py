@@ -0,0 +1,407 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+'''
+Benchmarks for the API hot paths
+
+    boots create_app against a local database (a throwaway sqlite file unless
+    --database-url is given), signs tokens with a local RSA key served by the
+    stand-in JWKS server and measures requests per second and latency
+    percentiles for every scenario through the Flask test client
+    the tables of the database are dropped and seeded, a --database-url that
+    has tables is refused unless --reset-database is given
+
+    python bench.py                               run every scenario
+    python bench.py --scenario list_actors        run some of them
+    python bench.py --save-baseline bench.json    store the results as a baseline
+    python bench.py --baseline bench.json         exit 1 when a scenario lost more
+                                                  than --threshold of its throughput
+    python bench.py --serialization               compare the ORM + jsonify and the
+                                                  row tuple + serializers.dumps paths
+    python bench.py --check-startup               time a cold import, create_app and
+                                                  first request in fresh processes
+'''
+
+SEED_ACTORS = 1000
+SEED_MOVIES = 1000
+
+SERIALIZATION_SIZES = (1000, 10000)
+
+STARTUP_RUNS = 5
+
+# run by a fresh interpreter for every --check-startup sample
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+flask_app = app.create_app()
+created = time.perf_counter()
+flask_app.test_client().get('/')
+served = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'create_app_ms': (created - imported) * 1000,
+    'first_request_ms': (served - created) * 1000,
+    'total_ms': (served - start) * 1000,
+    'modules': len(sys.modules)
+}))
+"""
+
+
+'''
+SCENARIOS
+    name -> (method, path(i), body(i), role)
+    i is the request number, used to spread reads and writes over the rows
+'''
+SCENARIOS = {
+    # full RS256 verification on every request, the token cache is off
+    'auth': ('GET', lambda i: '/actors?limit=1', None, 'casting_assistant'),
+    'list_actors': ('GET', lambda i: f'/actors?page={i % 50 + 1}', None, 'casting_assistant'),
+    'list_movies': ('GET', lambda i: f'/movies?page={i % 50 + 1}', None, 'casting_assistant'),
+    'list_actors_deep_cursor': ('GET', lambda i: f'/actors?after={SEED_ACTORS - 20}', None, 'casting_assistant'),
+    'list_actors_include_movies': ('GET', lambda i: '/actors?include=movies', None, 'casting_assistant'),
+    'search_actors': ('GET', lambda i: f'/actors?name=actor {i % 100}&sort=-age',
+                      None, 'casting_assistant'),
+    'search_movies': ('GET', lambda i: f'/movies?q=movie {i % 100}&released_after=2010-01-01',
+                      None, 'casting_assistant'),
+    'actor_detail': ('GET', lambda i: f'/actors/{i % 100 + 1}', None, 'casting_assistant'),
+    'movie_cast': ('GET', lambda i: f'/movies/{i % SEED_MOVIES + 1}/actors', None, 'casting_assistant'),
+    'top_movies': ('GET', lambda i: '/movies/top', None, 'casting_assistant'),
+    'create_actor': ('POST', lambda i: '/actors',
+                     lambda i: {'name': f'Bench {i}', 'age': 30, 'gender': 'Female'}, 'executive_producer'),
+    'update_actor': ('PATCH', lambda i: f'/actors/{i % SEED_ACTORS + 1}',
+                     lambda i: {'age': i % 80 + 10}, 'executive_producer'),
+    'create_movie': ('POST', lambda i: '/movies',
+                     lambda i: {'title': f'Bench {i}', 'release_date': '2023-02-16'}, 'executive_producer'),
+    'cast_actor': ('PUT', lambda i: f'/movies/{i % SEED_MOVIES + 1}/actors/{i % SEED_ACTORS + 1}',
+                   lambda i: {'rating': i % 5}, 'executive_producer')
+}
+
+
+def percentile(sorted_values, fraction):
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+class NonEmptyDatabaseError(Exception):
+    pass
+
+
+def database_tables(database_url):
+    from sqlalchemy import create_engine, inspect
+    engine = create_engine(database_url)
+    try:
+        return inspect(engine).get_table_names()
+    finally:
+        engine.dispose()
+
+
+'''
+BenchmarkEnvironment
+    app, database and token signer shared by the scenarios of one run
+    the database is dropped and seeded again: a database_url that already
+    has tables raises NonEmptyDatabaseError unless reset_database is set
+'''
+class BenchmarkEnvironment:
+    def __init__(self, database_url=None, response_cache=False, seed_rows=None,
+                 reset_database=False):
+        if database_url and not reset_database:
+            tables = database_tables(database_url)
+            if tables:
+                raise NonEmptyDatabaseError(
+                    f"{database_url} has tables ({', '.join(sorted(tables))}), the benchmark "
+                    f"drops them: pass --reset-database to go ahead")
+        self.directory = tempfile.TemporaryDirectory()
+        self.database_url = database_url or f'sqlite:///{self.directory.name}/bench.db'
+
+        import auth
+        import app as app_module
+        from fake_jwks import FakeJWKSServer
+        from models import setup_db, db_drop_and_create_all
+
+        self.auth = auth
+        self.app_module = app_module
+        self.jwks_server = FakeJWKSServer().start()
+        self.default_store = auth.jwks_store
+        auth.jwks_store = auth.JWKSKeyStore(self.jwks_server.url)
+
+        self.app = app_module.create_app()
+        setup_db(self.app, self.database_url)
+        db_drop_and_create_all()
+        self.seed(seed_rows or SEED_ACTORS)
+
+        self.default_cache_backend = app_module.response_cache.backend
+        if not response_cache:
+            app_module.response_cache.backend = None
+        # one token sends every request, the rate limit would only measure Retry-After
+        self.default_limiter_backend = auth.rate_limiter.backend
+        auth.rate_limiter.backend = None
+        self.headers = {}
+
+    def seed(self, rows):
+        from models import db, bulk_insert, Actor, Movie, Rating
+        bulk_insert(Actor, [{'name': f'Actor {i}', 'age': 20 + i % 60, 'gender': 'Female'}
+                            for i in range(rows)])
+        bulk_insert(Movie, [{'title': f'Movie {i}', 'release_date': date(2000 + i % 24, 1, 1)}
+                            for i in range(rows)])
+        # ratings only link seeded rows, the foreign keys are enforced
+        db.session.execute(Rating.insert(), [
+            {'Movie_id': movie_id, 'Actor_id': (movie_id * 7 + n) % rows + 2, 'rating': n % 5}
+            for movie_id in range(2, min(rows, SEED_MOVIES) + 2) for n in range(min(rows, 5))
+        ])
+        db.session.commit()
+
+    def auth_header(self, role):
+        if role not in self.headers:
+            self.headers[role] = self.jwks_server.auth_header(role)
+        return self.headers[role]
+
+    def close(self):
+        self.app_module.response_cache.backend = self.default_cache_backend
+        self.auth.rate_limiter.backend = self.default_limiter_backend
+        self.auth.jwks_store.stop()
+        self.auth.jwks_store = self.default_store
+        self.jwks_server.stop()
+        self.directory.cleanup()
+
+
+'''
+run_scenario(environment, name, requests, concurrency)
+    sends the scenario's requests and returns its throughput and latencies
+'''
+def run_scenario(environment, name, requests=500, concurrency=1, warmup=10):
+    method, path, body, role = SCENARIOS[name]
+    headers = environment.auth_header(role)
+    client = environment.app.test_client()
+    token_cache = environment.auth.token_cache
+    token_cache_enabled = token_cache.enabled
+    token_cache.enabled = name != 'auth'
+
+    def send(i):
+        start = time.perf_counter()
+        res = client.open(path(i), method=method, headers=headers,
+                          json=body(i) if body else None)
+        elapsed = time.perf_counter() - start
+        if res.status_code >= 400:
+            raise RuntimeError(f'{name}: {method} {path(i)} returned {res.status_code}')
+        return elapsed
+
+    try:
+        for i in range(warmup):
+            send(i)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            latencies = sorted(executor.map(send, range(warmup, warmup + requests)))
+        wall = time.perf_counter() - start
+    finally:
+        token_cache.enabled = token_cache_enabled
+
+    return {
+        'requests': requests,
+        'rps': requests / wall,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p90_ms': percentile(latencies, 0.90) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000
+    }
+
+
+def run_benchmarks(names=None, requests=500, concurrency=1, database_url=None,
+                   response_cache=False, reset_database=False):
+    environment = BenchmarkEnvironment(database_url, response_cache, reset_database=reset_database)
+    try:
+        return {name: run_scenario(environment, name, requests, concurrency)
+                for name in (names or SCENARIOS)}
+    finally:
+        environment.close()
+
+
+'''
+run_serialization_benchmark(sizes=SERIALIZATION_SIZES, repeat=5)
+    loads and encodes the first n movies both ways and returns the best
+    time of each, in milliseconds, with the speed-up
+        orm: Movie objects, Movie.format() and Flask's JSON encoder
+        rows: selected columns as row tuples, rows_to_dicts and serializers.dumps
+'''
+def run_serialization_benchmark(sizes=SERIALIZATION_SIZES, repeat=5, database_url=None,
+                                reset_database=False):
+    environment = BenchmarkEnvironment(database_url, seed_rows=max(sizes),
+                                       reset_database=reset_database)
+    from flask import json as flask_json
+    from sqlalchemy import select
+    import serializers
+    from models import db, Movie
+
+    columns = environment.app_module.MOVIE_COLUMNS
+
+    def orm_path(n):
+        movies = Movie.query.order_by(Movie.id).limit(n).all()
+        return flask_json.dumps({'success': True, 'movies': [movie.format() for movie in movies]})
+
+    def rows_path(n):
+        rows = db.session.execute(select(*columns).order_by(Movie.id).limit(n)).all()
+        return serializers.dumps({'success': True, 'movies': serializers.rows_to_dicts(columns, rows)})
+
+    def best_time(path, n):
+        timings = []
+        for _ in range(repeat):
+            # start from an empty identity map, as a new request would
+            db.session.remove()
+            start = time.perf_counter()
+            path(n)
+            timings.append(time.perf_counter() - start)
+        return min(timings) * 1000
+
+    results = {}
+    try:
+        with environment.app.app_context():
+            for n in sizes:
+                orm_ms = best_time(orm_path, n)
+                rows_ms = best_time(rows_path, n)
+                results[n] = {'orm_ms': orm_ms, 'rows_ms': rows_ms, 'speedup': orm_ms / rows_ms}
+    finally:
+        environment.close()
+    return results
+
+
+def format_serialization_results(results):
+    import serializers
+    encoder = 'orjson' if serializers.orjson is not None else 'json'
+    lines = [f"{'rows':>8}{'orm + jsonify ms':>20}{f'rows + {encoder} ms':>20}{'speed-up':>10}"]
+    for n, result in results.items():
+        lines.append(f"{n:>8}{result['orm_ms']:>20.2f}{result['rows_ms']:>20.2f}"
+                     f"{result['speedup']:>9.1f}x")
+    return '\n'.join(lines)
+
+
+'''
+run_startup_check(runs=STARTUP_RUNS, database_url=None)
+    starts runs fresh interpreters that import app, call create_app and serve
+    GET /, and returns the min and median of every phase, in milliseconds
+    (modules: the number of modules loaded), process_ms includes the
+    interpreter's own start
+'''
+def run_startup_check(runs=STARTUP_RUNS, database_url=None):
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ, DATABASE_URL=database_url or f'sqlite:///{directory}/startup.db')
+        env.pop('FLASK_RUN_FROM_CLI', None)
+        samples = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], env=env, check=True,
+                                    cwd=os.path.dirname(os.path.abspath(__file__)),
+                                    stdout=subprocess.PIPE, text=True).stdout
+            sample = json.loads(output.splitlines()[-1])
+            sample['process_ms'] = (time.perf_counter() - start) * 1000
+            samples.append(sample)
+    return {phase: {'min': min(sample[phase] for sample in samples),
+                    'median': statistics.median(sample[phase] for sample in samples)}
+            for phase in samples[0]}
+
+
+def format_startup_results(results):
+    lines = [f"{'phase':<20}{'min':>10}{'median':>10}"]
+    for phase, result in results.items():
+        lines.append(f"{phase:<20}{result['min']:>10.1f}{result['median']:>10.1f}")
+    return '\n'.join(lines)
+
+
+'''
+compare(results, baseline, threshold)
+    returns a message for every scenario whose throughput fell more than
+    threshold (a fraction) below the baseline
+'''
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        floor = baseline[name]['rps'] * (1 - threshold)
+        if result['rps'] < floor:
+            regressions.append(
+                f"{name}: {result['rps']:.0f} req/s is below {floor:.0f} req/s "
+                f"({baseline[name]['rps']:.0f} req/s baseline - {threshold:.0%})")
+    return regressions
+
+
+def format_results(results):
+    lines = [f"{'scenario':<28}{'req/s':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}"]
+    for name, result in results.items():
+        lines.append(f"{name:<28}{result['rps']:>10.0f}{result['p50_ms']:>10.2f}"
+                     f"{result['p90_ms']:>10.2f}{result['p99_ms']:>10.2f}")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the casting agency API')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='scenario to run, repeat for several (default: all)')
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--database-url', help='defaults to a temporary sqlite file')
+    parser.add_argument('--reset-database', action='store_true',
+                        help='drop the tables of a --database-url that has some')
+    parser.add_argument('--response-cache', action='store_true',
+                        help='keep the response cache on (measures cache hits)')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed throughput drop against the baseline (default 0.2)')
+    parser.add_argument('--save-baseline', help='write the results to this file')
+    parser.add_argument('--serialization', action='store_true',
+                        help='benchmark the list serialization paths on 1k and 10k rows instead')
+    parser.add_argument('--check-startup', action='store_true',
+                        help='time the startup of fresh processes instead')
+    parser.add_argument('--startup-runs', type=int, default=STARTUP_RUNS)
+    parser.add_argument('--startup-budget', type=float,
+                        help='exit 1 when the median total_ms exceeds this many milliseconds')
+    args = parser.parse_args(argv)
+
+    if args.check_startup:
+        results = run_startup_check(args.startup_runs, args.database_url)
+        print(format_startup_results(results))
+        if args.startup_budget is not None and results['total_ms']['median'] > args.startup_budget:
+            print(f"REGRESSION startup: {results['total_ms']['median']:.1f} ms is above the "
+                  f"{args.startup_budget:.0f} ms budget")
+            return 1
+        return 0
+
+    if args.serialization:
+        try:
+            results = run_serialization_benchmark(database_url=args.database_url,
+                                                  reset_database=args.reset_database)
+        except NonEmptyDatabaseError as error:
+            parser.error(str(error))
+        print(format_serialization_results(results))
+        return 0
+
+    try:
+        results = run_benchmarks(args.scenario, args.requests, args.concurrency,
+                                 args.database_url, args.response_cache, args.reset_database)
+    except NonEmptyDatabaseError as error:
+        parser.error(str(error))
+    print(format_results(results))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.threshold)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,152 @@
+import threading
+import time
+from collections import OrderedDict
+
+'''
+Response cache for the read endpoints
+
+    a backend stores response bodies under string keys, each tagged with the
+    tables the response was built from, so a write to a table can drop every
+    response that read it
+
+    LRUCacheBackend keeps the entries in process memory
+    RedisCacheBackend shares them between workers through any client with
+    the redis-py get/set/delete/sadd/smembers interface
+'''
+
+
+'''
+LRUCacheBackend(max_size)
+    every entry keeps its tags, an entry leaves the tag index with the
+    entry itself (evicted, expired, replaced or invalidated), so the index
+    never outgrows max_size entries
+'''
+class LRUCacheBackend:
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at, _ = entry
+            if expires_at <= time.monotonic():
+                self._discard(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl, tags=()):
+        with self._lock:
+            self._discard(key)
+            tags = frozenset(tags)
+            self._entries[key] = (value, time.monotonic() + ttl, tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_size:
+                self._discard(next(iter(self._entries)))
+
+    def invalidate(self, tags):
+        with self._lock:
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._discard(key)
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self._tags[tag]
+            keys.discard(key)
+            if not keys:
+                del self._tags[tag]
+
+    def size(self):
+        return len(self._entries)
+
+
+class RedisCacheBackend:
+    def __init__(self, client, prefix='casting-agency:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl, tags=()):
+        self.client.set(self.prefix + key, value, ex=ttl)
+        for tag in tags:
+            self.client.sadd(self.prefix + 'tag:' + tag, self.prefix + key)
+
+    def invalidate(self, tags):
+        for tag in tags:
+            tag_key = self.prefix + 'tag:' + tag
+            keys = self.client.smembers(tag_key)
+            self.client.delete(tag_key, *keys)
+
+    def size(self):
+        return None
+
+
+'''
+ResponseCache
+    counts hits and misses in front of a backend
+    a cache without backend is disabled and always misses
+'''
+class ResponseCache:
+    def __init__(self, backend=None, ttl=60):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    def get(self, key):
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value, tags=()):
+        self.backend.set(key, value, self.ttl, tags)
+
+    def invalidate(self, tags):
+        if self.enabled:
+            self.backend.invalidate(tags)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'size': self.backend.size() if self.enabled else 0
+            }
+
+
+'''
+create_response_cache(kind, url=None, max_size=1024, ttl=60)
+    kind is 'lru', 'redis' or 'none'
+    the redis backend needs the redis package and a RESPONSE_CACHE_URL
+'''
+def create_response_cache(kind, url=None, max_size=1024, ttl=60):
+    if kind == 'lru':
+        return ResponseCache(LRUCacheBackend(max_size), ttl)
+    if kind == 'redis':
+        import redis
+        return ResponseCache(RedisCacheBackend(redis.Redis.from_url(url)), ttl)
+    return ResponseCache(None, ttl)
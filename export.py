@@ -0,0 +1,94 @@
+import csv
+import io
+import json
+import os
+import threading
+from datetime import date
+
+'''
+Streaming export of whole tables
+
+    rows are read through a server-side cursor (stream_results) in chunks of
+    EXPORT_CHUNK_SIZE and encoded chunk by chunk, so memory stays flat and the
+    first bytes leave before the last rows are read
+
+    every export holds a pool connection for as long as its client takes to
+    read it, a process runs at most EXPORT_MAX_CONCURRENT of them at once so
+    slow clients cannot drain the pool, keep it below the engine profile's
+    pool_size. Further exports are refused with 503 and Retry-After.
+'''
+
+EXPORT_CHUNK_SIZE = 1000
+EXPORT_MAX_CONCURRENT = int(os.environ.get('EXPORT_MAX_CONCURRENT', 2))
+# seconds a refused export is told to wait
+EXPORT_RETRY_AFTER = int(os.environ.get('EXPORT_RETRY_AFTER', 5))
+
+export_slots = threading.BoundedSemaphore(EXPORT_MAX_CONCURRENT)
+
+
+'''
+acquire_export_slot()
+    takes an export slot without waiting, None when all are in use
+    returns the function that frees it, which only frees it the first time:
+    the end of the stream and the closing of the response both call it
+'''
+def acquire_export_slot():
+    slots = export_slots
+    if not slots.acquire(blocking=False):
+        return None
+    lock = threading.Lock()
+    held = [True]
+
+    def release():
+        with lock:
+            if not held:
+                return
+            held.clear()
+        slots.release()
+    return release
+
+EXPORT_MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+
+
+def _json_default(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def encode_ndjson(columns, rows):
+    return ''.join(json.dumps(dict(zip(columns, row)), default=_json_default) + '\n'
+                   for row in rows)
+
+
+def encode_csv(columns, rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(
+        [value.isoformat() if isinstance(value, date) else value for value in row]
+        for row in rows)
+    return buffer.getvalue()
+
+
+'''
+stream_export(engine, query, fmt, chunk_size=EXPORT_CHUNK_SIZE, release=None)
+    yields the encoded rows of a Core select, on a connection of its own
+    CSV output starts with a header line of the selected column names
+    release, when given, is called once the stream ends or is closed
+'''
+def stream_export(engine, query, fmt, chunk_size=EXPORT_CHUNK_SIZE, release=None):
+    columns = [column.name for column in query.selected_columns]
+    encode = encode_csv if fmt == 'csv' else encode_ndjson
+    try:
+        if fmt == 'csv':
+            yield encode_csv(columns, [columns])
+
+        with engine.connect() as connection:
+            result = connection.execution_options(stream_results=True).execute(query)
+            for rows in result.partitions(chunk_size):
+                yield encode(columns, rows)
+    finally:
+        if release is not None:
+            release()
@@ -0,0 +1,115 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import rsa
+from jose import jwt, jwk
+from auth import AUTH0_DOMAIN, API_AUDIENCE
+
+'''
+Local stand-in for the Auth0 /.well-known/jwks.json endpoint
+    generates RSA key pairs, serves their public halves as a JWKS document
+    and signs tokens the API accepts, so tests and benchmarks do not
+    depend on Auth0 or on pre-issued bearer tokens
+'''
+
+ROLE_PERMISSIONS = {
+    'casting_assistant': [
+        'get:actors', 'get:movies'
+    ],
+    'casting_director': [
+        'delete:actors', 'edit:actors', 'edit:movies',
+        'get:actors', 'get:movies', 'post:actors'
+    ],
+    'executive_producer': [
+        'delete:actors', 'delete:movies', 'edit:actors', 'edit:movies',
+        'get:actors', 'get:movies', 'post:actors', 'post:movies'
+    ]
+}
+
+# key generation is slow in pure python, share the keys within a process
+_private_keys = {}
+_private_keys_lock = threading.Lock()
+
+
+def generate_private_key(kid, key_size=2048):
+    with _private_keys_lock:
+        if kid not in _private_keys:
+            _, private_key = rsa.newkeys(key_size)
+            _private_keys[kid] = private_key.save_pkcs1().decode()
+        return _private_keys[kid]
+
+
+class FakeJWKSServer:
+    def __init__(self, kid='test-key', key_size=2048):
+        self.key_size = key_size
+        self.kid = kid
+        self.request_count = 0
+        self._keys = {}
+        self._server = None
+        self._thread = None
+        self.add_key(kid)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f'http://{host}:{port}/.well-known/jwks.json'
+
+    def add_key(self, kid):
+        private_key = generate_private_key(kid, self.key_size)
+        public_key = jwk.construct(private_key, 'RS256').public_key().to_dict()
+        public_key.update({'kid': kid, 'use': 'sig'})
+        self._keys[kid] = (private_key, public_key)
+
+    def remove_key(self, kid):
+        self._keys.pop(kid, None)
+
+    def jwks(self):
+        return {'keys': [public for _, public in self._keys.values()]}
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake.request_count += 1
+                body = json.dumps(fake.jwks()).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def sign(self, permissions, sub='auth0|test', expires_in=3600,
+             kid=None, signing_kid=None, **claims):
+        kid = kid or self.kid
+        private_key, _ = self._keys[signing_kid or kid]
+        now = int(time.time())
+        payload = {
+            'iss': f'https://{AUTH0_DOMAIN}/',
+            'sub': sub,
+            'aud': API_AUDIENCE,
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': list(permissions)
+        }
+        payload.update(claims)
+        return jwt.encode(payload, private_key, algorithm='RS256',
+                          headers={'kid': kid})
+
+    def auth_header(self, role, **kwargs):
+        token = self.sign(ROLE_PERMISSIONS[role], sub=f'auth0|{role}', **kwargs)
+        return {'Authorization': f'Bearer {token}'}
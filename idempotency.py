@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from functools import wraps
+from flask import abort, current_app, make_response, request
+from sqlalchemy import delete, exc, update
+from models import db, IdempotencyKey
+
+'''
+Retry-safe POST requests
+
+    a POST sent with an Idempotency-Key header reserves (token subject, key)
+    in idempotency_keys before the view runs, and stores the response once
+    it is done. A retry with the same key is answered from that row with a
+    single primary key lookup, without running the view again:
+
+        same body, response stored    the stored response, Idempotent-Replayed: true
+        same body, still running      409
+        different body                422
+
+    the view's writes and the stored response commit in one transaction, a
+    request either wrote and stored its response or did neither.
+    responses with a 5xx status (and exceptions) release the key so the
+    request can be retried, a reservation whose request died before it
+    could (a killed worker) is taken over by a retry after
+    IDEMPOTENCY_LEASE seconds. Keys older than IDEMPOTENCY_TTL seconds are
+    ignored and deleted at most every IDEMPOTENCY_COMPACT_INTERVAL seconds.
+'''
+
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 86400))
+# seconds a reservation without a stored response blocks retries with 409
+IDEMPOTENCY_LEASE = int(os.environ.get('IDEMPOTENCY_LEASE', 60))
+IDEMPOTENCY_COMPACT_INTERVAL = int(os.environ.get('IDEMPOTENCY_COMPACT_INTERVAL', 3600))
+MAX_KEY_LENGTH = 255
+
+_compaction_lock = threading.Lock()
+_last_compaction = None
+
+
+def request_fingerprint():
+    body = request.get_json(silent=True)
+    if body is None:
+        payload = request.get_data()
+    else:
+        payload = json.dumps(body, sort_keys=True, separators=(',', ':')).encode()
+    return hashlib.sha256(request.method.encode() + b' ' + request.path.encode() +
+                          b'\n' + payload).hexdigest()
+
+
+def expiry_cutoff():
+    return datetime.utcnow() - timedelta(seconds=IDEMPOTENCY_TTL)
+
+
+'''
+reserve_key(owner, key, fingerprint)
+    returns the live IdempotencyKey of an earlier request, or None once the
+    key is reserved for this one
+    concurrent requests with the same key race on the primary key, the
+    loser gets the winner's row. A reservation older than IDEMPOTENCY_LEASE
+    without a response is taken over with a conditional UPDATE, its request
+    wrote nothing.
+'''
+def reserve_key(owner, key, fingerprint):
+    record = db.session.get(IdempotencyKey, (owner, key))
+    if record is not None and record.created_at >= expiry_cutoff():
+        if record.status_code is not None or record.fingerprint != fingerprint or \
+                record.created_at >= datetime.utcnow() - timedelta(seconds=IDEMPOTENCY_LEASE):
+            return record
+        taken = db.session.execute(update(IdempotencyKey.__table__).where(
+            IdempotencyKey.owner == owner, IdempotencyKey.key == key,
+            IdempotencyKey.status_code.is_(None),
+            IdempotencyKey.created_at == record.created_at).values(
+            created_at=datetime.utcnow())).rowcount
+        db.session.commit()
+        if taken:
+            return None
+        db.session.refresh(record)
+        return record
+    if record is not None:
+        db.session.delete(record)
+    db.session.add(IdempotencyKey(owner=owner, key=key, fingerprint=fingerprint,
+                                  created_at=datetime.utcnow()))
+    try:
+        db.session.commit()
+    except exc.IntegrityError:
+        db.session.rollback()
+        return db.session.get(IdempotencyKey, (owner, key))
+    return None
+
+
+def release_key(owner, key):
+    db.session.rollback()
+    db.session.execute(delete(IdempotencyKey).where(
+        IdempotencyKey.owner == owner, IdempotencyKey.key == key))
+    db.session.commit()
+
+
+def store_response(owner, key, response):
+    record = db.session.get(IdempotencyKey, (owner, key))
+    record.status_code = response.status_code
+    record.response = response.get_data()
+
+
+def replay(record, fingerprint):
+    if record.fingerprint != fingerprint:
+        abort(422)
+    if record.status_code is None:
+        abort(409)
+    response = current_app.response_class(record.response, status=record.status_code,
+                                          mimetype='application/json')
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+'''
+compact_keys(force=False)
+    deletes the expired keys, at most once per IDEMPOTENCY_COMPACT_INTERVAL
+    seconds per process unless forced, returns the number of rows deleted
+'''
+def compact_keys(force=False):
+    global _last_compaction
+    with _compaction_lock:
+        now = time.monotonic()
+        if not force and _last_compaction is not None and \
+                now - _last_compaction < IDEMPOTENCY_COMPACT_INTERVAL:
+            return 0
+        _last_compaction = now
+    deleted = db.session.execute(delete(IdempotencyKey).where(
+        IdempotencyKey.created_at < expiry_cutoff())).rowcount
+    db.session.commit()
+    return deleted
+
+
+'''
+@idempotent
+    makes a view decorated with requires_auth retry-safe, place it below
+    requires_auth so the decoded payload identifies the key's owner
+    the view writes without committing, the decorator commits its writes,
+    together with the stored response when there is a key
+'''
+def idempotent(f):
+    @wraps(f)
+    def wrapper(payload, *args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            response = f(payload, *args, **kwargs)
+            db.session.commit()
+            return response
+        if not key or len(key) > MAX_KEY_LENGTH:
+            abort(400)
+
+        owner = payload.get('sub', '')
+        fingerprint = request_fingerprint()
+        record = reserve_key(owner, key, fingerprint)
+        if record is not None:
+            return replay(record, fingerprint)
+
+        try:
+            response = make_response(f(payload, *args, **kwargs))
+        except BaseException:
+            release_key(owner, key)
+            raise
+        if response.status_code >= 500:
+            release_key(owner, key)
+        else:
+            try:
+                store_response(owner, key, response)
+                db.session.commit()
+            except BaseException:
+                release_key(owner, key)
+                raise
+        compact_keys()
+        return response
+    return wrapper
@@ -0,0 +1,257 @@
+import argparse
+import os
+import socket
+import threading
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import and_, func, or_, select, update
+from models import db, Job
+
+'''
+Background jobs for large bulk requests
+
+    a bulk request sent with Prefer: respond-async is stored in the jobs
+    table and answered with 202 and the job id at once, whatever its size.
+    Workers claim queued jobs from that table, the database is the broker,
+    and write them JOB_CHUNK_SIZE items per transaction. Each transaction
+    also records the job's progress, so GET /jobs/<id> reports it and a job
+    whose worker died resumes after the last committed chunk once its lease
+    of JOB_LEASE seconds expires.
+
+    every web process starts JOB_WORKERS threads with its first job, set it
+    to 0 and run `python jobs.py --workers N` to drain the queue from
+    dedicated processes instead
+'''
+
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_CHUNK_SIZE = int(os.environ.get('JOB_CHUNK_SIZE', 1000))
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 1.0))
+JOB_LEASE = int(os.environ.get('JOB_LEASE', 300))
+MAX_JOB_ITEMS = int(os.environ.get('MAX_JOB_ITEMS', 1000000))
+# failed items listed on a job, the others are only counted
+MAX_JOB_ERRORS = 1000
+
+'''
+job_handlers
+    kind -> handler(items), registered by the app
+    a handler writes a chunk of items without committing and returns one
+    bulk result per item, {'index': ..., 'success': ...} as bulk_write does
+'''
+job_handlers = {}
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def register_job(kind, handler):
+    job_handlers[kind] = handler
+
+
+def claimable():
+    return or_(Job.status == 'queued',
+               and_(Job.status == 'running', Job.lease_expires_at < datetime.utcnow()))
+
+
+def lease_expiry():
+    return datetime.utcnow() + timedelta(seconds=JOB_LEASE)
+
+
+'''
+enqueue(kind, permission, owner, items)
+    stores a job and wakes the workers of this process
+    permission is the one the request was authorized with, GET /jobs/<id>
+    requires it again
+'''
+def enqueue(kind, permission, owner, items):
+    job = Job(kind=kind, permission=permission, owner=owner, status='queued',
+              items=items, total=len(items), processed=0, succeeded=0)
+    db.session.add(job)
+    db.session.commit()
+    if JOB_WORKERS:
+        start_workers(JOB_WORKERS).wake()
+    return job.id
+
+
+'''
+claim_job(worker)
+    takes the oldest claimable job with a conditional UPDATE, workers racing
+    for the same job find it already claimed and try the next one
+    returns the job id or None when the queue is empty
+'''
+def claim_job(worker):
+    while True:
+        job_id = db.session.execute(
+            select(Job.id).where(claimable()).order_by(Job.id).limit(1)).scalar()
+        if job_id is None:
+            db.session.commit()
+            return None
+        now = datetime.utcnow()
+        claimed = db.session.execute(
+            update(Job.__table__).where(Job.id == job_id, claimable()).values(
+                status='running', worker=worker, lease_expires_at=lease_expiry(),
+                started_at=func.coalesce(Job.started_at, now))).rowcount
+        db.session.commit()
+        if claimed:
+            return job_id
+
+
+'''
+run_job(job_id, worker)
+    writes the remaining items of a claimed job chunk by chunk, each chunk
+    and the job's progress commit together
+    a handler error fails the job, the chunks already committed stay written
+    a worker that lost its lease stops without touching the job
+'''
+def run_job(job_id, worker):
+    job = db.session.get(Job, job_id)
+    handler = job_handlers.get(job.kind)
+    items = job.items or []
+    processed, succeeded, errors = job.processed, job.succeeded, list(job.errors or [])
+    db.session.commit()
+    if handler is None:
+        return finish_job(job_id, worker, 'failed', f'unknown job kind {job.kind}')
+
+    while processed < len(items):
+        chunk = items[processed:processed + JOB_CHUNK_SIZE]
+        try:
+            results = handler(chunk)
+        except Exception as error:
+            db.session.rollback()
+            return finish_job(job_id, worker, 'failed', str(error))
+
+        for result in results:
+            if result['success']:
+                succeeded += 1
+            elif len(errors) < MAX_JOB_ERRORS:
+                errors.append(dict(result, index=result['index'] + processed))
+        processed += len(chunk)
+
+        owned = db.session.execute(
+            update(Job.__table__).where(Job.id == job_id, Job.worker == worker).values(
+                processed=processed, succeeded=succeeded, errors=errors,
+                lease_expires_at=lease_expiry())).rowcount
+        if not owned:
+            db.session.rollback()
+            return False
+        db.session.commit()
+    return finish_job(job_id, worker, 'done')
+
+
+def finish_job(job_id, worker, status, error=None):
+    finished = db.session.execute(
+        update(Job.__table__).where(Job.id == job_id, Job.worker == worker).values(
+            status=status, error=error, items=None, lease_expires_at=None,
+            finished_at=datetime.utcnow())).rowcount
+    db.session.commit()
+    return bool(finished)
+
+
+'''
+run_next_job(worker)
+    claims and runs one job, returns False when there was none
+'''
+def run_next_job(worker):
+    job_id = claim_job(worker)
+    if job_id is None:
+        return False
+    run_job(job_id, worker)
+    return True
+
+
+'''
+JobWorkerPool(app, workers, poll_interval)
+    threads that run jobs in an app context until stop()
+    idle workers poll the table every poll_interval seconds, enqueue()
+    wakes them at once for the jobs of their own process
+'''
+class JobWorkerPool:
+    def __init__(self, app, workers=JOB_WORKERS, poll_interval=JOB_POLL_INTERVAL):
+        self.app = app
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.pid = os.getpid()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        prefix = f'{socket.gethostname()}:{self.pid}'
+        for number in range(self.workers):
+            thread = threading.Thread(target=self.run, args=(f'{prefix}:{number}',),
+                                      name=f'job-worker-{number}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def wake(self):
+        self._wake.set()
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def run(self, worker):
+        with self.app.app_context():
+            while not self._stop.is_set():
+                try:
+                    ran = run_next_job(worker)
+                except Exception:
+                    self.app.logger.exception('job worker %s failed', worker)
+                    db.session.rollback()
+                    ran = False
+                finally:
+                    db.session.remove()
+                if not ran:
+                    self._wake.wait(self.poll_interval)
+                    self._wake.clear()
+
+
+'''
+start_workers(workers, app=None)
+    the worker pool of this process, started on first use
+    pre-fork servers copy the parent's pool without its threads, a forked
+    worker process starts a pool of its own
+'''
+def start_workers(workers, app=None):
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            if app is None:
+                app = current_app._get_current_object()
+            _pool = JobWorkerPool(app, workers).start()
+        return _pool
+
+
+def stop_workers(timeout=None):
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.stop(timeout)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the casting agency job workers')
+    parser.add_argument('--workers', type=int, default=max(JOB_WORKERS, 1))
+    args = parser.parse_args(argv)
+
+    # run as a script this file is __main__, while the app registers its
+    # handlers on the jobs module it imports: the workers must run that one
+    import jobs
+    from app import create_app
+    pool = jobs.start_workers(args.workers, create_app())
+    try:
+        pool.join()
+    except KeyboardInterrupt:
+        jobs.stop_workers()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
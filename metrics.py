@@ -0,0 +1,258 @@
+import hmac
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from flask import Response, g, has_request_context, jsonify, request
+from flask.json import JSONEncoder
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+'''
+Request instrumentation published in the Prometheus text format
+
+    every request records its wall time and, inside it, the time spent in
+    authorize() (token and permission checks), in SQL statements (through
+    engine events) and in JSON encoding, as per-route histograms on /metrics
+
+    the registry lives in process memory: each gunicorn worker exposes its
+    own series, which Prometheus sums when it scrapes them as separate targets
+
+    /metrics is not public: it takes METRICS_TOKEN when one is set, a token
+    holding METRICS_PERMISSION otherwise. Without METRICS_TOKEN,
+    METRICS_PUBLIC=true opens it to anyone who can reach it, for scrapers on
+    a private network only
+'''
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# when set, GET /metrics requires "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+# without METRICS_TOKEN, GET /metrics requires a token holding this permission
+METRICS_PERMISSION = os.environ.get('METRICS_PERMISSION', 'read:metrics')
+METRICS_PUBLIC = os.environ.get('METRICS_PUBLIC', 'false').lower() in ('1', 'true', 'yes')
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+PHASES = ('auth', 'sql', 'serialize')
+
+
+def escape_label(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def format_labels(names, values, **extra):
+    pairs = list(zip(names, values)) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+
+def format_value(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+'''
+Histogram(name, documentation, label_names=(), buckets=LATENCY_BUCKETS)
+    thread-safe Prometheus histogram, one series per combination of labels
+'''
+class Histogram:
+    def __init__(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def count(self, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            return sum(series[0]) if series else 0
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((labels, list(counts), total)
+                            for labels, (counts, total) in self._series.items())
+        for labels, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket'
+                             f'{format_labels(self.label_names, labels, le=format_value(bound))} '
+                             f'{cumulative}')
+            label_text = format_labels(self.label_names, labels)
+            lines.append(f'{self.name}_sum{label_text} {format_value(total)}')
+            lines.append(f'{self.name}_count{label_text} {cumulative}')
+        return lines
+
+
+'''
+MetricsRegistry
+    histograms plus stats collectors: callables returning {name: number},
+    rendered as gauges named <prefix>_<name>, registered once per prefix
+'''
+class MetricsRegistry:
+    def __init__(self):
+        self.histograms = {}
+        self.collectors = {}
+
+    def histogram(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(name, documentation, label_names, buckets)
+        return self.histograms[name]
+
+    def register_stats(self, prefix, stats):
+        self.collectors[prefix] = stats
+
+    def render(self):
+        lines = []
+        for histogram in self.histograms.values():
+            lines += histogram.render()
+        for prefix, stats in self.collectors.items():
+            for name, value in stats().items():
+                if isinstance(value, (bool, int, float)):
+                    lines.append(f'# TYPE {prefix}_{name} gauge')
+                    lines.append(f'{prefix}_{name} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+request_duration = registry.histogram(
+    'http_request_duration_seconds', 'Wall time of a request, per route',
+    ('method', 'route', 'status'))
+phase_durations = {
+    phase: registry.histogram(
+        f'http_request_{phase}_seconds', f'Time a request spent in {phase}, per route',
+        ('method', 'route'))
+    for phase in PHASES
+}
+request_statements = registry.histogram(
+    'http_request_sql_statements', 'SQL statements issued by a request, per route',
+    ('method', 'route'), COUNT_BUCKETS)
+statement_duration = registry.histogram(
+    'db_statement_duration_seconds', 'Execution time of SQL statements, per statement kind',
+    ('statement',))
+
+
+'''
+track(phase)
+    adds the time spent inside the with block to a phase of the current
+    request, a no-op outside of an instrumented request
+'''
+@contextmanager
+def track(phase):
+    phases = g.get('request_phases') if has_request_context() else None
+    if phases is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases[phase] += time.perf_counter() - start
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('statement_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_statement(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['statement_start'].pop()
+    kind = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'OTHER'
+    if kind not in ('SELECT', 'INSERT', 'UPDATE', 'DELETE'):
+        kind = 'OTHER'
+    statement_duration.observe(elapsed, kind)
+
+    phases = g.get('request_phases') if has_request_context() else None
+    if phases is not None:
+        phases['sql'] += elapsed
+        phases['statements'] += 1
+
+
+@event.listens_for(Engine, 'handle_error')
+def discard_statement_timer(context):
+    if context.connection is not None:
+        timers = context.connection.info.get('statement_start')
+        if timers:
+            timers.pop()
+
+
+'''
+TimedJSONEncoder
+    Flask's encoder, with its time counted in the request's serialize phase
+'''
+class TimedJSONEncoder(JSONEncoder):
+    def encode(self, o):
+        with track('serialize'):
+            return super().encode(o)
+
+
+def route_label():
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+'''
+setup_metrics(app)
+    instruments every request of app and adds GET /metrics
+    call it before registering other request hooks, so the wall time
+    includes them
+'''
+def setup_metrics(app):
+    if not METRICS_ENABLED:
+        return
+    app.json_encoder = TimedJSONEncoder
+
+    @app.before_request
+    def start_request_timer():
+        g.request_start = time.perf_counter()
+        g.request_phases = dict.fromkeys(PHASES + ('statements',), 0)
+
+    @app.after_request
+    def record_request(response):
+        start = g.pop('request_start', None)
+        phases = g.pop('request_phases', None)
+        if start is None or request.endpoint == 'metrics':
+            return response
+
+        route = route_label()
+        request_duration.observe(time.perf_counter() - start,
+                                 request.method, route, str(response.status_code))
+        for phase in PHASES:
+            phase_durations[phase].observe(phases[phase], request.method, route)
+        request_statements.observe(phases['statements'], request.method, route)
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        if METRICS_TOKEN is not None:
+            expected = f'Bearer {METRICS_TOKEN}'
+            if not hmac.compare_digest(request.headers.get('Authorization', ''), expected):
+                return jsonify({
+                    'success': False,
+                    'error': 401,
+                    'message': 'metrics token required'
+                }), 401
+        elif not METRICS_PUBLIC:
+            # imported here, auth imports this module for track
+            from auth import authorize
+            authorize(METRICS_PERMISSION)
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
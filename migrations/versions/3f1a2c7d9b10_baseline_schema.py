@@ -0,0 +1,54 @@
+"""baseline schema: actors, movies and ratings
+
+Revision ID: 3f1a2c7d9b10
+Revises:
+Create Date: 2023-03-01 10:00:00.000000
+
+Databases created by db.create_all() before migrations existed already have
+these tables, they are left as they are.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1a2c7d9b10'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    tables = sa.inspect(op.get_bind()).get_table_names()
+    if 'actors' not in tables:
+        op.create_table(
+            'actors',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('name', sa.String(), nullable=True),
+            sa.Column('gender', sa.String(), nullable=True),
+            sa.Column('age', sa.Integer(), nullable=True),
+            sa.PrimaryKeyConstraint('id')
+        )
+    if 'movies' not in tables:
+        op.create_table(
+            'movies',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('title', sa.String(), nullable=True),
+            sa.Column('release_date', sa.Date(), nullable=True),
+            sa.PrimaryKeyConstraint('id')
+        )
+    if 'ratings' not in tables:
+        op.create_table(
+            'ratings',
+            sa.Column('Movie_id', sa.Integer(), nullable=True),
+            sa.Column('Actor_id', sa.Integer(), nullable=True),
+            sa.Column('rating', sa.Float(), nullable=True),
+            sa.ForeignKeyConstraint(['Actor_id'], ['actors.id']),
+            sa.ForeignKeyConstraint(['Movie_id'], ['movies.id'])
+        )
+
+
+def downgrade():
+    op.drop_table('ratings')
+    op.drop_table('movies')
+    op.drop_table('actors')
@@ -0,0 +1,39 @@
+"""idempotency_keys
+
+Revision ID: 5b2e9d4c1f08
+Revises: c7d93e2f4a61
+Create Date: 2023-03-20 09:30:00.000000
+
+stored responses of POST requests sent with an Idempotency-Key header,
+created_at is indexed for the compaction of expired keys.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b2e9d4c1f08'
+down_revision = 'c7d93e2f4a61'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if 'idempotency_keys' in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.create_table(
+        'idempotency_keys',
+        sa.Column('owner', sa.String(length=255), nullable=False),
+        sa.Column('key', sa.String(length=255), nullable=False),
+        sa.Column('fingerprint', sa.String(length=64), nullable=False),
+        sa.Column('status_code', sa.Integer(), nullable=True),
+        sa.Column('response', sa.LargeBinary(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('owner', 'key')
+    )
+    op.create_index('ix_idempotency_keys_created_at', 'idempotency_keys', ['created_at'])
+
+
+def downgrade():
+    op.drop_index('ix_idempotency_keys_created_at', table_name='idempotency_keys')
+    op.drop_table('idempotency_keys')
@@ -0,0 +1,66 @@
+"""ratings primary key and reverse index, table_versions
+
+Revision ID: 8c4e51b0a7d2
+Revises: 3f1a2c7d9b10
+Create Date: 2023-03-01 10:05:00.000000
+
+(Movie_id, Actor_id) becomes the primary key of ratings, rows without a
+movie or an actor and duplicated links are removed first. table_versions
+holds the per-table version stamps behind ETags and the response cache.
+"""
+from datetime import datetime
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c4e51b0a7d2'
+down_revision = '3f1a2c7d9b10'
+branch_labels = None
+depends_on = None
+
+VERSIONED_TABLES = ('actors', 'movies', 'ratings')
+
+
+def upgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+
+    if not inspector.get_pk_constraint('ratings')['constrained_columns']:
+        op.execute('DELETE FROM ratings WHERE "Movie_id" IS NULL OR "Actor_id" IS NULL')
+        if bind.dialect.name == 'postgresql':
+            op.execute('DELETE FROM ratings a USING ratings b '
+                       'WHERE a.ctid < b.ctid '
+                       'AND a."Movie_id" = b."Movie_id" AND a."Actor_id" = b."Actor_id"')
+        else:
+            op.execute('DELETE FROM ratings WHERE rowid NOT IN '
+                       '(SELECT MIN(rowid) FROM ratings GROUP BY "Movie_id", "Actor_id")')
+        with op.batch_alter_table('ratings') as batch_op:
+            batch_op.alter_column('Movie_id', existing_type=sa.Integer(), nullable=False)
+            batch_op.alter_column('Actor_id', existing_type=sa.Integer(), nullable=False)
+            batch_op.create_primary_key('ratings_pkey', ['Movie_id', 'Actor_id'])
+
+    if 'ix_ratings_actor_movie' not in {index['name'] for index in inspector.get_indexes('ratings')}:
+        op.create_index('ix_ratings_actor_movie', 'ratings', ['Actor_id', 'Movie_id'])
+
+    if 'table_versions' not in inspector.get_table_names():
+        table_versions = op.create_table(
+            'table_versions',
+            sa.Column('name', sa.String(), nullable=False),
+            sa.Column('version', sa.Integer(), nullable=False),
+            sa.Column('updated_at', sa.DateTime(), nullable=False),
+            sa.PrimaryKeyConstraint('name')
+        )
+        op.bulk_insert(table_versions, [
+            {'name': name, 'version': 0, 'updated_at': datetime.utcnow()}
+            for name in VERSIONED_TABLES
+        ])
+
+
+def downgrade():
+    op.drop_table('table_versions')
+    op.drop_index('ix_ratings_actor_movie', table_name='ratings')
+    with op.batch_alter_table('ratings') as batch_op:
+        batch_op.drop_constraint('ratings_pkey', type_='primary')
+        batch_op.alter_column('Movie_id', existing_type=sa.Integer(), nullable=True)
+        batch_op.alter_column('Actor_id', existing_type=sa.Integer(), nullable=True)
@@ -0,0 +1,57 @@
+"""ratings foreign keys cascade on delete
+
+Revision ID: a93f6d1e2b47
+Revises: e4a8c2b7d915
+Create Date: 2023-04-03 09:30:00.000000
+
+deleting an actor or a movie deletes its ratings in the same statement,
+the application no longer deletes them itself. sqlite cannot alter a
+foreign key, the table is rebuilt there.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a93f6d1e2b47'
+down_revision = 'e4a8c2b7d915'
+branch_labels = None
+depends_on = None
+
+REFERENCES = (('Movie_id', 'movies'), ('Actor_id', 'actors'))
+
+
+def ratings_table(ondelete):
+    return sa.Table(
+        'ratings', sa.MetaData(),
+        sa.Column('Movie_id', sa.Integer(), nullable=False),
+        sa.Column('Actor_id', sa.Integer(), nullable=False),
+        sa.Column('rating', sa.Float(), nullable=True),
+        sa.PrimaryKeyConstraint('Movie_id', 'Actor_id', name='ratings_pkey'),
+        *[sa.ForeignKeyConstraint([column], [f'{table}.id'], ondelete=ondelete)
+          for column, table in REFERENCES],
+        sa.Index('ix_ratings_actor_movie', 'Actor_id', 'Movie_id')
+    )
+
+
+def set_ondelete(ondelete):
+    bind = op.get_bind()
+    if bind.dialect.name == 'sqlite':
+        with op.batch_alter_table('ratings', recreate='always',
+                                  copy_from=ratings_table(ondelete)):
+            pass
+        return
+
+    for foreign_key in sa.inspect(bind).get_foreign_keys('ratings'):
+        op.drop_constraint(foreign_key['name'], 'ratings', type_='foreignkey')
+    for column, table in REFERENCES:
+        op.create_foreign_key(f'ratings_{column}_fkey', 'ratings', table, [column], ['id'],
+                              ondelete=ondelete)
+
+
+def upgrade():
+    set_ondelete('CASCADE')
+
+
+def downgrade():
+    set_ondelete(None)
@@ -0,0 +1,59 @@
+"""search indexes on actors and movies
+
+Revision ID: c7d93e2f4a61
+Revises: 8c4e51b0a7d2
+Create Date: 2023-03-01 10:10:00.000000
+
+B-tree indexes for the filters and sort orders of GET /actors and
+GET /movies. On postgres also trigram GIN indexes (pg_trgm) for substring
+search and GIN indexes over to_tsvector for full-text search, built
+CONCURRENTLY so writes are not blocked while a large table is indexed.
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7d93e2f4a61'
+down_revision = '8c4e51b0a7d2'
+branch_labels = None
+depends_on = None
+
+BTREE_INDEXES = (
+    ('ix_actors_name', 'actors', 'name'),
+    ('ix_actors_gender', 'actors', 'gender'),
+    ('ix_actors_age', 'actors', 'age'),
+    ('ix_movies_title', 'movies', 'title'),
+    ('ix_movies_release_date', 'movies', 'release_date')
+)
+
+# must match models.TEXT_SEARCH_CONFIG, or the full-text queries miss the index
+TEXT_SEARCH_CONFIG = 'simple'
+
+GIN_INDEXES = (
+    ('ix_actors_name_trgm', 'actors', 'name gin_trgm_ops'),
+    ('ix_actors_name_fts', 'actors', f"to_tsvector('{TEXT_SEARCH_CONFIG}', name)"),
+    ('ix_movies_title_trgm', 'movies', 'title gin_trgm_ops'),
+    ('ix_movies_title_fts', 'movies', f"to_tsvector('{TEXT_SEARCH_CONFIG}', title)")
+)
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        for name, table, column in BTREE_INDEXES:
+            op.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {table} ({column})')
+        return
+
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    with op.get_context().autocommit_block():
+        for name, table, column in BTREE_INDEXES:
+            op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({column})')
+        for name, table, expression in GIN_INDEXES:
+            op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} '
+                       f'ON {table} USING gin ({expression})')
+
+
+def downgrade():
+    for name, _, _ in GIN_INDEXES:
+        op.execute(f'DROP INDEX IF EXISTS {name}')
+    for name, _, _ in BTREE_INDEXES:
+        op.execute(f'DROP INDEX IF EXISTS {name}')
@@ -0,0 +1,49 @@
+"""jobs
+
+Revision ID: d51c7e8a3f26
+Revises: a93f6d1e2b47
+Create Date: 2023-04-10 10:00:00.000000
+
+bulk requests queued with Prefer: respond-async, the table doubles as the
+queue the workers of jobs.py claim them from.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd51c7e8a3f26'
+down_revision = 'a93f6d1e2b47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if 'jobs' in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.create_table(
+        'jobs',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('kind', sa.String(length=32), nullable=False),
+        sa.Column('permission', sa.String(length=64), nullable=False),
+        sa.Column('owner', sa.String(length=255), nullable=False),
+        sa.Column('status', sa.String(length=16), nullable=False),
+        sa.Column('items', sa.JSON(), nullable=True),
+        sa.Column('total', sa.Integer(), nullable=False),
+        sa.Column('processed', sa.Integer(), nullable=False),
+        sa.Column('succeeded', sa.Integer(), nullable=False),
+        sa.Column('errors', sa.JSON(), nullable=True),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.Column('worker', sa.String(length=64), nullable=True),
+        sa.Column('lease_expires_at', sa.DateTime(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('started_at', sa.DateTime(), nullable=True),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_jobs_status', 'jobs', ['status'])
+
+
+def downgrade():
+    op.drop_index('ix_jobs_status', table_name='jobs')
+    op.drop_table('jobs')
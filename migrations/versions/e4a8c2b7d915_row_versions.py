@@ -0,0 +1,34 @@
+"""row versions of actors and movies
+
+Revision ID: e4a8c2b7d915
+Revises: 5b2e9d4c1f08
+Create Date: 2023-03-27 11:00:00.000000
+
+version is bumped by every UPDATE of a row, PATCH compares it with the
+If-Match header. Existing rows start at version 1.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4a8c2b7d915'
+down_revision = '5b2e9d4c1f08'
+branch_labels = None
+depends_on = None
+
+VERSIONED_TABLES = ('actors', 'movies')
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    for table in VERSIONED_TABLES:
+        if 'version' not in {column['name'] for column in inspector.get_columns(table)}:
+            op.add_column(table, sa.Column('version', sa.Integer(), nullable=False,
+                                           server_default='1'))
+
+
+def downgrade():
+    for table in VERSIONED_TABLES:
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_column('version')
@@ -1,34 +1,320 @@
 import os
-from sqlalchemy import Column, String, create_engine
-from flask_sqlalchemy import SQLAlchemy
-from datetime import date
-from config import SQLALCHEMY_DATABASE_URI
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app
+from sqlalchemy import Column, DDL, String, and_, bindparam, create_engine, delete, event, exc, \
+    func, insert, literal_column, orm, select, true, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.pool import Pool, QueuePool
+from sqlalchemy.sql import Select
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from datetime import date, datetime
+from config import SQLALCHEMY_DATABASE_URI, engine_profiles
+
+def normalize_database_url(url):
+    if url.startswith("postgres://"):
+        return url.replace("postgres://", "postgresql://", 1)
+    return url
+
 
 if 'DATABASE_URL' in os.environ:
-    database_path = os.environ['DATABASE_URL']
-    if database_path.startswith("postgres://"):
-        database_path = database_path.replace("postgres://", "postgresql://", 1)
+    database_path = normalize_database_url(os.environ['DATABASE_URL'])
 else:
     database_path = SQLALCHEMY_DATABASE_URI
 
-db = SQLAlchemy()
+# read replicas of the database, comma separated, GET requests read from one of them
+replica_paths = [normalize_database_url(url.strip())
+                 for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+# seconds a client reads from the primary after a write, so it sees its own writes
+REPLICA_STICKY_SECONDS = float(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+# where those writes are remembered: 'redis' (shared by every worker, needs
+# REPLICA_STICKY_URL) or 'memory' (per process, for a single worker only)
+REPLICA_STICKY = os.environ.get('REPLICA_STICKY', 'redis' if os.environ.get('REPLICA_STICKY_URL') else 'memory')
+REPLICA_STICKY_URL = os.environ.get('REPLICA_STICKY_URL')
+
+# rows per INSERT statement in bulk_insert
+BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE', 1000))
+
+DB_ENGINE_PROFILE = os.environ.get('DB_ENGINE_PROFILE', 'web')
+
+# postgres text search configuration of the full-text indexes and queries
+TEXT_SEARCH_CONFIG = 'simple'
+
+'''
+RoutingSession
+    sends the SELECTs of a session marked by use_replica() to its replica
+    engine, writes and the reads of a flush stay on the primary
+'''
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        replica = self.info.get('replica')
+        if replica is not None and not self._flushing and isinstance(clause, Select):
+            return replica
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+MIGRATIONS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+
+'''
+PoolMetrics
+    time spent waiting for a pooled connection, recorded by InstrumentedQueuePool
+'''
+class PoolMetrics:
+    def __init__(self):
+        self.checkouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+        self._lock = threading.Lock()
+
+    def record(self, wait_seconds, timed_out=False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_seconds += wait_seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+
+
+pool_metrics = PoolMetrics()
+
+
+class InstrumentedQueuePool(QueuePool):
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            pool_metrics.record(time.perf_counter() - start, timed_out=True)
+            raise
+        pool_metrics.record(time.perf_counter() - start)
+        return connection
+
+
+'''
+get_engine_options(database_path, profile=DB_ENGINE_PROFILE)
+    SQLAlchemy engine options from a profile in config.engine_profiles
+    each setting can be overridden with its DB_<NAME> environment variable,
+    e.g. DB_POOL_SIZE or DB_STATEMENT_TIMEOUT (milliseconds, 0 disables)
+    sqlite keeps its default pool, the sizing options only apply to servers
+'''
+def get_engine_options(database_path, profile=DB_ENGINE_PROFILE):
+    settings = dict(engine_profiles[profile])
+    for name, default in settings.items():
+        value = os.environ.get('DB_' + name.upper())
+        if value is not None:
+            settings[name] = value.lower() in ('1', 'true', 'yes') \
+                if isinstance(default, bool) else int(value)
+
+    if database_path.startswith('sqlite'):
+        return {}
+
+    options = {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': settings['pool_size'],
+        'max_overflow': settings['max_overflow'],
+        'pool_timeout': settings['pool_timeout'],
+        'pool_recycle': settings['pool_recycle'],
+        'pool_pre_ping': settings['pool_pre_ping']
+    }
+    if settings['statement_timeout'] and database_path.startswith('postgresql'):
+        options['connect_args'] = {
+            'options': f"-c statement_timeout={settings['statement_timeout']}"
+        }
+    return options
+
+
+'''
+pool_status()
+    size, usage and saturation of the connection pool, plus checkout wait times
+'''
+def pool_status():
+    pool = db.engine.pool
+    status = {
+        'checkouts': pool_metrics.checkouts,
+        'checkout_timeouts': pool_metrics.timeouts,
+        'checkout_wait_seconds': pool_metrics.wait_seconds,
+        'checkout_max_wait_seconds': pool_metrics.max_wait_seconds
+    }
+    if isinstance(pool, QueuePool):
+        capacity = pool.size() + max(pool._max_overflow, 0)
+        status.update({
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'overflow': max(pool.overflow(), 0),
+            'saturation': pool.checkedout() / capacity if capacity else 0.0
+        })
+    return status
+
+
+# pre-fork servers (gunicorn) copy the parent's pool into every worker.
+# A connection opened in another process is discarded on checkout, so
+# workers never share a socket with their parent or with each other.
+@event.listens_for(Pool, 'connect')
+def record_connection_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+@event.listens_for(Pool, 'checkout')
+def check_connection_pid(dbapi_connection, connection_record, connection_proxy):
+    pid = os.getpid()
+    if connection_record.info.get('pid', pid) != pid:
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            'Connection record belongs to pid %s, attempting to check out in pid %s'
+            % (connection_record.info['pid'], pid))
+
+
+# sqlite leaves foreign keys unenforced unless every connection asks for
+# them, the ratings of a deleted actor or movie go with ON DELETE CASCADE
+@event.listens_for(Pool, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
 
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+    engine_options defaults to the DB_ENGINE_PROFILE pool settings
+    replica_paths are read replicas of database_path, each with a pool of
+    its own built from the same profile
 '''
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=database_path, engine_options=None, replica_paths=replica_paths):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+    app.config["SQLALCHEMY_REPLICA_URIS"] = list(replica_paths)
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    if engine_options is None:
+        engine_options = get_engine_options(database_path)
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options
+    app.extensions['replica_engines'] = [create_engine(path, **get_engine_options(path))
+                                         for path in replica_paths]
+    if replica_paths and sticky_clients.client is None:
+        app.logger.warning('read-your-writes only holds within each process with '
+                           'REPLICA_STICKY=memory, set REPLICA_STICKY_URL for several workers')
     db.app = app
     db.init_app(app)
-    db.create_all()
+    # the schema comes from `flask db upgrade`, not from every process start
+    if os.environ.get('FLASK_RUN_FROM_CLI'):
+        setup_migrate(app)
+
+
+'''
+setup_migrate(app)
+    registers Flask-Migrate for the `flask db` commands, setup_db does it
+    under the flask CLI only: alembic takes longer to import than the rest
+    of the app takes to start
+'''
+def setup_migrate(app):
+    from flask_migrate import Migrate
+    return Migrate(app, db, directory=MIGRATIONS_DIRECTORY)
+
+
+'''
+read replicas
+    use_replica() routes the reads of the current request's session to a
+    random replica, use_primary() takes them back, e.g. to fill a cache that
+    must not hold replica lag. Without replicas both do nothing.
+    sticky_clients remembers the token subjects that wrote in the last
+    REPLICA_STICKY_SECONDS, their reads stay on the primary. A read usually
+    lands on another worker than the write, with several workers the marks
+    must live in redis (REPLICA_STICKY=redis), the memory store only sees
+    the writes of its own process.
+'''
+def use_replica():
+    engines = current_app.extensions.get('replica_engines')
+    if engines:
+        db.session.info['replica'] = random.choice(engines)
+
+
+def use_primary():
+    db.session.info.pop('replica', None)
+
+
+'''
+read_engine()
+    the engine the current session reads from, its replica after
+    use_replica(), the primary otherwise, for reads on a connection of
+    their own such as the exports
+'''
+def read_engine():
+    return db.session.info.get('replica') or db.engine
+
+
+class StickyClients:
+    def __init__(self, seconds=REPLICA_STICKY_SECONDS, max_clients=100000, client=None,
+                 prefix='casting-agency:sticky:'):
+        self.seconds = seconds
+        self.max_clients = max_clients
+        # a redis-py client shares the marks between processes, they expire in redis
+        self.client = client
+        self.prefix = prefix
+        self._until = OrderedDict()
+        self._lock = threading.Lock()
+
+    def mark(self, subject):
+        if not subject or self.seconds <= 0:
+            return
+        if self.client is not None:
+            self.client.set(self.prefix + subject, 1, px=max(int(self.seconds * 1000), 1))
+            return
+        with self._lock:
+            self._until[subject] = time.monotonic() + self.seconds
+            self._until.move_to_end(subject)
+            # the oldest marks expire first
+            while len(self._until) > self.max_clients:
+                self._until.popitem(last=False)
+
+    def is_sticky(self, subject):
+        if not subject:
+            return False
+        if self.client is not None:
+            return bool(self.client.exists(self.prefix + subject))
+        with self._lock:
+            until = self._until.get(subject)
+            if until is None:
+                return False
+            if until <= time.monotonic():
+                del self._until[subject]
+                return False
+            return True
+
+
+'''
+create_sticky_clients(kind, url=None, seconds=REPLICA_STICKY_SECONDS)
+    kind is 'memory' or 'redis', the redis store needs the redis package
+    and a REPLICA_STICKY_URL
+'''
+def create_sticky_clients(kind, url=None, seconds=REPLICA_STICKY_SECONDS):
+    if kind == 'redis':
+        import redis
+        return StickyClients(seconds, client=redis.Redis.from_url(url))
+    return StickyClients(seconds)
+
+
+sticky_clients = create_sticky_clients(REPLICA_STICKY, REPLICA_STICKY_URL)
 
 
 def db_drop_and_create_all():
     db.drop_all()
     db.create_all()
     setup_default_records()
+    # versions restart from zero, nothing cached before the reset is valid
+    for listener in commit_listeners:
+        listener(VERSIONED_TABLES)
 
 def setup_default_records():
     actor = (Actor(
@@ -42,82 +328,511 @@ def setup_default_records():
         release_date=date.today()
     ))
 
+    actor.insert()
+    movie.insert()
+
     rating = Rating.insert().values(
         Movie_id=movie.id,
         Actor_id=actor.id,
         rating=3.0
     )
-
-    actor.insert()
-    movie.insert()
     db.session.execute(rating)
     db.session.commit()
 
+'''
+TableVersion
+    one row per table, bumped right after every transaction that wrote to
+    it so request hooks can tell whether a table changed with a single
+    primary key lookup instead of re-running the query
+'''
+class TableVersion(db.Model):
+    __tablename__ = 'table_versions'
+
+    name = Column(String, primary_key=True)
+    version = Column(db.Integer, nullable=False, default=0)
+    updated_at = Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+VERSIONED_TABLES = ('actors', 'movies', 'ratings')
+
+
+@event.listens_for(TableVersion.__table__, 'after_create')
+def create_table_versions(target, connection, **kw):
+    connection.execute(target.insert(), [
+        {'name': name, 'version': 0, 'updated_at': datetime.utcnow()}
+        for name in VERSIONED_TABLES
+    ])
+
+
+'''
+IdempotencyKey
+    the response of a POST sent with an Idempotency-Key header, keyed by the
+    token subject and the key, returned again to retries of that request
+    status_code and response stay empty while the first request runs
+'''
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+
+    owner = Column(String(255), primary_key=True)
+    key = Column(String(255), primary_key=True)
+    fingerprint = Column(String(64), nullable=False)
+    status_code = Column(db.Integer)
+    response = Column(db.LargeBinary)
+    created_at = Column(db.DateTime, nullable=False, index=True, default=datetime.utcnow)
+
+
+'''
+Job
+    a bulk request queued with Prefer: respond-async, drained by jobs.py
+    items holds the batch until the job is done, processed counts the items
+    already written, errors the first failed items of the batch
+    a running job belongs to worker until lease_expires_at, an expired
+    lease makes it claimable again and it resumes from processed
+'''
+class Job(db.Model):
+    __tablename__ = 'jobs'
+
+    id = Column(db.Integer, primary_key=True)
+    kind = Column(String(32), nullable=False)
+    permission = Column(String(64), nullable=False)
+    owner = Column(String(255), nullable=False)
+    status = Column(String(16), nullable=False, index=True, default='queued')
+    items = Column(db.JSON)
+    total = Column(db.Integer, nullable=False)
+    processed = Column(db.Integer, nullable=False, default=0)
+    succeeded = Column(db.Integer, nullable=False, default=0)
+    errors = Column(db.JSON)
+    error = Column(db.Text)
+    worker = Column(String(64))
+    lease_expires_at = Column(db.DateTime)
+    created_at = Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = Column(db.DateTime)
+    finished_at = Column(db.DateTime)
+
+    def format(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'total': self.total,
+            'processed': self.processed,
+            'succeeded': self.succeeded,
+            'failed': self.processed - self.succeeded,
+            'errors': self.errors or [],
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at
+        }
+
+
+'''
+on_commit(listener)
+    registers listener(tables), called after every commit that wrote to
+    tables through bump_version, once their versions are bumped, used to
+    invalidate caches
+'''
+commit_listeners = []
+
+
+def on_commit(listener):
+    commit_listeners.append(listener)
+    return listener
+
+
+@event.listens_for(db.session, 'after_commit')
+def notify_commit_listeners(session):
+    tables = session.info.pop('written_tables', None)
+    if tables:
+        try:
+            write_versions(tables)
+        except Exception:
+            # the data is committed, the caches below still drop its responses
+            current_app.logger.exception('could not bump the versions of %s', ', '.join(sorted(tables)))
+        for listener in commit_listeners:
+            listener(tables)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_written_tables(session):
+    session.info.pop('written_tables', None)
+
+
+'''
+bump_version(*tables)
+    marks tables as changed, the caller commits and their versions are
+    bumped once the commit went through
+'''
+def bump_version(*tables):
+    db.session.info.setdefault('written_tables', set()).update(tables)
+
+
+'''
+write_versions(tables)
+    bumps the versions of tables in a short transaction of its own on the
+    primary, after the commit of the writes. Inside the writer's transaction
+    the table_versions row lock would serialize every writer of a table
+    until it commits. A reader between the two commits keys its ETag and
+    cache entry on the old version: one extra miss later, never a stale hit.
+'''
+def write_versions(tables):
+    now = datetime.utcnow()
+    with db.engine.begin() as connection:
+        updated = connection.execute(
+            update(TableVersion.__table__)
+            .where(TableVersion.name.in_(tables))
+            .values(version=TableVersion.version + 1, updated_at=now)).rowcount
+        if updated < len(tables):
+            # tables created before table_versions existed
+            missing = set(tables) - {row.name for row in connection.execute(versions_query(tables))}
+            connection.execute(insert(TableVersion.__table__), [
+                {'name': name, 'version': 1, 'updated_at': now} for name in missing
+            ])
+
+
+def versions_query(tables):
+    return select(TableVersion.name, TableVersion.version, TableVersion.updated_at) \
+        .where(TableVersion.name.in_(tables))
+
+
+'''
+get_versions(tables)
+    returns {table: (version, updated_at)} in one query
+'''
+def get_versions(tables):
+    rows = db.session.execute(versions_query(tables))
+    return {row.name: (row.version, row.updated_at) for row in rows}
+
+
 # actor and movie is many_to_many relationship
+# the primary key serves lookups by movie, the reverse index lookups by actor
+# deleting an actor or a movie deletes its ratings in the database
 Rating = db.Table('ratings',
-    db.Column('Movie_id', db.Integer, db.ForeignKey('movies.id')),
-    db.Column('Actor_id', db.Integer, db.ForeignKey('actors.id')),
-    db.Column('rating', db.Float)
+    db.Column('Movie_id', db.Integer, db.ForeignKey('movies.id', ondelete='CASCADE'),
+              primary_key=True),
+    db.Column('Actor_id', db.Integer, db.ForeignKey('actors.id', ondelete='CASCADE'),
+              primary_key=True),
+    db.Column('rating', db.Float),
+    db.Index('ix_ratings_actor_movie', 'Actor_id', 'Movie_id')
 )
 class Actor(db.Model):
     __tablename__ = 'actors'
 
     id = Column(db.Integer, primary_key=True)
-    name = Column(String)
-    gender = Column(String)
-    age = Column(db.Integer)
+    name = Column(String, index=True)
+    gender = Column(String, index=True)
+    age = Column(db.Integer, index=True)
+    # bumped by every UPDATE, PATCH compares it with If-Match
+    version = Column(db.Integer, nullable=False, default=1, server_default='1')
 
     def __init__(self, name, gender, age):
         self.name = name
         self.gender = gender
         self.age = age
 
-    def insert(self):
+    def insert(self, commit=True):
         db.session.add(self)
-        db.session.commit()
+        bump_version(self.__tablename__)
+        if commit:
+            db.session.commit()
+        else:
+            # the id is needed before the caller commits
+            db.session.flush()
 
     def update(self):
+        self.version = self.version + 1
+        bump_version(self.__tablename__)
         db.session.commit()
 
     def delete(self):
         db.session.delete(self)
+        bump_version(self.__tablename__, 'ratings')
         db.session.commit()
 
-    def format(self):
-        return {
+    def format(self, include=()):
+        formatted = {
             'id': self.id,
             'name': self.name,
             'gender': self.gender,
             'age': self.age
         }
+        if 'movies' in include:
+            formatted['movies'] = [movie.format() for movie in self.ratings]
+        return formatted
 
 
 class Movie(db.Model):
     __tablename__ = 'movies'
 
     id = Column(db.Integer, primary_key=True)
-    title = Column(db.String)
-    release_date = Column(db.Date)
-    actors = db.relationship('Actor', secondary=Rating, backref=db.backref('ratings', lazy='joined'))
+    title = Column(db.String, index=True)
+    release_date = Column(db.Date, index=True)
+    # bumped by every UPDATE, PATCH compares it with If-Match
+    version = Column(db.Integer, nullable=False, default=1, server_default='1')
+    # relations are never loaded implicitly with the parent rows, endpoints
+    # that need them ask for a batched selectinload
+    actors = db.relationship('Actor', secondary=Rating, passive_deletes=True,
+                             backref=db.backref('ratings', lazy='select', passive_deletes=True))
 
     def __init__(self, title, release_date):
         self.title = title
         self.release_date = release_date
 
-    def insert(self):
+    def insert(self, commit=True):
         db.session.add(self)
-        db.session.commit()
+        bump_version(self.__tablename__)
+        if commit:
+            db.session.commit()
+        else:
+            # the id is needed before the caller commits
+            db.session.flush()
 
     def update(self):
+        self.version = self.version + 1
+        bump_version(self.__tablename__)
         db.session.commit()
 
     def delete(self):
         db.session.delete(self)
+        bump_version(self.__tablename__, 'ratings')
         db.session.commit()
 
-    def format(self):
-        return {
+    def format(self, include=()):
+        formatted = {
             'id': self.id,
             'title': self.title,
             'release_date': self.release_date
         }
+        if 'actors' in include:
+            formatted['actors'] = [actor.format() for actor in self.actors]
+        return formatted
+
+
+'''
+search indexes
+    postgres gets a trigram GIN index (pg_trgm) for ILIKE '%...%' substring
+    matches and a GIN index over to_tsvector for full-text search on the
+    actor name and the movie title. The migrations create them on existing
+    databases, these DDL events on databases built by create_all.
+'''
+SEARCH_COLUMNS = (('actors', 'name'), ('movies', 'title'))
+
+
+def search_index_ddl(table, column):
+    return [
+        'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+        f'CREATE INDEX IF NOT EXISTS ix_{table}_{column}_trgm '
+        f'ON {table} USING gin ({column} gin_trgm_ops)',
+        f'CREATE INDEX IF NOT EXISTS ix_{table}_{column}_fts '
+        f"ON {table} USING gin (to_tsvector('{TEXT_SEARCH_CONFIG}', {column}))"
+    ]
+
+
+for model, (table, column) in zip((Actor, Movie), SEARCH_COLUMNS):
+    for statement in search_index_ddl(table, column):
+        event.listen(model.__table__, 'after_create',
+                     DDL(statement).execute_if(dialect='postgresql'))
+
+
+def escape_like(value):
+    return value.replace('/', '//').replace('%', '/%').replace('_', '/_')
+
+
+'''
+contains_text(column, value)
+    case-insensitive substring match, served by the trigram index on postgres
+'''
+def contains_text(column, value):
+    return column.ilike('%' + escape_like(value) + '%', escape='/')
+
+
+'''
+matches_text(column, terms)
+    full-text match of every word in terms
+    postgres compares to_tsvector(column) with plainto_tsquery(terms) so the
+    GIN index applies, other databases require each word as a substring
+'''
+def matches_text(column, terms):
+    if db.engine.dialect.name == 'postgresql':
+        config = literal_column(f"'{TEXT_SEARCH_CONFIG}'")
+        return func.to_tsvector(config, column).op('@@')(func.plainto_tsquery(config, terms))
+    return and_(true(), *[contains_text(column, word) for word in terms.split()])
+
+
+'''
+bulk_insert(model, mappings, commit=True)
+    inserts all rows in a single transaction and returns their ids in order
+    postgres gets multi-row INSERT ... RETURNING id statements, other
+    databases fall back to one INSERT per row inside the same transaction
+    with commit=False the caller commits, jobs commit their progress with it
+'''
+def bulk_insert(model, mappings, commit=True):
+    if not mappings:
+        return []
+
+    table = model.__table__
+    if db.engine.dialect.name == 'postgresql':
+        ids = []
+        for start in range(0, len(mappings), BULK_CHUNK_SIZE):
+            chunk = mappings[start:start + BULK_CHUNK_SIZE]
+            result = db.session.execute(
+                insert(table).values(chunk).returning(table.c.id))
+            ids += [row.id for row in result]
+    else:
+        ids = [db.session.execute(insert(table).values(mapping)).inserted_primary_key[0]
+               for mapping in mappings]
+    bump_version(table.name)
+    if commit:
+        db.session.commit()
+    return ids
+
+
+'''
+existing_ids(model, ids)
+    returns the subset of ids that exist, in one query
+'''
+def existing_ids(model, ids):
+    if not ids:
+        return set()
+    return set(db.session.execute(
+        select(model.id).where(model.id.in_(ids))).scalars())
+
+
+'''
+bulk_update(model, mappings, commit=True)
+    applies every {'id': ..., field: value} mapping in a single transaction
+    returns the ids that were updated, mappings for unknown ids are skipped
+'''
+def bulk_update(model, mappings, commit=True):
+    found = existing_ids(model, [mapping['id'] for mapping in mappings])
+    table = model.__table__
+    # one executemany per set of updated fields, each row's version is bumped
+    groups = {}
+    for mapping in mappings:
+        if mapping['id'] in found:
+            names = tuple(sorted(name for name in mapping if name != 'id'))
+            groups.setdefault(names, []).append(mapping)
+    for names, group in groups.items():
+        statement = update(table).where(table.c.id == bindparam('b_id')).values(
+            version=table.c.version + 1, **{name: bindparam('b_' + name) for name in names})
+        db.session.execute(statement, [
+            {'b_' + name: value for name, value in mapping.items()} for mapping in group
+        ])
+    if found:
+        bump_version(model.__tablename__)
+    if commit:
+        db.session.commit()
+    return found
+
+
+'''
+update_versioned(model, row_id, fields, columns, versions=None)
+    updates one row and bumps its version with a single UPDATE, the caller
+    commits. With versions (from If-Match) the row is only updated while its
+    version is one of them.
+    returns the columns and the new version of the updated row, None when no
+    row matched. Postgres returns them with UPDATE ... RETURNING, other
+    databases select the row again in the same transaction.
+'''
+def update_versioned(model, row_id, fields, columns, versions=None):
+    table = model.__table__
+    statement = update(table).where(table.c.id == row_id) \
+        .values(version=table.c.version + 1, **fields)
+    if versions is not None:
+        statement = statement.where(table.c.version.in_(versions))
+
+    if db.engine.dialect.name == 'postgresql':
+        row = db.session.execute(statement.returning(*columns, table.c.version)).first()
+    elif db.session.execute(statement).rowcount:
+        row = db.session.execute(select(*columns, table.c.version).where(table.c.id == row_id)).first()
+    else:
+        row = None
+    if row is not None:
+        bump_version(model.__tablename__)
+    return row
+
+
+'''
+bulk_delete(model, ids, commit=True)
+    deletes the rows in one statement, their ratings go with ON DELETE CASCADE
+    returns the ids that were deleted, unknown ids are skipped
+'''
+def bulk_delete(model, ids, commit=True):
+    table = model.__table__
+    if not ids:
+        found = set()
+    elif db.engine.dialect.name == 'postgresql':
+        found = set(db.session.execute(
+            delete(table).where(table.c.id.in_(ids)).returning(table.c.id)).scalars())
+    else:
+        found = existing_ids(model, ids)
+        if found:
+            db.session.execute(delete(table).where(table.c.id.in_(found)))
+    if found:
+        bump_version(model.__tablename__, 'ratings')
+    if commit:
+        db.session.commit()
+    return found
+
+
+'''
+delete_row(model, row_id)
+    deletes one row in a single statement, its ratings go with ON DELETE
+    CASCADE, returns the deleted id or None when there is no such row
+    postgres answers with DELETE ... RETURNING, other databases with the rowcount
+'''
+def delete_row(model, row_id):
+    table = model.__table__
+    statement = delete(table).where(table.c.id == row_id)
+    if db.engine.dialect.name == 'postgresql':
+        deleted = db.session.execute(statement.returning(table.c.id)).scalar()
+    else:
+        deleted = int(row_id) if db.session.execute(statement).rowcount else None
+    if deleted is not None:
+        bump_version(model.__tablename__, 'ratings')
+    db.session.commit()
+    return deleted
+
+
+'''
+cast_actor(movie_id, actor_id, rating)
+    creates or updates the rating that links an actor to a movie
+    returns True when a new link was created
+    the link is inserted with INSERT ... ON CONFLICT DO NOTHING (postgres and
+    sqlite) and updated when it already existed, so two requests casting the
+    same pair at once both succeed instead of one failing on the primary key.
+    Other databases insert in a savepoint and update on an IntegrityError.
+'''
+def cast_actor(movie_id, actor_id, rating):
+    link = (Rating.c.Movie_id == movie_id) & (Rating.c.Actor_id == actor_id)
+    values = {'Movie_id': movie_id, 'Actor_id': actor_id, 'rating': rating}
+    dialect = db.engine.dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        dialect_insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        created = bool(db.session.execute(dialect_insert(Rating).values(values)
+                                          .on_conflict_do_nothing()).rowcount)
+    else:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(Rating.insert().values(values))
+            created = True
+        except exc.IntegrityError:
+            created = False
+    if not created:
+        db.session.execute(Rating.update().where(link).values(rating=rating))
+    bump_version('ratings')
+    db.session.commit()
+    return created
+
+
+'''
+uncast_actor(movie_id, actor_id)
+    removes an actor from a movie, returns False if they were not cast in it
+'''
+def uncast_actor(movie_id, actor_id):
+    link = (Rating.c.Movie_id == movie_id) & (Rating.c.Actor_id == actor_id)
+    deleted = db.session.execute(Rating.delete().where(link)).rowcount
+    if deleted:
+        bump_version('ratings')
+    db.session.commit()
+    return bool(deleted)
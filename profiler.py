@@ -0,0 +1,201 @@
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from flask import Response, abort, g, has_request_context, jsonify, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from auth import authorize, requires_auth
+
+'''
+Opt-in sampling profiler for single requests
+
+    a request sent with an "X-Profile: 1" header (or ?profile=1) by a token
+    holding PROFILE_PERMISSION is sampled: a background thread records the
+    request thread's stack every PROFILE_INTERVAL_MS, and every SQL statement
+    is added to a timeline. The profile is stored under PROFILE_DIR, its id
+    returned in the X-Profile-Id response header and served by
+    GET /profiles/<id> (JSON, or ?format=folded for flamegraph.pl/speedscope)
+
+    PROFILE_SAMPLE_RATE profiles that fraction of all requests without any
+    header, for continuous low-overhead profiling. Requests that are not
+    profiled only pay for the header check.
+'''
+
+PROFILE_PERMISSION = os.environ.get('PROFILE_PERMISSION', 'profile:requests')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0.0))
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', 1.0))
+PROFILE_DIR = os.environ.get('PROFILE_DIR',
+                             os.path.join(tempfile.gettempdir(), 'casting-agency-profiles'))
+# number of profiles kept on disk, the oldest are removed first
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', 100))
+
+PROFILE_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+'''
+StackSampler(thread_id, interval)
+    counts the stacks of one thread, sampled every interval seconds
+    folded() returns them in the collapsed "outer;inner count" format
+'''
+class StackSampler:
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[self._fold(frame)] += 1
+
+    @staticmethod
+    def _fold(frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def folded(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+'''
+ProfileStore(directory, keep)
+    one JSON file per profile, at most keep of them
+'''
+class ProfileStore:
+    def __init__(self, directory=PROFILE_DIR, keep=PROFILE_KEEP):
+        self.directory = directory
+        self.keep = keep
+
+    def path(self, profile_id):
+        return os.path.join(self.directory, profile_id + '.json')
+
+    def save(self, profile):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path(profile['id']), 'w') as profile_file:
+            json.dump(profile, profile_file)
+        self.prune()
+        return profile['id']
+
+    def load(self, profile_id):
+        if not PROFILE_ID.match(profile_id):
+            return None
+        try:
+            with open(self.path(profile_id)) as profile_file:
+                return json.load(profile_file)
+        except FileNotFoundError:
+            return None
+
+    def prune(self):
+        paths = [entry.path for entry in os.scandir(self.directory) if entry.name.endswith('.json')]
+        if len(paths) <= self.keep:
+            return
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:len(paths) - self.keep]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+profile_store = ProfileStore()
+
+
+def profile_requested():
+    return request.headers.get('X-Profile', request.args.get('profile')) in ('1', 'true')
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_profiled_statement(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and has_request_context() and g.get('profile') is not None:
+        context.profile_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_profiled_statement(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, 'profile_start', None)
+    if start is None or not has_request_context():
+        return
+    profile = g.get('profile')
+    if profile is not None:
+        profile['sql'].append({
+            'start_ms': (start - profile['start']) * 1000,
+            'duration_ms': (time.perf_counter() - start) * 1000,
+            'statement': statement
+        })
+
+
+'''
+setup_profiler(app)
+    adds the profiling request hooks and GET /profiles/<id> to app
+'''
+def setup_profiler(app):
+
+    @app.before_request
+    def start_profile():
+        if profile_requested():
+            # explicit requests need the permission, sampled ones are server policy
+            authorize(PROFILE_PERMISSION)
+        elif not PROFILE_SAMPLE_RATE or random.random() >= PROFILE_SAMPLE_RATE:
+            return None
+        g.profile = {'start': time.perf_counter(), 'sql': []}
+        g.profile_sampler = StackSampler(threading.get_ident(),
+                                         PROFILE_INTERVAL_MS / 1000).start()
+
+    @app.after_request
+    def finish_profile(response):
+        sampler = g.pop('profile_sampler', None)
+        if sampler is None:
+            return response
+        sampler.stop()
+        profile = g.pop('profile')
+        response.headers['X-Profile-Id'] = profile_store.save({
+            'id': uuid.uuid4().hex,
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'status': response.status_code,
+            'duration_ms': (time.perf_counter() - profile['start']) * 1000,
+            'interval_ms': PROFILE_INTERVAL_MS,
+            'samples': sum(sampler.stacks.values()),
+            'folded': sampler.folded(),
+            'sql': profile['sql']
+        })
+        return response
+
+    @app.teardown_request
+    def stop_profile_sampler(error):
+        # requests that failed before after_request still stop their sampler
+        sampler = g.pop('profile_sampler', None)
+        if sampler is not None:
+            sampler.stop()
+
+    @app.route('/profiles/<profile_id>', methods=['GET'])
+    @requires_auth(PROFILE_PERMISSION)
+    def get_profile(jwt, profile_id):
+        profile = profile_store.load(profile_id)
+        if profile is None:
+            abort(404)
+        if request.args.get('format') == 'folded':
+            return Response(profile['folded'], mimetype='text/plain')
+        return jsonify(dict(profile, success=True))
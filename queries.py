@@ -0,0 +1,182 @@
+import os
+from sqlalchemy import func, select
+from models import Actor, Movie, Rating, contains_text, matches_text
+from validators import ValidationError, parse_date
+
+'''
+Query building shared by the Flask views (app.py) and the ASGI handlers (asgi.py)
+
+    request arguments come in as a werkzeug MultiDict, invalid values raise
+    ValidationError(400). The functions accept an ORM Query as well as a Core
+    select, both have filter/order_by/limit/offset.
+'''
+
+PAGE_SIZE = int(os.environ.get('PAGE_SIZE', 10))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 100))
+
+# columns of the list responses, selected as row tuples instead of ORM objects
+ACTOR_COLUMNS = (Actor.id, Actor.name, Actor.gender, Actor.age)
+MOVIE_COLUMNS = (Movie.id, Movie.title, Movie.release_date)
+
+# query string filters of the list endpoints: argument -> (convert, condition)
+ACTOR_FILTERS = {
+    'name': (str, lambda value: contains_text(Actor.name, value)),
+    'q': (str, lambda value: matches_text(Actor.name, value)),
+    'gender': (str, lambda value: Actor.gender == value),
+    'min_age': (int, lambda value: Actor.age >= value),
+    'max_age': (int, lambda value: Actor.age <= value)
+}
+MOVIE_FILTERS = {
+    'title': (str, lambda value: contains_text(Movie.title, value)),
+    'q': (str, lambda value: matches_text(Movie.title, value)),
+    'released_after': (parse_date, lambda value: Movie.release_date >= value),
+    'released_before': (parse_date, lambda value: Movie.release_date <= value)
+}
+
+# ?sort= fields of the list endpoints
+ACTOR_SORT = {'id': Actor.id, 'name': Actor.name, 'gender': Actor.gender, 'age': Actor.age}
+MOVIE_SORT = {'id': Movie.id, 'title': Movie.title, 'release_date': Movie.release_date}
+
+
+'''
+query_arg(args, name, convert)
+    converts a query string argument, a value that does not convert is a
+    bad request, a missing or empty one is None
+'''
+def query_arg(args, name, convert=str):
+    value = args.get(name, '').strip()
+    if not value:
+        return None
+    try:
+        return convert(value)
+    except (ValueError, ValidationError):
+        raise ValidationError(400)
+
+
+'''
+search_criteria(args, filters)
+    the SQL criteria of the filters present in the request
+'''
+def search_criteria(args, filters):
+    criteria = []
+    for name, (convert, condition) in filters.items():
+        value = query_arg(args, name, convert)
+        if value is not None:
+            criteria.append(condition(value))
+    return criteria
+
+
+'''
+sort_order(args, model, fields)
+    reads ?sort=field,-field and returns the ORDER BY clauses, ending with
+    the primary key so pages stay stable between requests
+'''
+def sort_order(args, model, fields):
+    order_by = []
+    for name in args.get('sort', '').split(','):
+        if not name:
+            continue
+        column = fields.get(name.lstrip('-'))
+        if column is None:
+            raise ValidationError(400)
+        order_by.append(column.desc() if name.startswith('-') else column.asc())
+    return order_by + [model.id]
+
+
+def page_size(args):
+    limit = args.get('limit', PAGE_SIZE, type=int)
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+'''
+select_fields(args, columns)
+    the columns named by ?fields=a,b in their usual order, all of them
+    without it, only those are selected
+    id is always kept, the next page's cursor is built from it, unknown
+    names are a bad request
+'''
+def select_fields(args, columns):
+    names = {name for name in args.get('fields', '').split(',') if name}
+    if not names:
+        return columns
+    if not names <= {column.key for column in columns}:
+        raise ValidationError(400)
+    return tuple(column for column in columns if column.key == 'id' or column.key in names)
+
+
+'''
+paginate(args, query, model, filters, sort_fields)
+    applies the filters, the sort order and the page window to query
+    ?limit= sets the page size, capped at MAX_PAGE_SIZE
+    ?after=<id> selects keyset (cursor) mode, otherwise ?page= uses OFFSET
+    the id cursor only follows the primary key order, combined with
+    ?sort= it is a bad request
+    one extra row is fetched to know whether there is a next page, returns
+    the query, the page size and whether the page follows the primary key
+    order (an id cursor can continue it), to pass to split_page
+'''
+def paginate(args, query, model, filters, sort_fields):
+    limit = page_size(args)
+    after = args.get('after', None, type=int)
+
+    order_by = sort_order(args, model, sort_fields)
+    keyset = len(order_by) == 1
+    query = query.filter(*search_criteria(args, filters)).order_by(*order_by)
+    if after is not None:
+        if not keyset:
+            raise ValidationError(400)
+        query = query.filter(model.id > after)
+    else:
+        page = max(args.get('page', 1, type=int), 1)
+        query = query.offset((page - 1) * limit)
+    return query.limit(limit + 1), limit, keyset
+
+
+'''
+split_page(rows, limit, keyset)
+    returns the rows of the page and the cursor of the next page, if any
+    pages in ?sort= order have no cursor, paginate refuses ?after= with
+    ?sort=, they go on with ?page=
+'''
+def split_page(rows, limit, keyset):
+    next_cursor = rows[limit - 1].id if keyset and len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+ACTOR_MOVIE_COLUMNS = MOVIE_COLUMNS + (Rating.c.rating,)
+MOVIE_ACTOR_COLUMNS = ACTOR_COLUMNS + (Rating.c.rating,)
+# columns of the /actors/ratings and /movies/top rows, next to their aggregates
+ACTOR_RATING_COLUMNS = (Actor.id, Actor.name)
+MOVIE_RATING_COLUMNS = (Movie.id, Movie.title)
+
+
+def actor_movies_query(actor_id):
+    return select(*ACTOR_MOVIE_COLUMNS) \
+        .join(Rating, Rating.c.Movie_id == Movie.id) \
+        .where(Rating.c.Actor_id == actor_id) \
+        .order_by(Movie.id)
+
+
+def movie_actors_query(movie_id):
+    return select(*MOVIE_ACTOR_COLUMNS) \
+        .join(Rating, Rating.c.Actor_id == Actor.id) \
+        .where(Rating.c.Movie_id == movie_id) \
+        .order_by(Actor.id)
+
+
+'''
+rating_aggregates_query(args, model, rating_column, columns)
+    average rating and number of ratings per row of model, best first
+    computed by the database with GROUP BY, paginated with ?page= and ?limit=
+'''
+def rating_aggregates_query(args, model, rating_column, columns):
+    limit = page_size(args)
+    page = max(args.get('page', 1, type=int), 1)
+
+    average_rating = func.avg(Rating.c.rating).label('average_rating')
+    return select(*columns, average_rating, func.count(Rating.c.rating).label('ratings')) \
+        .join(Rating, rating_column == model.id) \
+        .where(Rating.c.rating.isnot(None)) \
+        .group_by(*columns) \
+        .order_by(average_rating.desc(), model.id) \
+        .offset((page - 1) * limit).limit(limit)
@@ -0,0 +1,136 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+'''
+Token bucket rate limiting per token subject and permission
+
+    every bucket holds up to `burst` tokens and refills at `rate` tokens per
+    second, a request takes one token or is refused with the seconds until
+    the next token is available
+
+    MemoryBucketBackend keeps the buckets in process memory, each worker
+    limits on its own
+    RedisBucketBackend shares them between workers, one atomic script per
+    request, through any client with the redis-py eval interface
+'''
+
+
+class MemoryBucketBackend:
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, now):
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + max(now - updated, 0) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            # the least recently used buckets are the fullest, dropping one refills it
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def size(self):
+        return len(self._buckets)
+
+
+TAKE_SCRIPT = '''
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(now - updated, 0) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+'''
+
+
+class RedisBucketBackend:
+    def __init__(self, client, prefix='casting-agency:rate:'):
+        self.client = client
+        self.prefix = prefix
+
+    def take(self, key, rate, burst, now):
+        # the wait comes back as a string, redis truncates lua numbers to integers
+        return float(self.client.eval(TAKE_SCRIPT, 1, self.prefix + key, rate, burst, now))
+
+    def size(self):
+        return None
+
+
+'''
+RateLimiter(backend, limits)
+    limits maps a permission to {'rate': per second, 'burst': tokens},
+    'default' covers the others
+    take(subject, permission) returns 0 or the seconds to wait before retrying
+    a limiter without backend is disabled and admits every request
+'''
+class RateLimiter:
+    def __init__(self, backend=None, limits=None):
+        self.backend = backend
+        self.limits = limits or {}
+        self.allowed = 0
+        self.limited = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    def take(self, subject, permission):
+        limit = self.limits.get(permission, self.limits.get('default'))
+        if not self.enabled or limit is None:
+            return 0.0
+        wait = self.backend.take(f'{subject}:{permission}', limit['rate'], limit['burst'],
+                                 time.time())
+        with self._lock:
+            if wait:
+                self.limited += 1
+            else:
+                self.allowed += 1
+        return wait
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'allowed': self.allowed,
+                'limited': self.limited,
+                'buckets': (self.backend.size() if self.enabled else 0) or 0
+            }
+
+
+def retry_after(wait):
+    return max(1, math.ceil(wait))
+
+
+'''
+create_rate_limiter(kind, limits, url=None, max_keys=100000)
+    kind is 'memory', 'redis' or 'none'
+    the redis backend needs the redis package and a RATE_LIMIT_URL
+'''
+def create_rate_limiter(kind, limits, url=None, max_keys=100000):
+    if kind == 'memory':
+        return RateLimiter(MemoryBucketBackend(max_keys), limits)
+    if kind == 'redis':
+        import redis
+        return RateLimiter(RedisBucketBackend(redis.Redis.from_url(url)), limits)
+    return RateLimiter(None, limits)
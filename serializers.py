@@ -0,0 +1,65 @@
+import json
+import os
+from datetime import date
+from flask import current_app
+from werkzeug.http import http_date
+from metrics import track
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+'''
+JSON encoding of the read responses
+
+    list endpoints select the columns they return as row tuples, rows_to_dicts
+    zips them with the column names and json_response encodes the payload with
+    orjson when it is installed, the standard library otherwise
+
+    JSON_DATE_FORMAT chooses how dates are written: 'http' keeps the
+    "Sun, 16 Feb 2023 00:00:00 GMT" format of Flask's jsonify, 'iso' writes
+    "2023-02-16" and lets orjson encode dates natively
+'''
+
+JSON_DATE_FORMAT = os.environ.get('JSON_DATE_FORMAT', 'http')
+
+
+def format_date(value):
+    if JSON_DATE_FORMAT == 'iso':
+        return value.isoformat()
+    return http_date(value)
+
+
+def _default(value):
+    if isinstance(value, date):
+        return format_date(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+'''
+dumps(payload)
+    encodes payload to JSON bytes
+'''
+def dumps(payload):
+    if orjson is not None:
+        if JSON_DATE_FORMAT == 'iso':
+            return orjson.dumps(payload, default=_default)
+        return orjson.dumps(payload, default=_default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+    return json.dumps(payload, default=_default, separators=(',', ':')).encode()
+
+
+'''
+rows_to_dicts(columns, rows)
+    one {name: value} dict per row tuple, names taken from the selected columns
+'''
+def rows_to_dicts(columns, rows):
+    # plain str: orjson rejects str subclasses such as sqlalchemy's quoted_name
+    names = [str(column.key) for column in columns]
+    return [dict(zip(names, row)) for row in rows]
+
+
+def json_response(payload, status=200):
+    with track('serialize'):
+        body = dumps(payload)
+    return current_app.response_class(body, status=status, mimetype='application/json')
@@ -1,11 +1,23 @@
+import gzip
+import threading
 import unittest
+from unittest import mock
 import json
+from contextlib import contextmanager
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+import auth
+import idempotency
 from app import create_app
-from models import setup_db, db_drop_and_create_all, Actor, Movie, Rating, db_drop_and_create_all
+from models import setup_db, db_drop_and_create_all, bulk_insert, db, Actor, Movie, Rating, db_drop_and_create_all, \
+    IdempotencyKey, StickyClients
 from config import bearer_tokens, SQLALCHEMY_TEST_DATABASE_URI
-from datetime import date
+from fake_jwks import FakeJWKSServer
+from profiler import ProfileStore
+from ratelimit import MemoryBucketBackend, RateLimiter
+from datetime import date, datetime, timedelta
 import os
+import tempfile
 
 if 'CASTING_ASSISTANT' in os.environ:
     CASTING_ASSISTANT = os.environ['CASTING_ASSISTANT']
@@ -303,6 +315,1139 @@ class AgencyTestCase(unittest.TestCase):
         self.assertEqual(data['message'], 'resource not found')
 
 
+'''
+count_queries()
+    collects the SQL statements sent to the database inside the with block
+'''
+@contextmanager
+def count_queries():
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+
+'''
+LocalAuthTestCase
+    runs against the test database like AgencyTestCase, but signs its own
+    tokens with the stand-in JWKS server from fake_jwks.py instead of using
+    the pre-issued Auth0 bearer tokens
+'''
+class LocalAuthTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.jwks_server = FakeJWKSServer().start()
+        cls.default_store = auth.jwks_store
+        auth.jwks_store = auth.JWKSKeyStore(cls.jwks_server.url)
+        cls.casting_assistant_auth_header = cls.jwks_server.auth_header('casting_assistant')
+        cls.casting_director_auth_header = cls.jwks_server.auth_header('casting_director')
+        cls.executive_producer_auth_header = cls.jwks_server.auth_header('executive_producer')
+
+    @classmethod
+    def tearDownClass(cls):
+        auth.jwks_store.stop()
+        auth.jwks_store = cls.default_store
+        cls.jwks_server.stop()
+
+    def setUp(self):
+        self.app = create_app()
+        self.client = self.app.test_client
+        setup_db(self.app, SQLALCHEMY_TEST_DATABASE_URI)
+        db_drop_and_create_all()
+
+    def tearDown(self):
+        db.session.remove()
+
+    @contextmanager
+    def assertMaxQueries(self, maximum):
+        with count_queries() as statements:
+            yield statements
+        self.assertLessEqual(len(statements), maximum, '\n'.join(statements))
+
+
+class PaginationTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for i in range(24):
+            db.session.add(Actor(name=f'Actor {i}', gender='Female', age=20 + i))
+        db.session.commit()
+
+    def test_limit_sets_page_size(self):
+        res = self.client().get('/actors?page=2&limit=5', headers=self.casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor['id'] for actor in data['actors']], [6, 7, 8, 9, 10])
+        self.assertEqual(data['next_cursor'], 10)
+
+    def test_limit_is_capped(self):
+        res = self.client().get('/actors?limit=100000', headers=self.casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['actors']), 25)
+        self.assertIsNone(data['next_cursor'])
+
+    def test_cursor_walks_every_actor_once(self):
+        seen = []
+        cursor = 0
+        while cursor is not None:
+            res = self.client().get(f'/actors?after={cursor}&limit=10',
+                                    headers=self.casting_assistant_auth_header)
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            seen += [actor['id'] for actor in data['actors']]
+            cursor = data['next_cursor']
+
+        self.assertEqual(seen, list(range(1, 26)))
+
+    def test_sorted_pages_have_no_cursor(self):
+        res = self.client().get('/actors?sort=-age&limit=5', headers=self.casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['actors']), 5)
+        self.assertIsNone(data['next_cursor'])
+
+    def test_error_404_cursor_past_last_actor(self):
+        res = self.client().get('/actors?after=25', headers=self.casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertFalse(data['success'])
+
+
+class QueryCountTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+        actors = [Actor(name=f'Actor {i}', gender='Male', age=30) for i in range(20)]
+        movies = [Movie(title=f'Movie {i}', release_date=date.today()) for i in range(20)]
+        for i, movie in enumerate(movies):
+            movie.actors = actors[i:i + 5]
+        db.session.add_all(actors + movies)
+        db.session.commit()
+        db.session.expire_all()
+
+    # read endpoints also look up the table versions for their ETag
+    # and writes bump them, one statement each
+
+    def test_list_views_do_not_load_relations(self):
+        with self.assertMaxQueries(2):
+            res = self.client().get('/actors?limit=20', headers=self.casting_assistant_auth_header)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('movies', json.loads(res.data)['actors'][0])
+
+        with self.assertMaxQueries(2):
+            res = self.client().get('/movies?limit=20', headers=self.casting_assistant_auth_header)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('actors', json.loads(res.data)['movies'][0])
+
+    def test_include_batches_relations(self):
+        with self.assertMaxQueries(3):
+            res = self.client().get('/actors?limit=20&include=movies',
+                                    headers=self.casting_assistant_auth_header)
+        actors = json.loads(res.data)['actors']
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(actors[5]['movies']), 5)
+
+        with self.assertMaxQueries(3):
+            res = self.client().get('/movies?limit=20&include=actors',
+                                    headers=self.casting_assistant_auth_header)
+        movies = json.loads(res.data)['movies']
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(movies[1]['actors']), 5)
+
+    def test_error_400_unknown_include(self):
+        res = self.client().get('/actors?include=salary', headers=self.casting_assistant_auth_header)
+        self.assertEqual(res.status_code, 400)
+
+    def test_write_endpoints_issue_bounded_queries(self):
+        requests = [
+            ('post', '/actors', {'name': 'New', 'age': 20, 'gender': 'Female'}, 3),
+            ('patch', '/actors/3', {'age': 31}, 4),
+            ('delete', '/actors/4', None, 3),
+            ('post', '/movies', {'title': 'New', 'release_date': '2023-02-16'}, 3),
+            ('patch', '/movies/3', {'title': 'Renamed'}, 4),
+            ('delete', '/movies/4', None, 3)
+        ]
+        for method, path, body, maximum in requests:
+            with self.assertMaxQueries(maximum):
+                res = getattr(self.client(), method)(
+                    path, json=body, headers=self.executive_producer_auth_header)
+            self.assertEqual(res.status_code, 200, path)
+
+
+class BulkTestCase(LocalAuthTestCase):
+
+    def test_bulk_create_actors(self):
+        actors = [{'name': f'Actor {i}', 'age': 20, 'gender': 'Male'} for i in range(500)]
+        actors[3] = {'name': 'No age', 'gender': 'Male'}
+
+        with self.assertMaxQueries(510):
+            res = self.client().post('/actors/bulk', json=actors,
+                                     headers=self.casting_director_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], 499)
+        self.assertEqual(data['results'][0], {'index': 0, 'success': True, 'id': 2})
+        self.assertEqual(data['results'][3]['error'], 422)
+        self.assertEqual(data['results'][4]['id'], 5)
+        self.assertEqual(Actor.query.count(), 500)
+
+    def test_bulk_create_movies(self):
+        movies = [{'title': 'Crisso Movie', 'release_date': '2023-02-16'},
+                  {'title': 'Bad date', 'release_date': 'soon'}]
+        res = self.client().post('/movies/bulk', json=movies,
+                                 headers=self.executive_producer_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['created'], 1)
+        self.assertEqual(data['results'][1]['message'], 'unprocessable')
+
+    def test_bulk_update_actors(self):
+        res = self.client().patch('/actors/bulk', json=[{'id': 1, 'age': 40}, {'id': 100, 'age': 40}],
+                                  headers=self.casting_director_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['updated'], 1)
+        self.assertEqual(data['results'][1]['error'], 404)
+        self.assertEqual(Actor.query.get(1).age, 40)
+
+    def test_bulk_delete_movies(self):
+        with self.assertMaxQueries(5):
+            res = self.client().delete('/movies/bulk', json=[1, 100, 'x'],
+                                       headers=self.executive_producer_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted'], 1)
+        self.assertEqual([result['success'] for result in data['results']], [True, False, False])
+        self.assertEqual(Movie.query.count(), 0)
+
+    def test_error_403_bulk_delete_movies(self):
+        res = self.client().delete('/movies/bulk', json=[1], headers=self.casting_director_auth_header)
+        self.assertEqual(res.status_code, 403)
+
+    def test_error_400_bulk_body_is_not_a_list(self):
+        res = self.client().post('/actors/bulk', json={'name': 'Aileen'},
+                                 headers=self.casting_director_auth_header)
+        self.assertEqual(res.status_code, 400)
+
+
+class CastingTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+        actors = [Actor(name=f'Actor {i}', gender='Male', age=30) for i in range(3)]
+        movies = [Movie(title=f'Movie {i}', release_date=date.today()) for i in range(3)]
+        db.session.add_all(actors + movies)
+        db.session.commit()
+        # actors 2-4 and movies 2-4, actor 1 is cast in movie 1 with a rating of 3
+        db.session.execute(Rating.insert(), [
+            {'Movie_id': 2, 'Actor_id': 2, 'rating': 5.0},
+            {'Movie_id': 2, 'Actor_id': 3, 'rating': 4.0},
+            {'Movie_id': 3, 'Actor_id': 2, 'rating': 2.0},
+            {'Movie_id': 4, 'Actor_id': 4, 'rating': None}
+        ])
+        db.session.commit()
+
+    def test_get_movie_actors(self):
+        with self.assertMaxQueries(2):
+            res = self.client().get('/movies/2/actors', headers=self.casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([(actor['id'], actor['rating']) for actor in data['actors']],
+                         [(2, 5.0), (3, 4.0)])
+
+    def test_get_actor_movies(self):
+        res = self.client().get('/actors/2/movies', headers=self.casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([movie['id'] for movie in data['movies']], [2, 3])
+
+    def test_error_404_get_actor_movies(self):
+        res = self.client().get('/actors/100/movies', headers=self.casting_assistant_auth_header)
+        self.assertEqual(res.status_code, 404)
+
+    def test_cast_and_fire_actor(self):
+        res = self.client().put('/movies/3/actors/3', json={'rating': 4.5},
+                                headers=self.casting_director_auth_header)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['created'])
+
+        res = self.client().put('/movies/3/actors/3', json={'rating': 1},
+                                headers=self.casting_director_auth_header)
+        self.assertFalse(json.loads(res.data)['created'])
+        res = self.client().get('/actors/3/movies', headers=self.casting_assistant_auth_header)
+        self.assertEqual(json.loads(res.data)['movies'][-1]['rating'], 1.0)
+
+        res = self.client().delete('/movies/3/actors/3', headers=self.casting_director_auth_header)
+        self.assertEqual(res.status_code, 200)
+        res = self.client().delete('/movies/3/actors/3', headers=self.casting_director_auth_header)
+        self.assertEqual(res.status_code, 404)
+
+    def test_concurrent_cast_of_the_same_pair_updates_the_link(self):
+        # another request commits the same link right before this one inserts it
+        raced = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('INSERT INTO ratings') and not raced:
+                raced.append(statement)
+                with db.engine.begin() as other:
+                    other.execute(Rating.insert().values(Movie_id=3, Actor_id=3, rating=2))
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            res = self.client().put('/movies/3/actors/3', json={'rating': 4.5},
+                                    headers=self.casting_director_auth_header)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertFalse(json.loads(res.data)['created'])
+        link = (Rating.c.Movie_id == 3) & (Rating.c.Actor_id == 3)
+        self.assertEqual(db.session.query(Rating.c.rating).filter(link).scalar(), 4.5)
+
+    def test_delete_actor_cascades_to_ratings(self):
+        with count_queries() as statements:
+            res = self.client().delete('/actors/2', headers=self.executive_producer_auth_header)
+
+        self.assertEqual(res.status_code, 200)
+        deletes = [statement for statement in statements if statement.startswith('DELETE')]
+        self.assertEqual(len(deletes), 1)
+        self.assertIn('actors', deletes[0])
+        self.assertEqual(db.session.query(Rating).filter(Rating.c.Actor_id == 2).count(), 0)
+        self.assertEqual(db.session.query(Rating).count(), 3)
+
+    def test_delete_movie_cascades_to_ratings(self):
+        res = self.client().delete('/movies/2', headers=self.executive_producer_auth_header)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(db.session.query(Rating).filter(Rating.c.Movie_id == 2).count(), 0)
+        res = self.client().delete('/movies/2', headers=self.executive_producer_auth_header)
+        self.assertEqual(res.status_code, 404)
+
+    def test_error_422_cast_actor_with_bad_rating(self):
+        res = self.client().put('/movies/3/actors/3', json={'rating': 11},
+                                headers=self.casting_director_auth_header)
+        self.assertEqual(res.status_code, 422)
+
+    def test_error_400_cast_actor_with_malformed_body(self):
+        res = self.client().put('/movies/1/actors/1', data='{"rating": 4.5',
+                                content_type='application/json',
+                                headers=self.casting_director_auth_header)
+        self.assertEqual(res.status_code, 400)
+        link = (Rating.c.Movie_id == 1) & (Rating.c.Actor_id == 1)
+        self.assertEqual(db.session.query(Rating.c.rating).filter(link).scalar(), 3.0)
+
+    def test_error_403_cast_actor(self):
+        res = self.client().put('/movies/3/actors/3', headers=self.casting_assistant_auth_header)
+        self.assertEqual(res.status_code, 403)
+
+    def test_average_rating_per_actor(self):
+        res = self.client().get('/actors/ratings', headers=self.casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([(actor['id'], actor['average_rating'], actor['ratings']) for actor in data['actors']],
+                         [(3, 4.0, 1), (2, 3.5, 2), (1, 3.0, 1)])
+
+    def test_top_movies(self):
+        res = self.client().get('/movies/top?limit=2', headers=self.casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([movie['id'] for movie in data['movies']], [2, 1])
+
+
+class ConditionalRequestTestCase(LocalAuthTestCase):
+
+    def get(self, path, **headers):
+        headers.update(self.casting_assistant_auth_header)
+        return self.client().get(path, headers=headers)
+
+    def test_unchanged_list_returns_304_without_loading_rows(self):
+        res = self.get('/actors?page=1')
+        etag = res.headers['ETag']
+        self.assertEqual(res.status_code, 200)
+        self.assertIsNotNone(res.headers.get('Last-Modified'))
+
+        with self.assertMaxQueries(1) as statements:
+            res = self.get('/actors?page=1', If_None_Match=etag)
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], etag)
+        self.assertEqual(res.data, b'')
+        self.assertIn('table_versions', statements[0])
+
+    def test_unauthenticated_request_is_refused_before_any_query(self):
+        etag = self.get('/actors?page=1').headers['ETag']
+
+        with count_queries() as statements:
+            res = self.client().get('/actors?page=1', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 401)
+        self.assertEqual(statements, [])
+
+    def test_write_changes_etag(self):
+        etag = self.get('/actors').headers['ETag']
+
+        self.client().patch('/actors/1', json={'age': 30}, headers=self.casting_director_auth_header)
+
+        res = self.get('/actors', If_None_Match=etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_versions_are_bumped_after_the_write_commits(self):
+        executed = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            executed.append((statement.split()[0], 'table_versions' in statement, conn.connection))
+
+        def commit(conn):
+            executed.append(('COMMIT', False, conn.connection))
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(db.engine, 'commit', commit)
+        try:
+            res = self.client().patch('/actors/1', json={'age': 30}, headers=self.casting_director_auth_header)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+            event.remove(db.engine, 'commit', commit)
+
+        self.assertEqual(res.status_code, 200)
+        write = next(i for i, (verb, versions, _) in enumerate(executed) if verb == 'UPDATE' and not versions)
+        bump = next(i for i, (verb, versions, _) in enumerate(executed) if verb == 'UPDATE' and versions)
+        write_commit = next(i for i in range(write, len(executed))
+                            if executed[i][0] == 'COMMIT' and executed[i][2] is executed[write][2])
+        self.assertLess(write_commit, bump)
+
+    def test_etag_depends_on_query_arguments(self):
+        self.assertNotEqual(self.get('/movies?limit=1').headers['ETag'],
+                            self.get('/movies?limit=2').headers['ETag'])
+
+    def test_if_modified_since(self):
+        last_modified = self.get('/movies').headers['Last-Modified']
+        res = self.get('/movies', If_Modified_Since=last_modified)
+        self.assertEqual(res.status_code, 304)
+
+    def test_error_401_conditional_request_without_token(self):
+        etag = self.get('/movies').headers['ETag']
+        res = self.client().get('/movies', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 401)
+
+
+class ResponseCacheTestCase(LocalAuthTestCase):
+
+    def get(self, path, headers=None):
+        return self.client().get(path, headers=headers or self.casting_assistant_auth_header)
+
+    def test_repeated_read_is_served_from_cache(self):
+        self.assertEqual(self.get('/movies').headers['X-Cache'], 'MISS')
+
+        with self.assertMaxQueries(1):
+            res = self.get('/movies')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['X-Cache'], 'HIT')
+        self.assertEqual(json.loads(res.data)['movies'][0]['id'], 1)
+
+    def test_write_invalidates_cached_pages(self):
+        self.get('/actors')
+        self.client().patch('/actors/1', json={'name': 'Renamed'}, headers=self.casting_director_auth_header)
+
+        res = self.get('/actors')
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertEqual(json.loads(res.data)['actors'][0]['name'], 'Renamed')
+
+        self.client().delete('/actors/1', headers=self.casting_director_auth_header)
+        self.assertEqual(self.get('/actors').status_code, 404)
+
+    def test_cache_key_includes_permissions(self):
+        self.get('/actors')
+        res = self.get('/actors', headers=self.executive_producer_auth_header)
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+
+    def test_error_401_cached_page_needs_token(self):
+        self.get('/actors')
+        res = self.client().get('/actors')
+        self.assertEqual(res.status_code, 401)
+
+
+class ExportTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+        bulk_insert(Actor, [{'name': f'Actor {i}', 'age': 20, 'gender': 'Male'} for i in range(2500)])
+
+    def test_export_actors_ndjson(self):
+        res = self.client().get('/actors/export', headers=self.casting_assistant_auth_header)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.is_streamed)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        lines = res.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 2501)
+        self.assertEqual(json.loads(lines[1]), {'id': 2, 'name': 'Actor 0', 'gender': 'Male', 'age': 20})
+
+    def test_export_movies_csv(self):
+        res = self.client().get('/movies/export?format=csv', headers=self.casting_assistant_auth_header)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/csv')
+        lines = res.get_data(as_text=True).splitlines()
+        self.assertEqual(lines[0], 'id,title,release_date')
+        self.assertEqual(lines[1], f'1,Aileen meets tiger,{date.today().isoformat()}')
+
+    def test_export_streams_in_chunks(self):
+        res = self.client().get('/actors/export', headers=self.casting_assistant_auth_header)
+        chunks = list(res.response)
+        self.assertEqual(len(chunks), 3)
+
+    def test_concurrent_exports_are_capped(self):
+        with mock.patch('export.export_slots', threading.BoundedSemaphore(1)):
+            first = self.client().get('/actors/export', headers=self.casting_assistant_auth_header)
+            self.assertEqual(first.status_code, 200)
+
+            res = self.client().get('/movies/export', headers=self.casting_assistant_auth_header)
+            self.assertEqual(res.status_code, 503)
+            self.assertEqual(res.headers['Retry-After'], '5')
+
+            # closing the response, read or not, frees its slot
+            first.close()
+            res = self.client().get('/movies/export', headers=self.casting_assistant_auth_header)
+            self.assertEqual(res.status_code, 200)
+            # and so does reading it to the end, once
+            res.get_data()
+            res.close()
+            for _ in range(2):
+                res = self.client().get('/movies/export', headers=self.casting_assistant_auth_header)
+                self.assertEqual(res.status_code, 200)
+                res.get_data()
+
+    def test_error_400_unknown_export_format(self):
+        res = self.client().get('/actors/export?format=xml', headers=self.casting_assistant_auth_header)
+        self.assertEqual(res.status_code, 400)
+
+    def test_error_401_export_without_token(self):
+        res = self.client().get('/actors/export')
+        self.assertEqual(res.status_code, 401)
+
+
+class CompressionTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+        bulk_insert(Actor, [{'name': f'Actor {i}', 'age': 20, 'gender': 'Male'} for i in range(100)])
+
+    def get(self, path, **headers):
+        return self.client().get(path, headers=dict(self.casting_assistant_auth_header, **headers))
+
+    def test_large_list_is_gzipped(self):
+        plain = self.get('/actors?limit=100')
+        res = self.get('/actors?limit=100', **{'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(gzip.decompress(res.data), plain.data)
+        self.assertLess(len(res.data) * 5, len(plain.data))
+        self.assertEqual(res.headers['X-Cache'], 'HIT')
+        self.assertEqual(res.headers['ETag'], plain.headers['ETag'])
+        self.assertTrue(res.headers['ETag'].startswith('W/'))
+
+    def test_weak_etag_returns_304(self):
+        etag = self.get('/actors?limit=100', **{'Accept-Encoding': 'gzip'}).headers['ETag']
+
+        res = self.get('/actors?limit=100', **{'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], etag)
+
+    def test_row_with_strong_etag_stays_plain(self):
+        actor = Actor(name='x' * 2000, gender='Male', age=20)
+        actor.insert()
+
+        res = self.get(f'/actors/{actor.id}', **{'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertEqual(res.headers['ETag'], '"1"')
+
+    def test_small_and_unaccepted_responses_stay_plain(self):
+        res = self.get('/actors?limit=2', **{'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', res.headers)
+
+        res = self.get('/actors?limit=100', **{'Accept-Encoding': 'identity'})
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+
+
+class SparseFieldsTestCase(LocalAuthTestCase):
+
+    def get(self, path):
+        return self.client().get(path, headers=self.casting_assistant_auth_header)
+
+    def test_fields_reach_the_select(self):
+        with count_queries() as statements:
+            res = self.get('/actors?fields=name')
+        actors = json.loads(res.data)['actors']
+
+        self.assertEqual(actors, [{'id': 1, 'name': 'aileen'}])
+        select_list = next(statement for statement in statements if 'FROM actors' in statement)
+        self.assertNotIn('gender', select_list.split('FROM')[0])
+
+    def test_id_is_always_kept_for_the_cursor(self):
+        res = self.get('/movies?fields=title&limit=1')
+        data = json.loads(res.data)
+
+        self.assertEqual(set(data['movies'][0]), {'id', 'title'})
+        self.assertIsNone(data['next_cursor'])
+
+    def test_fields_with_include(self):
+        res = self.get('/movies?fields=title&include=actors')
+        movie = json.loads(res.data)['movies'][0]
+
+        self.assertEqual(set(movie), {'id', 'title', 'actors'})
+
+    def test_export_fields(self):
+        res = self.get('/movies/export?format=csv&fields=title')
+        self.assertEqual(res.get_data(as_text=True).splitlines()[0], 'id,title')
+
+    def test_error_400_unknown_field(self):
+        self.assertEqual(self.get('/actors?fields=name,salary').status_code, 400)
+
+
+class SearchTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+        bulk_insert(Actor, [
+            {'name': 'Meryl Streep', 'age': 73, 'gender': 'Female'},
+            {'name': 'Tom Hanks', 'age': 66, 'gender': 'Male'},
+            {'name': 'Tom Holland', 'age': 26, 'gender': 'Male'},
+            {'name': '100% Real', 'age': 40, 'gender': 'Male'}
+        ])
+        bulk_insert(Movie, [
+            {'title': 'The Post', 'release_date': date(2017, 12, 22)},
+            {'title': 'Big', 'release_date': date(1988, 6, 3)},
+            {'title': 'Spider-Man: Homecoming', 'release_date': date(2017, 7, 7)}
+        ])
+
+    def get(self, path):
+        res = self.client().get(path, headers=self.casting_assistant_auth_header)
+        return res.status_code, json.loads(res.data)
+
+    def test_name_substring_is_case_insensitive(self):
+        status, data = self.get('/actors?name=tom h')
+
+        self.assertEqual(status, 200)
+        self.assertEqual([actor['name'] for actor in data['actors']], ['Tom Hanks', 'Tom Holland'])
+
+    def test_name_wildcards_are_literal(self):
+        status, data = self.get('/actors?name=%25')
+
+        self.assertEqual(status, 200)
+        self.assertEqual([actor['name'] for actor in data['actors']], ['100% Real'])
+
+    def test_full_text_matches_every_word(self):
+        status, data = self.get('/actors?q=holland tom')
+
+        self.assertEqual(status, 200)
+        self.assertEqual([actor['name'] for actor in data['actors']], ['Tom Holland'])
+
+    def test_gender_and_age_range(self):
+        status, data = self.get('/actors?gender=Male&min_age=30&max_age=70')
+
+        self.assertEqual(status, 200)
+        self.assertEqual([actor['name'] for actor in data['actors']], ['Tom Hanks', '100% Real'])
+
+    def test_sort_descending(self):
+        status, data = self.get('/actors?sort=-age&limit=3')
+
+        self.assertEqual(status, 200)
+        self.assertEqual([actor['age'] for actor in data['actors']], [73, 66, 40])
+
+    def test_movies_release_range_sorted_by_title(self):
+        status, data = self.get('/movies?released_after=2017-01-01&released_before=2017-12-31&sort=title')
+
+        self.assertEqual(status, 200)
+        self.assertEqual([movie['title'] for movie in data['movies']],
+                         ['Spider-Man: Homecoming', 'The Post'])
+
+    def test_movie_title_search(self):
+        status, data = self.get('/movies?title=post')
+
+        self.assertEqual(status, 200)
+        self.assertEqual([movie['title'] for movie in data['movies']], ['The Post'])
+
+    def test_filters_are_part_of_the_etag(self):
+        first = self.client().get('/actors?name=tom', headers=self.casting_assistant_auth_header)
+        second = self.client().get('/actors?name=meryl', headers=self.casting_assistant_auth_header)
+
+        self.assertNotEqual(first.headers['ETag'], second.headers['ETag'])
+
+    def test_error_404_nothing_matches(self):
+        status, data = self.get('/actors?name=nobody')
+
+        self.assertEqual(status, 404)
+        self.assertFalse(data['success'])
+
+    def test_error_400_invalid_filter_value(self):
+        self.assertEqual(self.get('/actors?min_age=old')[0], 400)
+        self.assertEqual(self.get('/movies?released_after=someday')[0], 400)
+
+    def test_error_400_unknown_sort_field(self):
+        self.assertEqual(self.get('/actors?sort=salary')[0], 400)
+
+    def test_error_400_cursor_with_sort(self):
+        self.assertEqual(self.get('/actors?sort=name&after=1')[0], 400)
+
+
+class MetricsTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+        token = self.jwks_server.sign(['read:metrics'], sub='metrics|scraper')
+        self.metrics_auth_header = {'Authorization': f'Bearer {token}'}
+
+    def metric(self, text, name):
+        for line in text.splitlines():
+            if line.startswith(name + ' '):
+                return float(line.split()[-1])
+        return None
+
+    def test_request_phases_are_recorded_per_route(self):
+        before = self.client().get('/metrics', headers=self.metrics_auth_header).get_data(as_text=True)
+        self.client().get('/movies', headers=self.casting_assistant_auth_header)
+        res = self.client().get('/metrics', headers=self.metrics_auth_header)
+        after = res.get_data(as_text=True)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/plain')
+        for name in ('http_request_duration_seconds_count{method="GET",route="/movies",status="200"}',
+                     'http_request_auth_seconds_count{method="GET",route="/movies"}',
+                     'http_request_serialize_seconds_count{method="GET",route="/movies"}',
+                     'http_request_sql_statements_count{method="GET",route="/movies"}'):
+            self.assertEqual(self.metric(after, name), (self.metric(before, name) or 0) + 1, name)
+        statements = self.metric(after, 'http_request_sql_statements_sum{method="GET",route="/movies"}') - \
+            (self.metric(before, 'http_request_sql_statements_sum{method="GET",route="/movies"}') or 0)
+        self.assertGreaterEqual(statements, 1)
+        self.assertIn('db_statement_duration_seconds_count{statement="SELECT"}', after)
+        self.assertIn('token_cache_hits', after)
+        self.assertIn('response_cache_hit_rate', after)
+
+    def test_metrics_token(self):
+        with mock.patch('metrics.METRICS_TOKEN', 'scrape-secret'):
+            self.assertEqual(self.client().get('/metrics').status_code, 401)
+            res = self.client().get('/metrics', headers={'Authorization': 'Bearer scrape-secret'})
+            self.assertEqual(res.status_code, 200)
+
+    def test_metrics_require_a_permission_by_default(self):
+        self.assertEqual(self.client().get('/metrics').status_code, 401)
+        res = self.client().get('/metrics', headers=self.casting_assistant_auth_header)
+        self.assertEqual(res.status_code, 403)
+
+    def test_public_metrics_are_opt_in(self):
+        with mock.patch('metrics.METRICS_PUBLIC', True):
+            self.assertEqual(self.client().get('/metrics').status_code, 200)
+
+
+class ProfilerTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        patcher = mock.patch('profiler.profile_store', ProfileStore(self.directory.name))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.directory.cleanup)
+        token = self.jwks_server.sign(['get:movies', 'edit:movies', 'profile:requests'])
+        self.profiling_auth_header = {'Authorization': f'Bearer {token}'}
+
+    def test_profiled_request_stores_stacks_and_sql_timeline(self):
+        res = self.client().patch('/movies/1', json={'title': 'Slow'},
+                                  headers=dict(self.profiling_auth_header, **{'X-Profile': '1'}))
+        self.assertEqual(res.status_code, 200)
+        profile_id = res.headers['X-Profile-Id']
+
+        res = self.client().get(f'/profiles/{profile_id}', headers=self.profiling_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['method'], 'PATCH')
+        self.assertEqual(data['path'], '/movies/1')
+        self.assertTrue(any(entry['statement'].startswith('UPDATE movies') for entry in data['sql']))
+        self.assertTrue(all(entry['duration_ms'] >= 0 for entry in data['sql']))
+
+        res = self.client().get(f'/profiles/{profile_id}?format=folded', headers=self.profiling_auth_header)
+        self.assertEqual(res.mimetype, 'text/plain')
+        self.assertEqual(res.get_data(as_text=True), data['folded'])
+
+    def test_requests_without_the_switch_are_not_profiled(self):
+        res = self.client().get('/movies', headers=self.profiling_auth_header)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('X-Profile-Id', res.headers)
+
+    def test_sample_rate_profiles_without_the_switch(self):
+        with mock.patch('profiler.PROFILE_SAMPLE_RATE', 1.0):
+            res = self.client().get('/movies', headers=self.casting_assistant_auth_header)
+
+        self.assertIn('X-Profile-Id', res.headers)
+
+    def test_error_403_profile_switch_without_permission(self):
+        res = self.client().get('/movies?profile=1', headers=self.casting_assistant_auth_header)
+
+        self.assertEqual(res.status_code, 403)
+        self.assertNotIn('X-Profile-Id', res.headers)
+
+    def test_error_404_unknown_profile(self):
+        res = self.client().get('/profiles/' + 'f' * 32, headers=self.profiling_auth_header)
+        self.assertEqual(res.status_code, 404)
+
+
+class IdempotencyTestCase(LocalAuthTestCase):
+
+    actor = {'name': 'Retried actor', 'gender': 'Female', 'age': 41}
+
+    def post(self, body, key='retry-1', headers=None):
+        headers = dict(headers or self.casting_director_auth_header, **{'Idempotency-Key': key})
+        return self.client().post('/actors', json=body, headers=headers)
+
+    def test_retry_returns_stored_response_without_insert(self):
+        first = self.post(self.actor)
+        count = Actor.query.count()
+
+        with self.assertMaxQueries(1):
+            retry = self.post(self.actor)
+
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(Actor.query.count(), count)
+
+    def test_keys_are_scoped_to_the_token_subject(self):
+        first = json.loads(self.post(self.actor).data)
+        other = json.loads(self.post(self.actor, headers=self.executive_producer_auth_header).data)
+
+        self.assertNotEqual(first['created'], other['created'])
+
+    def test_failed_request_releases_key(self):
+        self.assertEqual(self.post({'name': 'No age'}).status_code, 422)
+
+        res = self.post(self.actor)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Idempotent-Replayed', res.headers)
+
+    def test_expired_keys_are_compacted(self):
+        self.post(self.actor)
+        with mock.patch('idempotency.IDEMPOTENCY_TTL', -1):
+            self.assertEqual(idempotency.compact_keys(force=True), 1)
+            res = self.post(self.actor)
+
+        self.assertNotIn('Idempotent-Replayed', res.headers)
+
+    def test_error_409_request_still_running(self):
+        db.session.add(IdempotencyKey(owner='auth0|casting_director', key='retry-1',
+                                      fingerprint=self.fingerprint(self.actor)))
+        db.session.commit()
+
+        res = self.post(self.actor)
+        self.assertEqual(res.status_code, 409)
+
+    def test_insert_and_stored_response_commit_together(self):
+        count = Actor.query.count()
+        with mock.patch('idempotency.store_response', side_effect=RuntimeError('database went away')):
+            self.assertEqual(self.post(self.actor).status_code, 500)
+        db.session.remove()
+        self.assertEqual(Actor.query.count(), count)
+
+        res = self.post(self.actor)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(Actor.query.count(), count + 1)
+
+    def test_abandoned_reservation_is_taken_over_after_its_lease(self):
+        db.session.add(IdempotencyKey(owner='auth0|casting_director', key='retry-1',
+                                      fingerprint=self.fingerprint(self.actor),
+                                      created_at=datetime.utcnow() - timedelta(seconds=61)))
+        db.session.commit()
+
+        res = self.post(self.actor)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Idempotent-Replayed', res.headers)
+        self.assertEqual(self.post(self.actor).headers['Idempotent-Replayed'], 'true')
+
+    def test_error_422_key_reused_with_another_body(self):
+        self.post(self.actor)
+
+        res = self.post(dict(self.actor, age=42))
+        self.assertEqual(res.status_code, 422)
+
+    def fingerprint(self, body):
+        with self.app.test_request_context('/actors', method='POST', json=body):
+            return idempotency.request_fingerprint()
+
+
+class DetailTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+        db.session.add(Actor(name='Bob', gender='Male', age=40))
+        db.session.commit()
+        db.session.execute(Rating.insert().values(Movie_id=1, Actor_id=2, rating=4.5))
+        db.session.commit()
+
+    def get(self, path, **headers):
+        headers.update(self.casting_assistant_auth_header)
+        return self.client().get(path, headers=headers)
+
+    def test_get_actor(self):
+        res = self.get('/actors/1')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actor'], {'id': 1, 'name': 'aileen', 'gender': 'Female', 'age': 18})
+        self.assertEqual(res.headers['ETag'], '"1"')
+
+    def test_detail_is_one_primary_key_lookup(self):
+        with self.assertMaxQueries(1):
+            res = self.get('/actors/1')
+        self.assertEqual(res.status_code, 200)
+
+    def test_writes_of_other_processes_reach_the_detail(self):
+        self.get('/actors/1')
+        # straight through the engine, the commit hooks of this process never see it
+        with db.engine.begin() as connection:
+            connection.execute(Actor.__table__.update().where(Actor.id == 1).values(
+                age=50, version=Actor.version + 1))
+
+        res = self.get('/actors/1')
+        self.assertEqual(json.loads(res.data)['actor']['age'], 50)
+        self.assertEqual(res.headers['ETag'], '"2"')
+        self.assertEqual(self.get('/actors/1', If_None_Match='"1"').status_code, 200)
+
+        with db.engine.begin() as connection:
+            connection.execute(Actor.__table__.delete().where(Actor.id == 1))
+        self.assertEqual(self.get('/actors/1').status_code, 404)
+
+    def test_writes_reach_the_detail(self):
+        self.get('/actors/1')
+        self.client().patch('/actors/1', json={'age': 30}, headers=self.casting_director_auth_header)
+        res = self.get('/actors/1')
+        self.assertEqual(json.loads(res.data)['actor']['age'], 30)
+        self.assertEqual(res.headers['ETag'], '"2"')
+
+        self.client().patch('/actors/bulk', json=[{'id': 1, 'age': 31}],
+                            headers=self.casting_director_auth_header)
+        self.assertEqual(json.loads(self.get('/actors/1').data)['actor']['age'], 31)
+
+        self.client().delete('/actors/1', headers=self.executive_producer_auth_header)
+        self.assertEqual(self.get('/actors/1').status_code, 404)
+
+    def test_include_loads_the_cast_in_one_query(self):
+        # the movie and its cast
+        with self.assertMaxQueries(2):
+            res = self.get('/movies/1?include=actors')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([(actor['id'], actor['rating']) for actor in data['movie']['actors']],
+                         [(1, 3.0), (2, 4.5)])
+        self.assertNotIn('ETag', res.headers)
+
+        data = json.loads(self.get('/actors/2?include=movies').data)
+        self.assertEqual([movie['id'] for movie in data['actor']['movies']], [1])
+
+    def test_not_modified(self):
+        etag = self.get('/movies/1').headers['ETag']
+
+        res = self.get('/movies/1', If_None_Match=etag)
+        self.assertEqual(res.status_code, 304)
+
+    def test_error_404_unknown_actor(self):
+        self.assertEqual(self.get('/actors/100').status_code, 404)
+
+    def test_error_400_unknown_include(self):
+        self.assertEqual(self.get('/movies/1?include=crew').status_code, 400)
+
+    def test_error_401_get_movie(self):
+        self.assertEqual(self.client().get('/movies/1').status_code, 401)
+
+
+class OptimisticConcurrencyTestCase(LocalAuthTestCase):
+
+    def patch(self, path, body, **headers):
+        headers.update(self.casting_director_auth_header)
+        return self.client().patch(path, json=body, headers=headers)
+
+    def test_patch_updates_without_reading_the_row_first(self):
+        with self.assertMaxQueries(3) as statements:
+            res = self.patch('/actors/1', {'age': 30})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['ETag'], '"2"')
+        self.assertEqual(data['actor'], [{'id': 1, 'name': 'aileen', 'gender': 'Female', 'age': 30}])
+        self.assertTrue(statements[0].startswith('UPDATE actors'))
+
+    def test_matching_if_match_updates(self):
+        etag = self.patch('/movies/1', {'title': 'First cut'}).headers['ETag']
+
+        res = self.patch('/movies/1', {'title': 'Final cut'}, If_Match=etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['movie'][0]['title'], 'Final cut')
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_error_412_stale_if_match(self):
+        etag = self.patch('/actors/1', {'age': 30}).headers['ETag']
+        self.patch('/actors/1', {'age': 31})
+
+        res = self.patch('/actors/1', {'age': 99}, If_Match=etag)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 412)
+        self.assertEqual(data['message'], 'precondition failed')
+        self.assertEqual(db.session.get(Actor, 1).age, 31)
+
+    def test_error_412_after_bulk_update(self):
+        etag = self.patch('/actors/1', {'age': 30}).headers['ETag']
+        self.client().patch('/actors/bulk', json=[{'id': 1, 'age': 31}],
+                            headers=self.casting_director_auth_header)
+
+        self.assertEqual(self.patch('/actors/1', {'age': 99}, If_Match=etag).status_code, 412)
+
+    def test_error_404_if_match_unknown_actor(self):
+        res = self.patch('/actors/100', {'age': 30}, If_Match='"1"')
+        self.assertEqual(res.status_code, 404)
+
+
+class ReplicaTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        replica_path = os.environ.get('SQLALCHEMY_TEST_REPLICA_URI',
+                                      f'sqlite:///{self.directory.name}/replica.db')
+        self.app = create_app()
+        self.client = self.app.test_client
+        setup_db(self.app, SQLALCHEMY_TEST_DATABASE_URI, replica_paths=[replica_path])
+        db_drop_and_create_all()
+
+        # the replica holds other rows than the primary, reads show where they went
+        self.replica = self.app.extensions['replica_engines'][0]
+        db.metadata.drop_all(self.replica)
+        db.metadata.create_all(self.replica)
+        with self.replica.begin() as connection:
+            connection.execute(Actor.__table__.insert().values(name='replica', gender='Male', age=50))
+
+        for target, value in (('app.sticky_clients', StickyClients(60)),
+                              ('app.response_cache.backend', None)):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        super().tearDown()
+        self.replica.dispose()
+        self.directory.cleanup()
+
+    def actor_names(self, headers):
+        res = self.client().get('/actors', headers=headers)
+        return [actor['name'] for actor in json.loads(res.data)['actors']]
+
+    def test_reads_go_to_the_replica(self):
+        self.assertEqual(self.actor_names(self.casting_assistant_auth_header), ['replica'])
+
+    def test_exports_read_the_replica(self):
+        res = self.client().get('/actors/export', headers=self.casting_assistant_auth_header)
+        self.assertEqual([json.loads(line)['name'] for line in res.get_data(as_text=True).splitlines()],
+                         ['replica'])
+
+    def test_writer_reads_its_own_writes(self):
+        res = self.client().post('/actors', json={'name': 'New', 'age': 20, 'gender': 'Female'},
+                                 headers=self.executive_producer_auth_header)
+        self.assertEqual(res.status_code, 200)
+
+        self.assertEqual(self.actor_names(self.executive_producer_auth_header), ['aileen', 'New'])
+        self.assertEqual(self.actor_names(self.casting_assistant_auth_header), ['replica'])
+
+    def test_detail_reads_the_primary(self):
+        res = self.client().get('/actors/1', headers=self.casting_assistant_auth_header)
+        self.assertEqual(json.loads(res.data)['actor']['name'], 'aileen')
+
+
+class RateLimitTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+        limiter = RateLimiter(MemoryBucketBackend(), {'default': {'rate': 0.01, 'burst': 2}})
+        patcher = mock.patch('auth.rate_limiter', limiter)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_error_429_after_burst(self):
+        for _ in range(2):
+            self.assertEqual(self.client().get('/movies', headers=self.casting_assistant_auth_header).status_code, 200)
+
+        res = self.client().get('/movies', headers=self.casting_assistant_auth_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 429)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['message'], 'Too many requests.')
+        self.assertGreaterEqual(int(res.headers['Retry-After']), 1)
+
+    def test_buckets_per_subject_and_permission(self):
+        for _ in range(3):
+            self.client().get('/movies', headers=self.casting_assistant_auth_header)
+
+        self.assertEqual(self.client().get('/actors', headers=self.casting_assistant_auth_header).status_code, 200)
+        self.assertEqual(self.client().get('/movies', headers=self.casting_director_auth_header).status_code, 200)
+
+    def test_throttled_token_skips_signature_check(self):
+        headers = {'Authorization': 'Bearer ' + self.jwks_server.sign(['get:movies'], sub='auth0|fresh')}
+        for _ in range(2):
+            self.client().get('/movies', headers=headers)
+
+        with mock.patch('auth.decode_jwt') as decode_jwt:
+            res = self.client().get('/movies', headers=headers)
+        self.assertEqual(res.status_code, 429)
+        decode_jwt.assert_not_called()
+
+    def test_forged_claims_cannot_throttle_a_subject(self):
+        self.jwks_server.add_key('forger')
+        self.addCleanup(self.jwks_server.remove_key, 'forger')
+        forged = [{'Authorization': 'Bearer ' + self.jwks_server.sign(
+            ['get:movies'], sub='auth0|casting_assistant', signing_kid='forger', jti=str(i))}
+            for i in range(5)]
+        for header in forged:
+            self.assertEqual(self.client().get('/movies', headers=header).status_code, 400)
+
+        res = self.client().get('/movies', headers=self.casting_assistant_auth_header)
+        self.assertEqual(res.status_code, 200)
+
+    def test_replayed_forged_token_is_throttled_before_its_signature_check(self):
+        self.jwks_server.add_key('forger')
+        self.addCleanup(self.jwks_server.remove_key, 'forger')
+        headers = {'Authorization': 'Bearer ' + self.jwks_server.sign(
+            ['get:movies'], sub='auth0|casting_assistant', signing_kid='forger')}
+        for _ in range(2):
+            self.client().get('/movies', headers=headers)
+
+        with mock.patch('auth.decode_jwt') as decode_jwt:
+            res = self.client().get('/movies', headers=headers)
+        self.assertEqual(res.status_code, 429)
+        decode_jwt.assert_not_called()
+
+
 # Make the tests conveniently executable.
 # From app directory, run 'python test_app.py' to start tests
 if __name__ == "__main__":
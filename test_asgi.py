@@ -0,0 +1,187 @@
+import asyncio
+import json
+import tempfile
+import unittest
+from unittest import mock
+from datetime import date
+import httpx
+from sqlalchemy import create_engine
+from asgi import AsyncAgencyApp, AsyncJWKSKeyStore, async_database_url, get_async_engine_options
+from fake_jwks import FakeJWKSServer
+from models import db, Actor, Movie, StickyClients
+from ratelimit import MemoryBucketBackend, RateLimiter
+from test_app import LocalAuthTestCase
+
+
+class AsgiTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for i in range(12):
+            db.session.add(Actor(name=f'Actor {i}', gender='Female', age=20 + i))
+            db.session.add(Movie(title=f'Movie {i}', release_date=date(2020, 1, 1 + i)))
+        db.session.commit()
+
+        self.loop = asyncio.new_event_loop()
+        self.asgi_app = AsyncAgencyApp(self.app, AsyncJWKSKeyStore(self.jwks_server.url))
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.asgi_app.close())
+        self.loop.close()
+        super().tearDown()
+
+    def request(self, method, path, headers=None, **kwargs):
+        async def send():
+            transport = httpx.ASGITransport(app=self.asgi_app)
+            async with httpx.AsyncClient(transport=transport, base_url='http://localhost') as client:
+                return await client.request(method, path, headers=headers, **kwargs)
+        return self.loop.run_until_complete(send())
+
+    def get(self, path, headers=None):
+        return self.request('GET', path, headers=dict(headers or {}, **self.casting_assistant_auth_header))
+
+    def test_reads_match_the_flask_app(self):
+        for path in ('/actors?limit=5&sort=-age', '/movies?q=movie&page=2&limit=3',
+                     '/actors/1/movies', '/movies/1/actors', '/actors/ratings', '/movies/top'):
+            flask_res = self.client().get(path, headers=self.casting_assistant_auth_header)
+            res = self.get(path)
+
+            self.assertEqual(res.status_code, flask_res.status_code, path)
+            self.assertEqual(res.json(), json.loads(flask_res.data), path)
+            self.assertEqual(res.headers['ETag'], flask_res.headers['ETag'], path)
+            self.assertEqual(res.headers['Last-Modified'], flask_res.headers['Last-Modified'], path)
+
+    def test_sparse_fields_compressed(self):
+        for i in range(12, 100):
+            db.session.add(Actor(name=f'Actor {i}', gender='Female', age=20))
+        db.session.commit()
+        path = '/actors?limit=100&fields=name'
+
+        res = self.get(path, {'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertTrue(res.headers['ETag'].startswith('W/'))
+        self.assertEqual(res.json(), json.loads(self.client().get(
+            path, headers=self.casting_assistant_auth_header).data))
+        self.assertEqual(set(res.json()['actors'][0]), {'id', 'name'})
+
+    def test_flask_etag_returns_304(self):
+        etag = self.client().get('/movies', headers=self.casting_assistant_auth_header).headers['ETag']
+
+        res = self.get('/movies', {'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.content, b'')
+
+    def test_repeated_read_is_served_from_cache(self):
+        self.assertEqual(self.get('/actors').headers['X-Cache'], 'MISS')
+        self.assertEqual(self.get('/actors').headers['X-Cache'], 'HIT')
+
+    def test_writes_go_through_flask(self):
+        etag = self.get('/actors').headers['ETag']
+
+        res = self.request('POST', '/actors', headers=self.casting_director_auth_header,
+                           json={'name': 'New actor', 'gender': 'Male', 'age': 40})
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.json()['success'])
+
+        res = self.get('/actors?sort=-age&limit=1', {'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()['actors'][0]['name'], 'New actor')
+
+    def test_reads_go_to_the_replica_until_the_token_writes(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        replica_path = f'sqlite:///{directory.name}/replica.db'
+        replica = create_engine(replica_path)
+        db.metadata.create_all(replica)
+        with replica.begin() as connection:
+            connection.execute(Actor.__table__.insert().values(name='replica', gender='Male', age=50))
+        replica.dispose()
+        self.app.config['SQLALCHEMY_REPLICA_URIS'] = [replica_path]
+
+        with mock.patch('app.response_cache.backend', None), \
+                mock.patch('asgi.sticky_clients', StickyClients(60)) as sticky_clients:
+            self.assertEqual([actor['name'] for actor in self.get('/actors').json()['actors']],
+                             ['replica'])
+            sticky_clients.mark('auth0|casting_assistant')
+            self.assertEqual(len(self.get('/actors').json()['actors']), 10)
+
+    def test_export_streams_through_flask(self):
+        res = self.get('/actors/export')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(res.text.splitlines()), Actor.query.count())
+
+    def test_error_401_without_token(self):
+        res = self.request('GET', '/actors')
+
+        self.assertEqual(res.status_code, 401)
+        self.assertFalse(res.json()['success'])
+
+    def test_error_403_missing_permission(self):
+        token = self.jwks_server.sign(['get:movies'])
+        res = self.request('GET', '/actors/ratings', headers={'Authorization': f'Bearer {token}'})
+
+        self.assertEqual(res.status_code, 403)
+
+    def test_error_404_unknown_actor(self):
+        res = self.get('/actors/999/movies')
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(res.json()['message'], 'resource not found')
+
+    def test_error_429_with_retry_after(self):
+        limiter = RateLimiter(MemoryBucketBackend(), {'default': {'rate': 0.01, 'burst': 1}})
+        with mock.patch('auth.rate_limiter', limiter):
+            self.assertEqual(self.get('/movies').status_code, 200)
+            res = self.get('/movies')
+
+        self.assertEqual(res.status_code, 429)
+        self.assertGreaterEqual(int(res.headers['Retry-After']), 1)
+
+    def test_error_400_unknown_sort_field(self):
+        res = self.get('/movies?sort=budget')
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(res.json()['message'], 'bad request')
+
+
+class AsyncJWKSKeyStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.jwks_server = FakeJWKSServer().start()
+
+    def tearDown(self):
+        self.jwks_server.stop()
+
+    def test_concurrent_misses_fetch_once(self):
+        store = AsyncJWKSKeyStore(self.jwks_server.url)
+
+        async def get_keys():
+            keys = await asyncio.gather(*[store.get_key('test-key') for _ in range(20)])
+            store.stop()
+            return keys
+
+        keys = asyncio.run(get_keys())
+        self.assertTrue(all(key is not None for key in keys))
+        self.assertEqual(store.fetch_count, 1)
+        self.assertEqual(self.jwks_server.request_count, 1)
+
+
+class AsyncEngineOptionsTestCase(unittest.TestCase):
+
+    def test_async_drivers(self):
+        self.assertEqual(async_database_url('postgresql://user@localhost/agency'),
+                         'postgresql+asyncpg://user@localhost/agency')
+        self.assertEqual(async_database_url('sqlite:////tmp/agency.db'),
+                         'sqlite+aiosqlite:////tmp/agency.db')
+
+    def test_statement_timeout_is_a_server_setting(self):
+        options = get_async_engine_options('postgresql://user@localhost/agency')
+
+        self.assertNotIn('poolclass', options)
+        self.assertEqual(options['connect_args'], {'server_settings': {'statement_timeout': '5000'}})
+
+
+# From app directory, run 'python test_asgi.py' to start tests
+if __name__ == "__main__":
+    unittest.main()
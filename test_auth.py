@@ -0,0 +1,170 @@
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+from flask import Flask
+from jose import jwt
+import auth
+from auth import AuthError, JWKSKeyStore, VerifiedTokenCache, requires_auth, verify_decode_jwt
+from fake_jwks import FakeJWKSServer, ROLE_PERMISSIONS
+from ratelimit import RateLimiter
+
+jwks_server = None
+
+
+def setUpModule():
+    global jwks_server
+    jwks_server = FakeJWKSServer().start()
+
+
+def tearDownModule():
+    jwks_server.stop()
+
+
+class JWKSKeyStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.jwks_server = jwks_server
+        self.jwks_server.request_count = 0
+        self.default_store = auth.jwks_store
+        auth.jwks_store = JWKSKeyStore(self.jwks_server.url)
+
+    def tearDown(self):
+        auth.jwks_store.stop()
+        auth.jwks_store = self.default_store
+
+    def test_10k_requests_fetch_jwks_once(self):
+        token = self.jwks_server.sign(ROLE_PERMISSIONS['casting_assistant'])
+
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            payloads = list(executor.map(
+                lambda _: verify_decode_jwt(token), range(10000)))
+
+        self.assertEqual(len(payloads), 10000)
+        self.assertEqual(payloads[-1]['permissions'],
+                         ROLE_PERMISSIONS['casting_assistant'])
+        self.assertEqual(self.jwks_server.request_count, 1)
+        self.assertEqual(auth.jwks_store.fetch_count, 1)
+
+    def test_unknown_kid_refetches_rotated_keys(self):
+        auth.jwks_store.min_refetch_interval = 0
+        verify_decode_jwt(self.jwks_server.sign(['get:actors']))
+
+        self.jwks_server.add_key('rotated-key')
+        token = self.jwks_server.sign(['get:actors'], kid='rotated-key')
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda _: verify_decode_jwt(token), range(100)))
+
+        self.assertEqual(self.jwks_server.request_count, 2)
+        self.jwks_server.remove_key('rotated-key')
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        verify_decode_jwt(self.jwks_server.sign(['get:actors']))
+        token = self.jwks_server.sign(['get:actors'], kid='unknown-key',
+                                      signing_kid=self.jwks_server.kid)
+
+        for _ in range(100):
+            with self.assertRaises(AuthError) as context:
+                verify_decode_jwt(token)
+            self.assertEqual(context.exception.error['description'],
+                             'Unable to find the appropriate key.')
+
+        self.assertEqual(self.jwks_server.request_count, 1)
+
+
+class VerifiedTokenCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.default_store = auth.jwks_store
+        self.default_cache = auth.token_cache
+        self.default_limiter = auth.rate_limiter
+        auth.jwks_store = JWKSKeyStore(jwks_server.url)
+        auth.token_cache = VerifiedTokenCache(max_size=2, enabled=True)
+        auth.rate_limiter = RateLimiter(None)
+
+        self.app = Flask(__name__)
+
+        @self.app.route('/actors')
+        @requires_auth('get:actors')
+        def get_actors(payload):
+            return payload['sub']
+
+        @self.app.errorhandler(AuthError)
+        def auth_error(error):
+            return error.error['description'], error.status_code
+
+        self.client = self.app.test_client
+
+    def tearDown(self):
+        auth.jwks_store.stop()
+        auth.jwks_store = self.default_store
+        auth.token_cache = self.default_cache
+        auth.rate_limiter = self.default_limiter
+
+    def get_actors(self, token):
+        return self.client().get('/actors', headers={
+            'Authorization': f'Bearer {token}'
+        })
+
+    def test_warm_cache_skips_signature_verification(self):
+        token = jwks_server.sign(ROLE_PERMISSIONS['casting_assistant'])
+        self.assertEqual(self.get_actors(token).status_code, 200)
+
+        with mock.patch('jose.jwt.decode') as decode, \
+                mock.patch('jose.jwt.get_unverified_header') as get_header:
+            for _ in range(100):
+                self.assertEqual(self.get_actors(token).status_code, 200)
+        decode.assert_not_called()
+        get_header.assert_not_called()
+
+        stats = auth.token_cache.stats()
+        self.assertEqual(stats['hits'], 100)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_cached_token_still_checks_permissions(self):
+        token = jwks_server.sign(ROLE_PERMISSIONS['casting_assistant'])
+        self.get_actors(token)
+
+        @self.app.route('/movies', methods=['DELETE'])
+        @requires_auth('delete:movies')
+        def delete_movies(payload):
+            return ''
+
+        res = self.client().delete('/movies', headers={
+            'Authorization': f'Bearer {token}'
+        })
+        self.assertEqual(res.status_code, 403)
+
+    def test_entries_expire_with_token(self):
+        token = jwks_server.sign(['get:actors'], expires_in=60)
+        self.get_actors(token)
+        self.assertIsNotNone(auth.token_cache.get(token))
+
+        with mock.patch('auth.time.time', return_value=time.time() + 120):
+            self.assertIsNone(auth.token_cache.get(token))
+        self.assertEqual(auth.token_cache.stats()['size'], 0)
+
+    def test_size_limit_evicts_least_recently_used(self):
+        tokens = [jwks_server.sign(['get:actors'], sub=f'auth0|{i}')
+                  for i in range(3)]
+        for token in tokens:
+            self.get_actors(token)
+
+        self.assertEqual(auth.token_cache.stats()['size'], 2)
+        self.assertIsNone(auth.token_cache.get(tokens[0]))
+        self.assertIsNotNone(auth.token_cache.get(tokens[2]))
+
+    def test_disabled_cache_verifies_every_request(self):
+        auth.token_cache.enabled = False
+        token = jwks_server.sign(['get:actors'])
+
+        with mock.patch('jose.jwt.decode', wraps=jwt.decode) as decode:
+            for _ in range(3):
+                self.get_actors(token)
+        self.assertEqual(decode.call_count, 3)
+        self.assertEqual(auth.token_cache.stats()['size'], 0)
+
+
+# From app directory, run 'python test_auth.py' to start tests
+if __name__ == "__main__":
+    unittest.main()
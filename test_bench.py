@@ -0,0 +1,73 @@
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+from bench import NonEmptyDatabaseError, compare, run_benchmarks, run_serialization_benchmark, \
+    run_startup_check
+
+
+class BenchmarkTestCase(unittest.TestCase):
+
+    def test_compare_flags_throughput_drops_over_threshold(self):
+        baseline = {'list_actors': {'rps': 1000}, 'create_actor': {'rps': 100}}
+        results = {'list_actors': {'rps': 790}, 'create_actor': {'rps': 85},
+                   'list_movies': {'rps': 1}}
+
+        regressions = compare(results, baseline, threshold=0.2)
+
+        self.assertEqual(len(regressions), 1)
+        self.assertTrue(regressions[0].startswith('list_actors'))
+
+    def test_scenarios_run(self):
+        results = run_benchmarks(['auth', 'list_actors', 'update_actor'], requests=5)
+
+        self.assertEqual(set(results), {'auth', 'list_actors', 'update_actor'})
+        for result in results.values():
+            self.assertGreater(result['rps'], 0)
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+
+    def test_non_empty_database_is_kept_without_reset(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = f'{directory.name}/keep.db'
+        with sqlite3.connect(path) as connection:
+            connection.execute('CREATE TABLE actors (id INTEGER PRIMARY KEY, name TEXT)')
+            connection.execute("INSERT INTO actors (name) VALUES ('Keep me')")
+        database_url = os.environ.get('DATABASE_URL')
+
+        with self.assertRaises(NonEmptyDatabaseError):
+            run_benchmarks(['auth'], requests=1, database_url=f'sqlite:///{path}')
+        with sqlite3.connect(path) as connection:
+            self.assertEqual(connection.execute('SELECT name FROM actors').fetchall(), [('Keep me',)])
+
+        results = run_benchmarks(['auth'], requests=1, database_url=f'sqlite:///{path}',
+                                 reset_database=True)
+        self.assertGreater(results['auth']['rps'], 0)
+        self.assertEqual(os.environ.get('DATABASE_URL'), database_url)
+
+    def test_serialization_benchmark_runs(self):
+        results = run_serialization_benchmark(sizes=(50,), repeat=1)
+
+        self.assertEqual(set(results), {50})
+        self.assertGreater(results[50]['orm_ms'], 0)
+        self.assertGreater(results[50]['rows_ms'], 0)
+
+    def test_startup_check_leaves_alembic_and_jose_unloaded(self):
+        script = "import sys; import app; app.create_app(); " \
+                 "print(','.join(sorted({'alembic', 'jose'} & set(sys.modules))))"
+        output = subprocess.run([sys.executable, '-c', script], check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                stdout=subprocess.PIPE, text=True).stdout
+        self.assertEqual(output.splitlines()[-1], '')
+
+        results = run_startup_check(runs=1)
+        self.assertEqual(set(results), {'import_ms', 'create_app_ms', 'first_request_ms',
+                                        'total_ms', 'modules', 'process_ms'})
+        self.assertLessEqual(results['import_ms']['min'], results['total_ms']['min'])
+
+
+# From app directory, run 'python test_bench.py' to start tests
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import time
+import unittest
+from unittest import mock
+from cache import LRUCacheBackend, RedisCacheBackend, ResponseCache
+
+
+'''
+FakeRedis
+    in-memory stand-in for the subset of the redis-py client the cache uses
+'''
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def sadd(self, key, *members):
+        self.data.setdefault(key, set()).update(members)
+
+    def smembers(self, key):
+        return set(self.data.get(key, set()))
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+
+class CacheBackendTestCase(unittest.TestCase):
+
+    def backends(self):
+        return [LRUCacheBackend(max_size=10), RedisCacheBackend(FakeRedis())]
+
+    def test_set_and_get(self):
+        for backend in self.backends():
+            backend.set('actors:1', b'[]', 60, tags=('actors',))
+            self.assertEqual(backend.get('actors:1'), b'[]')
+            self.assertIsNone(backend.get('actors:2'))
+
+    def test_invalidate_drops_tagged_entries_only(self):
+        for backend in self.backends():
+            backend.set('actors:1', b'actors', 60, tags=('actors',))
+            backend.set('casting:1', b'casting', 60, tags=('actors', 'ratings'))
+            backend.set('movies:1', b'movies', 60, tags=('movies',))
+
+            backend.invalidate({'actors'})
+
+            self.assertIsNone(backend.get('actors:1'))
+            self.assertIsNone(backend.get('casting:1'))
+            self.assertEqual(backend.get('movies:1'), b'movies')
+
+    def test_lru_evicts_least_recently_used(self):
+        backend = LRUCacheBackend(max_size=2)
+        backend.set('a', b'a', 60)
+        backend.set('b', b'b', 60)
+        backend.get('a')
+        backend.set('c', b'c', 60)
+
+        self.assertIsNone(backend.get('b'))
+        self.assertEqual(backend.get('a'), b'a')
+        self.assertEqual(backend.size(), 2)
+
+    def test_lru_entries_expire(self):
+        backend = LRUCacheBackend()
+        with mock.patch('cache.time.monotonic', return_value=0):
+            backend.set('a', b'a', 60)
+        with mock.patch('cache.time.monotonic', return_value=61):
+            self.assertIsNone(backend.get('a'))
+
+    def test_lru_tag_index_stays_bounded(self):
+        backend = LRUCacheBackend(max_size=10)
+        for i in range(1000):
+            backend.set(f'actors:{i}', b'[]', 60, tags=('actors', 'ratings'))
+        with mock.patch('cache.time.monotonic', return_value=time.monotonic() + 61):
+            for i in range(990, 995):
+                self.assertIsNone(backend.get(f'actors:{i}'))
+        backend.invalidate({'ratings'})
+
+        self.assertEqual(backend.size(), 0)
+        self.assertEqual(backend._tags, {})
+
+        for i in range(1000):
+            backend.set(f'actors:{i}', b'[]', 60, tags=('actors',))
+        self.assertEqual({tag: len(keys) for tag, keys in backend._tags.items()}, {'actors': 10})
+
+    def test_hit_rate(self):
+        cache = ResponseCache(LRUCacheBackend())
+        cache.set('a', b'a')
+        cache.get('a')
+        cache.get('a')
+        cache.get('b')
+
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']), (2, 1, 1))
+        self.assertAlmostEqual(stats['hit_rate'], 2 / 3)
+
+
+# From app directory, run 'python test_cache.py' to start tests
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import gzip
+import unittest
+from unittest import mock
+import compression
+from compression import compress, compressible, negotiate_encoding
+
+
+class NegotiateEncodingTestCase(unittest.TestCase):
+
+    @unittest.skipIf(compression.brotli is None, 'brotli is not installed')
+    def test_brotli_wins_a_tie(self):
+        self.assertEqual(negotiate_encoding('gzip, deflate, br'), 'br')
+
+    def test_client_weights_win(self):
+        self.assertEqual(negotiate_encoding('br;q=0.5, gzip'), 'gzip')
+        self.assertEqual(negotiate_encoding('gzip;q=0.5, *;q=0.1'), 'gzip')
+
+    def test_gzip_without_brotli(self):
+        with mock.patch('compression.brotli', None):
+            self.assertEqual(negotiate_encoding('br, gzip;q=0.1'), 'gzip')
+            self.assertIsNone(negotiate_encoding('br'))
+
+    def test_identity(self):
+        self.assertIsNone(negotiate_encoding(None))
+        self.assertIsNone(negotiate_encoding('identity, deflate'))
+
+
+class CompressTestCase(unittest.TestCase):
+
+    body = b'{"id":1,"name":"Actor"}' * 100
+
+    def test_gzip_is_deterministic(self):
+        self.assertEqual(gzip.decompress(compress(self.body, 'gzip')), self.body)
+        self.assertEqual(compress(self.body, 'gzip'), compress(self.body, 'gzip'))
+
+    @unittest.skipIf(compression.brotli is None, 'brotli is not installed')
+    def test_brotli(self):
+        self.assertEqual(compression.brotli.decompress(compress(self.body, 'br')), self.body)
+
+    def test_threshold_and_mimetypes(self):
+        self.assertTrue(compressible('application/json', compression.COMPRESSION_MIN_SIZE))
+        self.assertFalse(compressible('application/json', compression.COMPRESSION_MIN_SIZE - 1))
+        self.assertFalse(compressible('image/png', 10 ** 6))
+        with mock.patch('compression.COMPRESSION_ENABLED', False):
+            self.assertFalse(compressible('application/json', 10 ** 6))
+
+
+# From app directory, run 'python test_compression.py' to start tests
+if __name__ == "__main__":
+    unittest.main()
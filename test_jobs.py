@@ -0,0 +1,175 @@
+import json
+import os
+import subprocess
+import sys
+import time
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+import jobs
+from jobs import JobWorkerPool, claim_job, run_job, run_next_job
+from models import db, Actor, Job, Movie
+from test_app import SQLALCHEMY_TEST_DATABASE_URI, LocalAuthTestCase
+
+
+class JobTestCase(LocalAuthTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # jobs run when the test calls run_next_job, no worker threads
+        for name, value in (('JOB_WORKERS', 0), ('JOB_CHUNK_SIZE', 2)):
+            patcher = mock.patch.object(jobs, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def queue(self, method, path, items, headers=None):
+        headers = dict(headers or self.executive_producer_auth_header, Prefer='respond-async')
+        return getattr(self.client(), method)(path, json=items, headers=headers)
+
+    def get_job(self, job_id, headers=None):
+        return self.client().get(f'/jobs/{job_id}', headers=headers or self.executive_producer_auth_header)
+
+    def actors(self, count):
+        return [{'name': f'Actor {i}', 'age': 30, 'gender': 'Male'} for i in range(count)]
+
+    def test_bulk_request_is_queued(self):
+        items = self.actors(5)
+        items[3] = {'name': 'No age'}
+        res = self.queue('post', '/actors/bulk', items)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 202)
+        self.assertTrue(res.headers['Location'].endswith(f"/jobs/{data['job_id']}"))
+        job = json.loads(self.get_job(data['job_id']).data)['job']
+        self.assertEqual((job['status'], job['total'], job['processed']), ('queued', 5, 0))
+        self.assertEqual(Actor.query.count(), 1)
+
+        self.assertTrue(run_next_job('test'))
+        job = json.loads(self.get_job(data['job_id']).data)['job']
+        self.assertEqual((job['status'], job['processed'], job['succeeded'], job['failed']),
+                         ('done', 5, 4, 1))
+        self.assertEqual([(error['index'], error['error']) for error in job['errors']], [(3, 422)])
+        self.assertEqual(Actor.query.count(), 5)
+        self.assertFalse(run_next_job('test'))
+
+    def test_queued_update_and_delete(self):
+        res = self.queue('patch', '/movies/bulk', [{'id': 1, 'title': 'Renamed'}, {'id': 100, 'title': 'x'}])
+        update_job = json.loads(res.data)['job_id']
+        res = self.queue('delete', '/actors/bulk', [1, 100])
+        delete_job = json.loads(res.data)['job_id']
+        while run_next_job('test'):
+            pass
+
+        self.assertEqual(json.loads(self.get_job(update_job).data)['job']['succeeded'], 1)
+        self.assertEqual(json.loads(self.get_job(delete_job).data)['job']['succeeded'], 1)
+        self.assertEqual(db.session.get(Movie, 1).title, 'Renamed')
+        self.assertEqual(Actor.query.count(), 0)
+
+    def test_chunks_commit_with_the_job_progress(self):
+        job_id = json.loads(self.queue('post', '/actors/bulk', self.actors(5)).data)['job_id']
+        insert = jobs.job_handlers['actors.insert']
+        calls = []
+
+        def fail_second_chunk(items):
+            calls.append(items)
+            if len(calls) == 2:
+                insert(items)
+                raise RuntimeError('database went away')
+            return insert(items)
+
+        with mock.patch.dict(jobs.job_handlers, {'actors.insert': fail_second_chunk}):
+            run_next_job('test')
+        job = json.loads(self.get_job(job_id).data)['job']
+
+        self.assertEqual((job['status'], job['processed'], job['error']),
+                         ('failed', 2, 'database went away'))
+        self.assertEqual(Actor.query.count(), 3)
+
+    def test_expired_lease_resumes_on_another_worker(self):
+        job_id = json.loads(self.queue('post', '/actors/bulk', self.actors(3)).data)['job_id']
+        self.assertEqual(claim_job('a'), job_id)
+        self.assertIsNone(claim_job('b'))
+
+        db.session.query(Job).filter(Job.id == job_id).update(
+            {'lease_expires_at': datetime.utcnow() - timedelta(seconds=1)})
+        db.session.commit()
+        self.assertEqual(claim_job('b'), job_id)
+
+        self.assertFalse(run_job(job_id, 'a'))
+        self.assertTrue(run_job(job_id, 'b'))
+        self.assertEqual(Actor.query.count(), 4)
+
+    def test_worker_pool_drains_the_queue(self):
+        pool = JobWorkerPool(self.app, workers=2, poll_interval=0.05).start()
+        self.addCleanup(pool.stop)
+        job_ids = [json.loads(self.queue('post', '/movies/bulk', [
+            {'title': f'Movie {i}', 'release_date': '2023-02-16'} for i in range(4)
+        ]).data)['job_id'] for _ in range(3)]
+
+        deadline = time.monotonic() + 10
+        statuses = []
+        while time.monotonic() < deadline:
+            statuses = [json.loads(self.get_job(job_id).data)['job']['status'] for job_id in job_ids]
+            if statuses == ['done'] * 3:
+                break
+            time.sleep(0.05)
+
+        self.assertEqual(statuses, ['done'] * 3)
+        self.assertEqual(Movie.query.count(), 13)
+
+    def test_worker_command_runs_the_queued_jobs(self):
+        job_id = json.loads(self.queue('post', '/actors/bulk', self.actors(3)).data)['job_id']
+        db.session.remove()
+
+        env = dict(os.environ, DATABASE_URL=SQLALCHEMY_TEST_DATABASE_URI, JOB_POLL_INTERVAL='0.05')
+        worker = subprocess.Popen([sys.executable, 'jobs.py', '--workers', '1'], env=env,
+                                  cwd=os.path.dirname(os.path.abspath(__file__)),
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.addCleanup(worker.wait)
+        self.addCleanup(worker.kill)
+
+        deadline = time.monotonic() + 30
+        status = None
+        while time.monotonic() < deadline and worker.poll() is None:
+            status = db.session.get(Job, job_id).status
+            db.session.remove()
+            if status in ('done', 'failed'):
+                break
+            time.sleep(0.05)
+
+        job = json.loads(self.get_job(job_id).data)['job']
+        self.assertEqual((job['status'], job['succeeded'], job['error']), ('done', 3, None))
+        self.assertEqual(Actor.query.count(), 4)
+
+    def test_error_404_job_of_another_token(self):
+        job_id = json.loads(self.queue('post', '/actors/bulk', self.actors(1)).data)['job_id']
+
+        res = self.get_job(job_id, self.casting_director_auth_header)
+        self.assertEqual(res.status_code, 404)
+
+    def test_error_403_job_without_its_permission(self):
+        job_id = json.loads(self.queue('delete', '/actors/bulk', [1]).data)['job_id']
+
+        res = self.get_job(job_id, self.casting_assistant_auth_header)
+        self.assertEqual(res.status_code, 403)
+
+    def test_error_404_unknown_job(self):
+        self.assertEqual(self.get_job(100).status_code, 404)
+
+    def test_error_401_job_without_token(self):
+        job_id = json.loads(self.queue('post', '/actors/bulk', self.actors(1)).data)['job_id']
+
+        self.assertEqual(self.client().get(f'/jobs/{job_id}').status_code, 401)
+        self.assertEqual(self.client().get('/jobs/100').status_code, 401)
+        forged = {'Authorization': 'Bearer not-a-token'}
+        self.assertEqual(self.get_job(job_id, forged).status_code, self.get_job(100, forged).status_code)
+
+    def test_error_403_queue_without_permission(self):
+        res = self.queue('delete', '/movies/bulk', [1], self.casting_director_auth_header)
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(Job.query.count(), 0)
+
+
+# From app directory, run 'python test_jobs.py' to start tests
+if __name__ == "__main__":
+    unittest.main()
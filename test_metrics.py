@@ -0,0 +1,49 @@
+import unittest
+from metrics import Histogram, MetricsRegistry
+
+
+class HistogramTestCase(unittest.TestCase):
+
+    def test_buckets_are_cumulative(self):
+        histogram = Histogram('latency_seconds', 'Latency', ('route',), buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.7, 3.0):
+            histogram.observe(value, '/actors')
+
+        lines = histogram.render()
+
+        self.assertIn('# TYPE latency_seconds histogram', lines)
+        self.assertIn('latency_seconds_bucket{route="/actors",le="0.1"} 1', lines)
+        self.assertIn('latency_seconds_bucket{route="/actors",le="1.0"} 3', lines)
+        self.assertIn('latency_seconds_bucket{route="/actors",le="+Inf"} 4', lines)
+        self.assertIn('latency_seconds_sum{route="/actors"} 4.25', lines)
+        self.assertIn('latency_seconds_count{route="/actors"} 4', lines)
+
+    def test_boundary_value_falls_in_its_bucket(self):
+        histogram = Histogram('statements', 'Statements', buckets=(1, 2))
+        histogram.observe(1)
+
+        self.assertIn('statements_bucket{le="1"} 1', histogram.render())
+
+    def test_label_values_are_escaped(self):
+        histogram = Histogram('latency_seconds', 'Latency', ('route',))
+        histogram.observe(0.1, 'a "quoted"\\path')
+
+        self.assertIn('latency_seconds_count{route="a \\"quoted\\"\\\\path"} 1', histogram.render())
+
+
+class MetricsRegistryTestCase(unittest.TestCase):
+
+    def test_stats_are_rendered_as_gauges(self):
+        registry = MetricsRegistry()
+        registry.register_stats('cache', lambda: {'hits': 3, 'enabled': True, 'backend': 'lru'})
+
+        text = registry.render()
+
+        self.assertIn('cache_hits 3\n', text)
+        self.assertIn('cache_enabled 1\n', text)
+        self.assertNotIn('backend', text)
+
+
+# From app directory, run 'python test_metrics.py' to start tests
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,182 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+import flask_migrate
+from flask import Flask
+from sqlalchemy import create_engine, exc, inspect, text
+import models
+from models import InstrumentedQueuePool, StickyClients, get_engine_options
+
+
+class EngineOptionsTestCase(unittest.TestCase):
+
+    def test_profile_settings(self):
+        options = get_engine_options('postgresql://localhost/agency', 'worker')
+
+        self.assertIs(options['poolclass'], InstrumentedQueuePool)
+        self.assertEqual(options['pool_size'], 2)
+        self.assertEqual(options['max_overflow'], 0)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertEqual(options['connect_args'], {'options': '-c statement_timeout=60000'})
+
+    def test_environment_overrides_profile(self):
+        with mock.patch.dict(os.environ, {'DB_POOL_SIZE': '20',
+                                          'DB_POOL_PRE_PING': 'false',
+                                          'DB_STATEMENT_TIMEOUT': '0'}):
+            options = get_engine_options('postgresql://localhost/agency', 'web')
+
+        self.assertEqual(options['pool_size'], 20)
+        self.assertFalse(options['pool_pre_ping'])
+        self.assertNotIn('connect_args', options)
+
+    def test_sqlite_keeps_default_pool(self):
+        self.assertEqual(get_engine_options('sqlite:///agency.db', 'web'), {})
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.engine = create_engine(
+            f'sqlite:///{self.directory.name}/pool.db',
+            poolclass=InstrumentedQueuePool, pool_size=1, max_overflow=0, pool_timeout=0.1)
+        models.pool_metrics = models.PoolMetrics()
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.directory.cleanup()
+
+    def test_connections_are_not_reused_across_fork(self):
+        with self.engine.connect() as connection:
+            parent_connection = connection.connection.connection
+
+        with mock.patch('models.os.getpid', return_value=os.getpid() + 1):
+            with self.engine.connect() as connection:
+                child_connection = connection.connection.connection
+                connection.execute(text('SELECT 1'))
+
+        self.assertIsNot(child_connection, parent_connection)
+        # the parent's connection is left open for the parent
+        parent_connection.execute('SELECT 1')
+
+    def test_checkout_wait_and_timeouts_are_recorded(self):
+        with self.engine.connect():
+            with self.assertRaises(exc.TimeoutError):
+                self.engine.connect()
+
+        self.assertEqual(models.pool_metrics.checkouts, 1)
+        self.assertEqual(models.pool_metrics.timeouts, 1)
+        self.assertGreaterEqual(models.pool_metrics.max_wait_seconds, 0.1)
+
+
+'''
+FakeRedis
+    the set/exists subset of the redis-py client, expiries are recorded
+'''
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+        self.expiry = {}
+
+    def set(self, key, value, px=None):
+        self.data[key] = value
+        self.expiry[key] = px
+
+    def exists(self, key):
+        return int(key in self.data)
+
+
+class StickyClientsTestCase(unittest.TestCase):
+
+    def test_subject_is_sticky_until_the_window_ends(self):
+        clients = StickyClients(seconds=5)
+        with mock.patch('models.time.monotonic', return_value=100):
+            clients.mark('auth0|writer')
+            self.assertTrue(clients.is_sticky('auth0|writer'))
+            self.assertFalse(clients.is_sticky('auth0|reader'))
+        with mock.patch('models.time.monotonic', return_value=105):
+            self.assertFalse(clients.is_sticky('auth0|writer'))
+
+    def test_oldest_marks_are_dropped(self):
+        clients = StickyClients(seconds=5, max_clients=2)
+        for subject in ('a', 'b', 'c'):
+            clients.mark(subject)
+
+        self.assertEqual([clients.is_sticky(subject) for subject in ('a', 'b', 'c')],
+                         [False, True, True])
+
+    def test_anonymous_requests_are_never_sticky(self):
+        clients = StickyClients()
+        clients.mark(None)
+        self.assertFalse(clients.is_sticky(None))
+
+    def test_redis_marks_are_seen_by_every_worker(self):
+        client = FakeRedis()
+        writer, reader = StickyClients(seconds=5, client=client), StickyClients(seconds=5, client=client)
+        writer.mark('auth0|writer')
+
+        self.assertTrue(reader.is_sticky('auth0|writer'))
+        self.assertFalse(reader.is_sticky('auth0|reader'))
+        self.assertEqual(client.expiry['casting-agency:sticky:auth0|writer'], 5000)
+        client.data.clear()
+        self.assertFalse(reader.is_sticky('auth0|writer'))
+
+
+class MigrationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = Flask(__name__)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{self.directory.name}/migrate.db'
+        self.app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        models.db.init_app(self.app)
+        models.setup_migrate(self.app)
+        self.context = self.app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        models.db.engine.dispose()
+        self.context.pop()
+        self.directory.cleanup()
+
+    def test_upgrade_creates_schema_and_search_indexes(self):
+        flask_migrate.upgrade()
+        inspector = inspect(models.db.engine)
+
+        self.assertEqual(inspector.get_pk_constraint('ratings')['constrained_columns'],
+                         ['Movie_id', 'Actor_id'])
+        self.assertTrue({'table_versions', 'jobs'} <= set(inspector.get_table_names()))
+        self.assertEqual({foreign_key['options'].get('ondelete')
+                          for foreign_key in inspector.get_foreign_keys('ratings')}, {'CASCADE'})
+        self.assertIn('ix_idempotency_keys_created_at',
+                      {index['name'] for index in inspector.get_indexes('idempotency_keys')})
+        self.assertTrue({'ix_actors_name', 'ix_actors_gender', 'ix_actors_age'} <=
+                        {index['name'] for index in inspector.get_indexes('actors')})
+        self.assertTrue({'ix_movies_title', 'ix_movies_release_date'} <=
+                        {index['name'] for index in inspector.get_indexes('movies')})
+
+    def test_upgrade_removes_duplicate_and_dangling_ratings(self):
+        flask_migrate.upgrade(revision='3f1a2c7d9b10')
+        with models.db.engine.begin() as connection:
+            connection.execute(text("INSERT INTO actors (id, name) VALUES (1, 'a')"))
+            connection.execute(text("INSERT INTO movies (id, title) VALUES (1, 'm')"))
+            connection.execute(text('INSERT INTO ratings ("Movie_id", "Actor_id", rating) '
+                                    'VALUES (1, 1, 3), (1, 1, 3), (1, NULL, 2)'))
+
+        flask_migrate.upgrade()
+        with models.db.engine.connect() as connection:
+            rows = connection.execute(text('SELECT "Movie_id", "Actor_id" FROM ratings')).all()
+
+        self.assertEqual(rows, [(1, 1)])
+
+    def test_downgrade_to_base(self):
+        flask_migrate.upgrade()
+        flask_migrate.downgrade(revision='base')
+
+        self.assertEqual(inspect(models.db.engine).get_table_names(), ['alembic_version'])
+
+
+# From app directory, run 'python test_models.py' to start tests
+if __name__ == "__main__":
+    unittest.main()
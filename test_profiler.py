@@ -0,0 +1,62 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from profiler import ProfileStore, StackSampler
+
+
+def busy_loop(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+class StackSamplerTestCase(unittest.TestCase):
+
+    def test_samples_are_folded_outermost_first(self):
+        stop = threading.Event()
+        worker = threading.Thread(target=busy_loop, args=(stop,))
+        worker.start()
+        sampler = StackSampler(worker.ident, 0.001).start()
+        time.sleep(0.05)
+        sampler.stop()
+        stop.set()
+        worker.join()
+
+        folded = sampler.folded()
+        self.assertGreater(sum(sampler.stacks.values()), 0)
+        stack, count = folded.splitlines()[0].rsplit(' ', 1)
+        self.assertTrue(stack.split(';')[-1].startswith('busy_loop (test_profiler.py:'))
+        self.assertGreater(int(count), 0)
+
+
+class ProfileStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = ProfileStore(self.directory.name, keep=2)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_save_and_load(self):
+        profile_id = self.store.save({'id': 'a' * 32, 'folded': 'main 1\n'})
+
+        self.assertEqual(self.store.load(profile_id)['folded'], 'main 1\n')
+        self.assertIsNone(self.store.load('b' * 32))
+
+    def test_ids_cannot_leave_the_directory(self):
+        self.assertIsNone(self.store.load('../' + 'a' * 29))
+
+    def test_oldest_profiles_are_pruned(self):
+        for n, letter in enumerate('abc'):
+            self.store.save({'id': letter * 32})
+            os.utime(self.store.path(letter * 32), (n, n))
+        self.store.prune()
+
+        self.assertEqual(sorted(os.listdir(self.directory.name)), ['b' * 32 + '.json', 'c' * 32 + '.json'])
+
+
+# From app directory, run 'python test_profiler.py' to start tests
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+from ratelimit import MemoryBucketBackend, RateLimiter, retry_after
+
+
+class MemoryBucketBackendTestCase(unittest.TestCase):
+
+    def test_burst_then_refill(self):
+        backend = MemoryBucketBackend()
+
+        self.assertEqual([backend.take('a', 1, 2, 100.0) for _ in range(2)], [0.0, 0.0])
+        self.assertAlmostEqual(backend.take('a', 1, 2, 100.0), 1.0)
+        self.assertEqual(backend.take('a', 1, 2, 101.0), 0.0)
+
+    def test_buckets_are_independent(self):
+        backend = MemoryBucketBackend()
+        backend.take('a', 1, 1, 100.0)
+
+        self.assertEqual(backend.take('b', 1, 1, 100.0), 0.0)
+
+    def test_least_recently_used_bucket_is_dropped(self):
+        backend = MemoryBucketBackend(max_keys=2)
+        for key in ('a', 'b', 'c'):
+            backend.take(key, 1, 1, 100.0)
+
+        self.assertEqual(backend.size(), 2)
+        self.assertEqual(backend.take('a', 1, 1, 100.0), 0.0)
+
+
+class RateLimiterTestCase(unittest.TestCase):
+
+    def test_permission_limits_and_default(self):
+        limiter = RateLimiter(MemoryBucketBackend(), {
+            'default': {'rate': 1, 'burst': 1},
+            'get:actors': {'rate': 1, 'burst': 3}
+        })
+
+        self.assertEqual(sum(1 for _ in range(5) if not limiter.take('user', 'get:actors')), 3)
+        self.assertEqual(sum(1 for _ in range(5) if not limiter.take('user', 'get:movies')), 1)
+        self.assertEqual(limiter.stats()['limited'], 6)
+
+    def test_disabled_limiter_admits_everything(self):
+        limiter = RateLimiter(None, {'default': {'rate': 1, 'burst': 1}})
+
+        self.assertFalse(any(limiter.take('user', 'get:actors') for _ in range(5)))
+
+    def test_retry_after_is_whole_seconds(self):
+        self.assertEqual(retry_after(0.2), 1)
+        self.assertEqual(retry_after(2.5), 3)
+
+
+# From app directory, run 'python test_ratelimit.py' to start tests
+if __name__ == "__main__":
+    unittest.main()
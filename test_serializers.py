@@ -0,0 +1,45 @@
+import json
+import unittest
+from datetime import date
+from unittest import mock
+from sqlalchemy import column
+import serializers
+from serializers import dumps, rows_to_dicts
+
+
+class DumpsTestCase(unittest.TestCase):
+
+    payload = {'movies': [{'id': 1, 'title': 'Big', 'release_date': date(1988, 6, 3)}]}
+
+    def test_dates_keep_the_jsonify_format(self):
+        self.assertEqual(json.loads(dumps(self.payload))['movies'][0]['release_date'],
+                         'Fri, 03 Jun 1988 00:00:00 GMT')
+
+    def test_iso_dates(self):
+        with mock.patch('serializers.JSON_DATE_FORMAT', 'iso'):
+            self.assertEqual(json.loads(dumps(self.payload))['movies'][0]['release_date'], '1988-06-03')
+
+    @unittest.skipIf(serializers.orjson is None, 'orjson is not installed')
+    def test_standard_library_fallback_matches_orjson(self):
+        with mock.patch('serializers.orjson', None):
+            fallback = dumps(self.payload)
+
+        self.assertEqual(fallback, dumps(self.payload))
+
+    def test_unknown_types_are_rejected(self):
+        with self.assertRaises(TypeError):
+            dumps({'value': object()})
+
+
+class RowsToDictsTestCase(unittest.TestCase):
+
+    def test_rows_are_zipped_with_column_names(self):
+        rows = [(1, 'Big'), (2, 'The Post')]
+
+        self.assertEqual(rows_to_dicts((column('id'), column('title')), rows),
+                         [{'id': 1, 'title': 'Big'}, {'id': 2, 'title': 'The Post'}])
+
+
+# From app directory, run 'python test_serializers.py' to start tests
+if __name__ == "__main__":
+    unittest.main()
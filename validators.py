@@ -0,0 +1,101 @@
+from datetime import date, datetime
+from email.utils import parsedate_to_datetime
+
+'''
+Request body validation shared by the single-item and bulk handlers
+    each validator returns the column values to write, or raises
+    ValidationError with the status code the handler should answer with
+'''
+
+
+class ValidationError(Exception):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+def parse_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    if not isinstance(value, str):
+        raise ValidationError(422)
+    try:
+        return date.fromisoformat(value[:10])
+    except ValueError:
+        pass
+    # dates echoed back from our own responses use the HTTP date format
+    try:
+        return parsedate_to_datetime(value).date()
+    except (TypeError, ValueError):
+        raise ValidationError(422)
+
+
+def validate_fields(body, required, converters, partial=False):
+    if not body or not isinstance(body, dict):
+        raise ValidationError(400)
+
+    if not partial and not all(body.get(name) for name in required):
+        raise ValidationError(422)
+
+    fields = {}
+    for name, convert in converters.items():
+        if name in body:
+            fields[name] = convert(body[name])
+    return fields
+
+
+def _string(value):
+    if not isinstance(value, str) or not value:
+        raise ValidationError(422)
+    return value
+
+
+def _integer(value):
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValidationError(422)
+    return value
+
+
+'''
+validate_actor(body, partial=False)
+    a new actor needs name, age and gender
+    partial validation (PATCH) only checks the fields present in the body
+'''
+def validate_actor(body, partial=False):
+    return validate_fields(body, ('name', 'age', 'gender'), {
+        'name': _string,
+        'age': _integer,
+        'gender': _string
+    }, partial)
+
+
+'''
+validate_movie(body, partial=False)
+    a new movie needs title and release_date
+    partial validation (PATCH) only checks the fields present in the body
+'''
+def validate_movie(body, partial=False):
+    return validate_fields(body, ('title', 'release_date'), {
+        'title': _string,
+        'release_date': parse_date
+    }, partial)
+
+
+'''
+validate_rating(body)
+    the body of a casting request is optional, its rating a number from 0 to 5
+'''
+def validate_rating(body, partial=False):
+    if body is None:
+        return {'rating': None}
+    if not isinstance(body, dict):
+        raise ValidationError(400)
+
+    rating = body.get('rating')
+    if rating is not None:
+        if isinstance(rating, bool) or not isinstance(rating, (int, float)) \
+                or not 0 <= rating <= 5:
+            raise ValidationError(422)
+        rating = float(rating)
+    return {'rating': rating}